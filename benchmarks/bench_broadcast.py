@@ -0,0 +1,117 @@
+"""
+Measure the broadcast traffic saved by conflation and delta payloads.
+
+Replays a simulated stream of location pings (and the odd status change)
+from --deliveries devices pinging --rate times a second through the relay's
+BroadcastScheduler, on a simulated clock, and counts the events sent and the
+bytes each subscriber receives, with every event sent in full and with the
+scheduler at several location intervals.
+
+    python benchmarks/bench_broadcast.py --deliveries 1000 --rate 5 --duration 60
+"""
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django, build_delivery_son, STATUSES
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def simulate(args):
+    """
+    Build the pings of every delivery, in time order.
+    Returns:
+        list: (time, delivery, message) tuples.
+    """
+    from deliveries.outbox import event_message
+
+    rng = random.Random(42)
+    events = []
+    for index in range(args.deliveries):
+        delivery = build_delivery_son(index, history_length=0, rng=rng)
+        delivery["status"] = "in transit"
+        lon, lat = delivery["current_location"]["coordinates"]
+        # Devices don't ping in step
+        at = rng.random() / args.rate
+        step = 0
+        while at < args.duration:
+            lon += rng.uniform(-0.0005, 0.0005)
+            lat += rng.uniform(-0.0005, 0.0005)
+            step += 1
+            status_change = args.status_every and step % args.status_every == 0
+            if status_change:
+                delivery["status"] = STATUSES[(STATUSES.index(delivery["status"]) + 1) % (len(STATUSES) - 1)]
+            location = {"type": "Point", "coordinates": [lon, lat]}
+            son = {**delivery, "current_location": location,
+                   "last_updated": delivery["last_updated"] + timedelta(seconds=at)}
+            events.append((at, son, event_message(son, {
+                "event_id": f"{index:08d}{step:08d}",
+                "update_type": "status" if status_change else "location",
+                "status": son["status"] if status_change else None,
+                "location": location,
+                "created_at": son["last_updated"],
+            })))
+            at += 1 / args.rate
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def replay(events, interval):
+    """
+    Returns:
+        tuple: (messages sent, bytes sent) per subscriber of every delivery.
+    """
+    from deliveries.broadcast import BroadcastScheduler
+    from deliveries.events import event_payload
+
+    if interval is None:
+        sent = [message for _, _, message in events]
+    else:
+        clock = SimulatedClock()
+        scheduler = BroadcastScheduler(interval=interval, clock=clock)
+        sent = []
+        for at, delivery, message in events:
+            clock.now = at
+            sent += [ready for _, ready in scheduler.due()]
+            sent += [ready for _, ready in scheduler.submit(delivery, message)]
+        sent += [ready for _, ready in scheduler.flush()]
+    return len(sent), sum(len(json.dumps(event_payload(message))) for message in sent)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--deliveries", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=5, help="pings per second per delivery")
+    parser.add_argument("--duration", type=float, default=60, help="simulated seconds")
+    parser.add_argument("--status-every", type=int, default=300, help="pings between status changes, 0 for none")
+    parser.add_argument("--intervals", default="0,0.5,1,2,5", help="location intervals to compare, in seconds")
+    args = parser.parse_args()
+
+    setup_django()
+    events = simulate(args)
+    baseline_count, baseline_bytes = replay(events, None)
+    print(f"\n{len(events)} events from {args.deliveries} deliveries at {args.rate}/s over {args.duration:.0f}s")
+    print(f"{'broadcast':<22} {'events/s':>10} {'bytes/event':>12} {'bytes/s':>12} {'traffic':>8}")
+    rows = [("every event, full", None)] + [
+        (f"interval {float(value):g}s + deltas", float(value)) for value in args.intervals.split(",")
+    ]
+    for name, interval in rows:
+        count, size = (baseline_count, baseline_bytes) if interval is None else replay(events, interval)
+        print(f"{name:<22} {count / args.duration:>10.0f} {size / max(count, 1):>12.0f} "
+              f"{size / args.duration:>12.0f} {size / baseline_bytes:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
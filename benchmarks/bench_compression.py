@@ -0,0 +1,94 @@
+"""
+Measure the bytes/latency trade-off of response compression on delivery lists.
+
+Payloads are built like scripts/seed.py data and rendered with FastJSONRenderer.
+For every available encoding and level it reports the compressed size, the
+compress/decompress time and the estimated time to deliver the response over
+a few link speeds (compress + transfer + decompress).
+
+    python benchmarks/bench_compression.py --count 500
+"""
+import os
+import sys
+import gzip
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django, build_delivery_son, measure
+
+setup_django()
+
+from deliveries.renderers import FastJSONRenderer
+from deliveries.utils.serializers import delivery_from_son, ndjson_lines
+from logistics_backend.middleware import CODECS, brotli, zstandard
+
+# Link speeds in bytes per second
+LINKS = [
+    ("3G (1.5 Mbit/s)", 1.5e6 / 8),
+    ("LTE (20 Mbit/s)", 20e6 / 8),
+    ("LAN (1 Gbit/s)", 1e9 / 8),
+]
+
+LEVELS = {
+    "gzip": [1, 6, 9],
+    "br": [1, 4, 11],
+    "zstd": [1, 3, 9],
+}
+
+DECOMPRESSORS = {
+    "gzip": gzip.decompress,
+    "br": brotli.decompress if brotli is not None else None,
+    "zstd": (lambda data: zstandard.ZstdDecompressor().decompress(data)) if zstandard is not None else None,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--history", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    deliveries = [delivery_from_son(build_delivery_son(i, args.history, rng)) for i in range(args.count)]
+    payload = FastJSONRenderer().render(deliveries)
+    chunks = list(ndjson_lines(deliveries))
+
+    print(f"\n{args.count} deliveries, {len(payload)} bytes uncompressed")
+    header = f"{'encoding':<10} {'size':>10} {'ratio':>7} {'comp (ms)':>10} {'decomp (ms)':>12}"
+    print(header + "".join(f" {name:>18}" for name, _ in LINKS))
+
+    identity = "".join(f" {len(payload) / speed * 1000:>15.1f} ms" for _, speed in LINKS)
+    print(f"{'identity':<10} {len(payload):>10} {'100%':>7} {'-':>10} {'-':>12}" + identity)
+
+    for encoding, codec_class in CODECS.items():
+        if codec_class is None:
+            print(f"{encoding:<10} not installed")
+            continue
+        for level in LEVELS[encoding]:
+            codec = codec_class(level)
+            compressed = codec.compress(payload)
+            compress_time = measure(lambda: codec.compress(payload), args.repeat)["median"]
+            decompress_time = measure(lambda: DECOMPRESSORS[encoding](compressed), args.repeat)["median"]
+            totals = "".join(
+                f" {(compress_time + len(compressed) / speed + decompress_time) * 1000:>15.1f} ms"
+                for _, speed in LINKS
+            )
+            print(
+                f"{encoding + '-' + str(level):<10} {len(compressed):>10} {len(compressed) / len(payload):>7.0%} "
+                f"{compress_time * 1000:>10.2f} {decompress_time * 1000:>12.2f}" + totals
+            )
+
+    print("\nStreaming NDJSON (flush per chunk of 100 lines)")
+    for encoding, codec_class in CODECS.items():
+        if codec_class is None:
+            continue
+        compress, finish = codec_class(LEVELS[encoding][1]).stream()
+        streamed = sum(len(compress(chunk)) for chunk in chunks) + len(finish())
+        print(f"{encoding:<10} {streamed:>10} {streamed / sum(map(len, chunks)):>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Compare JSON and MessagePack payload size and encode/decode time.
+
+Covers a delivery list response and a single WebSocket delivery_update event.
+No database is needed, deliveries are generated in memory.
+
+    python benchmarks/bench_encoding.py --count 1000
+"""
+import os
+import sys
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django, build_delivery_son, measure, print_table
+
+setup_django()
+
+from deliveries.utils.serializers import delivery_from_son, dumps, loads, msgpack_dumps, msgpack_loads
+
+
+def stdlib_dumps(data):
+    return json.dumps(data, default=str, separators=(",", ":")).encode("utf-8")
+
+
+CODECS = [
+    ("json (stdlib)", stdlib_dumps, json.loads),
+    ("json (fast)", dumps, loads),
+    ("msgpack", msgpack_dumps, msgpack_loads),
+]
+
+
+def run(title, payload, iterations, repeat):
+    rows = []
+    sizes = []
+    for name, encode, decode in CODECS:
+        encoded = encode(payload)
+        sizes.append((name, len(encoded)))
+        rows.append((f"{name} encode", measure(lambda: [encode(payload) for _ in range(iterations)], repeat)))
+        rows.append((f"{name} decode", measure(lambda: [decode(encoded) for _ in range(iterations)], repeat)))
+    print_table(f"{title} (x{iterations})", rows, baseline="json (stdlib) encode")
+    json_size = sizes[0][1]
+    for name, size in sizes:
+        print(f"{name:<40} {size:>12} bytes {size / json_size:>8.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    deliveries = [delivery_from_son(build_delivery_son(i, 3, rng)) for i in range(args.count)]
+    event = {
+        "type": "delivery_update",
+        "update_type": "location",
+        "delivery": deliveries[0]["delivery_id"],
+        "location": deliveries[0]["current_location"],
+        "status": deliveries[0]["status"],
+        "timestamp": deliveries[0]["last_updated"].isoformat()
+    }
+
+    run(f"delivery list, {args.count} deliveries", deliveries, 1, args.repeat)
+    run("delivery_update event", event, 10000, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Measure the event throughput of the fleet stream.
+
+Publishes delivery events the way the relays do (deliveries.events.publish,
+one batch of deliveries concurrently) while --subscribers fleet subscribers,
+a quarter of them filtered by status, read them from the channel layer. The
+publish rate and the rate at which every subscriber has received its events
+are reported, with the events a subscriber never got: the Redis channel
+layer drops messages for channels over their capacity.
+
+Runs against the configured Redis channel layer, or the in-memory one with
+--stand-ins, which deep-copies every message and is much slower.
+
+    python benchmarks/bench_fleet_stream.py --events 20000 --subscribers 50
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django, build_delivery_son, STATUSES
+
+
+async def subscriber(layer, groups, received):
+    channel = await layer.new_channel()
+    for group in groups:
+        await layer.group_add(group, channel)
+    received[channel] = 0
+    try:
+        while True:
+            await layer.receive(channel)
+            received[channel] += 1
+    except asyncio.CancelledError:
+        for group in groups:
+            await layer.group_discard(group, channel)
+
+
+async def run(layer, args):
+    from deliveries.events import publish, fleet_group
+    from deliveries.outbox import event_message
+
+    rng = random.Random(42)
+    deliveries = [build_delivery_son(index, history_length=0, rng=rng) for index in range(args.deliveries)]
+    events = []
+    for index in range(args.events):
+        delivery = deliveries[index % len(deliveries)]
+        events.append((delivery, event_message(delivery, {
+            "event_id": f"{index:032x}",
+            "update_type": "location",
+            "location": delivery["current_location"],
+            "created_at": delivery["last_updated"],
+        })))
+
+    # A quarter of the subscribers follow one status, the rest the whole fleet
+    filters = [[STATUSES[index % len(STATUSES)]] if index % 4 == 3 else [] for index in range(args.subscribers)]
+    expected = [
+        sum(1 for delivery, _ in events if not statuses or delivery["status"] in statuses)
+        for statuses in filters
+    ]
+    received = {}
+    readers = [
+        asyncio.create_task(subscriber(layer, [fleet_group(status) for status in statuses] or [fleet_group()],
+                                       received))
+        for statuses in filters
+    ]
+    while len(received) < len(readers):
+        await asyncio.sleep(0.01)
+
+    start = time.perf_counter()
+    for offset in range(0, len(events), args.batch_size):
+        await asyncio.gather(*(publish(layer, delivery, message)
+                               for delivery, message in events[offset:offset + args.batch_size]))
+    published = time.perf_counter() - start
+
+    # Wait until the subscribers have read everything or nothing more arrives
+    total, idle_since = -1, time.perf_counter()
+    while sum(received.values()) < sum(expected) and time.perf_counter() - idle_since < 2:
+        await asyncio.sleep(0.01)
+        if sum(received.values()) != total:
+            total, idle_since = sum(received.values()), time.perf_counter()
+    delivered = (idle_since if sum(received.values()) < sum(expected) else time.perf_counter()) - start
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers)
+    return published, delivered, sum(expected), sum(received.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--deliveries", type=int, default=2000, help="deliveries the events are spread over")
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=100, help="events published concurrently")
+    parser.add_argument("--stand-ins", action="store_true", help="use the in-memory channel layer")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from channels.layers import get_channel_layer
+
+    if args.stand_ins:
+        settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    layer = get_channel_layer()
+
+    published, delivered, expected, received = asyncio.run(run(layer, args))
+    print(f"\n{args.events} events over {args.deliveries} deliveries, {args.subscribers} fleet subscribers, "
+          f"{type(layer).__name__}")
+    print(f"{'published':<12} {args.events / published:>12.0f} events/s")
+    print(f"{'delivered':<12} {args.events / delivered:>12.0f} events/s  {received / delivered:>12.0f} messages/s")
+    print(f"{'dropped':<12} {expected - received:>12} of {expected} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Measure location updates and snapshot reads with the Redis hot state.
+
+Sends --pings location updates to each of --deliveries deliveries through
+HotStateStore.update, once written through to Mongo and once written behind
+and flushed in bulk writes, and reports the update latency and the Mongo
+writes each took. Then times snapshot reads from Mongo and from the hot state.
+
+Runs against the configured Mongo and Redis. The deliveries are inserted with
+HOTBENCH ids and removed at the end.
+
+    python benchmarks/bench_hot_state.py --deliveries 200 --pings 20
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django, build_delivery_son, measure, print_table
+
+
+def ping(store, delivery_id, rng):
+    from deliveries.outbox import new_event
+
+    location = {"type": "Point", "coordinates": [rng.uniform(-74.1, -73.9), rng.uniform(40.6, 40.9)]}
+    now = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    store.update(delivery_id, new_event("location", location, timestamp=now),
+                 {"current_location": location, "last_updated": now})
+    return time.perf_counter() - start
+
+
+def run(store, delivery_ids, args, durability):
+    """
+    Returns:
+        tuple: (ping latencies, seconds to flush, Mongo writes).
+    """
+    from django.conf import settings
+    from deliveries.hot_state import HotStateFlusher
+
+    settings.HOT_STATE_DURABILITY = {**settings.HOT_STATE_DURABILITY,
+                                     "current_location": durability, "last_updated": durability}
+    rng = random.Random(42)
+    latencies = [ping(store, delivery_id, rng) for _ in range(args.pings) for delivery_id in delivery_ids]
+    if not durability:
+        return latencies, 0.0, len(latencies)
+
+    flusher = HotStateFlusher(store, batch_size=args.batch_size)
+    start = time.perf_counter()
+    bulk_writes = 0
+    while flusher.flush_once(everything=True):
+        bulk_writes += 1
+    # The first ping of each delivery was written through, it made the hash
+    return latencies, time.perf_counter() - start, len(delivery_ids) + bulk_writes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--deliveries", type=int, default=200)
+    parser.add_argument("--pings", type=int, default=20, help="location updates per delivery")
+    parser.add_argument("--batch-size", type=int, default=500, help="deliveries per flush")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    setup_django()
+    from deliveries.mongo.delivery import Delivery
+    from deliveries.mongo.readers import get_delivery_reader
+    from deliveries.hot_state import HotStateStore
+
+    collection = Delivery._get_collection()
+    rng = random.Random(42)
+    sons = []
+    for index in range(args.deliveries):
+        son = build_delivery_son(index, rng=rng)
+        son.update(delivery_id=f"HOTBENCH{index:06d}", status="in transit", outbox=[])
+        sons.append(son)
+    delivery_ids = [son["delivery_id"] for son in sons]
+    collection.delete_many({"delivery_id": {"$in": delivery_ids}})
+    collection.insert_many(sons)
+    store = HotStateStore()
+
+    try:
+        total = args.deliveries * args.pings
+        print(f"\n{total} location updates over {args.deliveries} deliveries")
+        print(f"{'write':<22} {'p50 (ms)':>10} {'p99 (ms)':>10} {'flush (ms)':>11} {'Mongo writes':>13}")
+        for name, durability in [("through", 0), ("behind, 1s", 1.0)]:
+            latencies, flushed, writes = run(store, delivery_ids, args, durability)
+            latencies.sort()
+            print(f"{name:<22} {statistics.median(latencies) * 1000:>10.3f} "
+                  f"{latencies[int(len(latencies) * 0.99)] * 1000:>10.3f} {flushed * 1000:>11.1f} {writes:>13}")
+
+        reader = get_delivery_reader(route="tracking")
+        print_table(f"{args.deliveries} snapshot reads", [
+            ("mongo", measure(lambda: [reader.snapshot(delivery_id) for delivery_id in delivery_ids], args.repeat)),
+            ("hot state", measure(lambda: [store.snapshot(delivery_id) for delivery_id in delivery_ids], args.repeat)),
+        ], baseline="mongo")
+    finally:
+        for delivery_id in delivery_ids:
+            store.evict(delivery_id)
+        collection.delete_many({"delivery_id": {"$in": delivery_ids}})
+
+
+if __name__ == "__main__":
+    main()
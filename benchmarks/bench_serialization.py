@@ -0,0 +1,57 @@
+"""
+Compare the delivery list serialization paths.
+
+The old path hydrates mongoengine documents, calls to_dict() and renders with
+DRF's JSONRenderer. The new path builds the wire schema straight from the raw
+Mongo documents and renders with FastJSONRenderer. No database is needed, raw
+documents are generated in memory.
+
+    python benchmarks/bench_serialization.py --count 10000
+"""
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django, build_delivery_son, measure, print_table
+
+setup_django()
+
+from rest_framework.renderers import JSONRenderer
+from deliveries.mongo.delivery import Delivery
+from deliveries.renderers import FastJSONRenderer
+from deliveries.utils.serializers import delivery_from_son
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--history", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    sons = [build_delivery_son(i, args.history, rng) for i in range(args.count)]
+    stock, fast = JSONRenderer(), FastJSONRenderer()
+
+    def old_path():
+        return stock.render([Delivery._from_son(son).to_dict() for son in sons])
+
+    def new_path():
+        return fast.render([delivery_from_son(son) for son in sons])
+
+    assert old_path() == new_path(), "serialization paths disagree"
+
+    rows = [
+        ("hydrate + to_dict + JSONRenderer", measure(old_path, args.repeat)),
+        ("hydrate only", measure(lambda: [Delivery._from_son(son) for son in sons], args.repeat)),
+        ("raw + FastJSONRenderer", measure(new_path, args.repeat)),
+    ]
+    print_table(f"{args.count} deliveries, {args.history} history entries each", rows,
+                baseline="hydrate + to_dict + JSONRenderer")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measure the Redis memory taken per session by the token store.
+
+Stores the same tokens in the legacy format (token:<JWT> -> user_id) and in
+the current one (t:<jti> -> user_id plus the sessions:<user_id> index) and
+reports the bytes per session, from MEMORY USAGE on a real Redis. fakeredis
+(--stand-ins) has no MEMORY USAGE, there the key and value bytes are summed
+instead, which leaves out Redis' own per-key overhead.
+
+The keys are written to --db, use a database nothing else uses.
+
+    python benchmarks/bench_token_memory.py --tokens 10000 --users 1000 --db 15
+"""
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django
+
+
+def legacy_store(client, token, user_id, ttl):
+    client.setex(f"token:{token}", ttl, user_id)
+    return [f"token:{token}"]
+
+
+def key_bytes(client, keys):
+    """Memory of keys, from MEMORY USAGE if the server has it"""
+    try:
+        return sum(client.memory_usage(key, samples=0) or 0 for key in keys), "MEMORY USAGE"
+    except Exception:
+        pass
+    total = 0
+    for key in keys:
+        key_type = client.type(key)
+        if key_type == b"zset":
+            total += len(key) + sum(len(member) + 8 for member, _ in client.zrange(key, 0, -1, withscores=True))
+        else:
+            total += len(key) + len(client.get(key) or b"")
+    return total, "key and value bytes"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000, help="users the tokens are spread over")
+    parser.add_argument("--db", type=int, default=15, help="Redis database to write to")
+    parser.add_argument("--fleet", type=int, default=1000000, help="sessions to project the totals for")
+    parser.add_argument("--stand-ins", action="store_true", help="use fakeredis")
+    args = parser.parse_args()
+
+    if args.stand_ins:
+        import redis
+        import fakeredis
+        redis.Redis = fakeredis.FakeRedis
+    setup_django()
+
+    from django.conf import settings
+    import jwt
+    from users.utils.jwt_utils import build_payload
+    from users.utils.redis_auth import redis_token_manager, SESSIONS_KEY
+    from monitoring.redis_client import InstrumentedRedis
+
+    client = InstrumentedRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=args.db)
+    redis_token_manager.redis_client = client
+    ttl = settings.JWT_TTL_SECONDS
+
+    rng = random.Random(42)
+    user_ids = [f"{rng.getrandbits(96):024x}" for _ in range(args.users)]
+    tokens = []
+    for index in range(args.tokens):
+        user_id = user_ids[index % len(user_ids)]
+        tokens.append((jwt.encode(build_payload(user_id), settings.JWT_SECRET_KEY, algorithm="HS256"), user_id))
+
+    results = {}
+    try:
+        keys = []
+        for token, user_id in tokens:
+            keys += legacy_store(client, token, user_id, ttl)
+        results["legacy token:<JWT>"] = key_bytes(client, keys)
+        client.delete(*keys)
+
+        keys = {SESSIONS_KEY.format(user_id=user_id) for user_id in user_ids}
+        for token, user_id in tokens:
+            redis_token_manager.store_token(token, user_id)
+            keys.add(redis_token_manager.token_key(token))
+        results["t:<jti> + sessions index"] = key_bytes(client, list(keys))
+        client.delete(*keys)
+    finally:
+        client.close()
+
+    print(f"\n{args.tokens} sessions over {args.users} users, JWT {len(tokens[0][0])} bytes")
+    print(f"{'format':<28} {'bytes/session':>14} {f'{args.fleet} sessions':>20}  measured with")
+    for name, (total, method) in results.items():
+        per_session = total / args.tokens
+        print(f"{name:<28} {per_session:>14.1f} {per_session * args.fleet / 2**20:>16.1f} MiB  {method}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import random
+import statistics
+from datetime import datetime, timedelta
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATUSES = ['pending', 'in transit', 'out for delivery', 'delivered']
+
+
+def setup_django():
+    """Setup the Django environment for standalone benchmark scripts"""
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'logistics_backend.settings')
+    import django
+    django.setup()
+
+
+def build_delivery_son(index, history_length=3, rng=None):
+    """
+    Build a delivery document as it is stored in Mongo.
+    Args:
+        index: Sequence number used for the delivery ID.
+        history_length: Number of status history entries.
+        rng: Optional random.Random instance.
+    Returns:
+        dict: The raw delivery document.
+    """
+    rng = rng or random
+    now = datetime(2025, 1, 1, 12, 0, 0, 123000)
+    history = []
+    for step in range(history_length):
+        history.append({
+            "status": STATUSES[min(step, len(STATUSES) - 1)],
+            "location": {
+                "type": "Point",
+                "coordinates": [rng.uniform(-74.1, -73.9), rng.uniform(40.6, 40.9)]
+            },
+            "timestamp": now - timedelta(minutes=history_length - step)
+        })
+    return {
+        "delivery_id": f"DEL{index:08d}",
+        "title": f"Benchmark Delivery {index}",
+        "status": rng.choice(STATUSES),
+        "customer_id": f"customer_{index % 500}",
+        "recipient_name": f"Recipient {index}",
+        "current_location": {
+            "type": "Point",
+            "coordinates": [rng.uniform(-74.1, -73.9), rng.uniform(40.6, 40.9)]
+        },
+        "destination": f"{index % 999 + 1} Broadway, New York, NY 10001",
+        "created_at": now - timedelta(days=1),
+        "last_updated": now,
+        "status_history": history
+    }
+
+
+def measure(func, repeat=5):
+    """
+    Time a callable several times.
+    Args:
+        func: The zero-argument callable to time.
+        repeat: Number of runs.
+    Returns:
+        dict: Best and median wall time in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return {"best": min(timings), "median": statistics.median(timings)}
+
+
+def print_table(title, rows, baseline=None):
+    """
+    Print benchmark results as a table.
+    Args:
+        title: Heading printed above the table.
+        rows: List of (name, result dict) tuples as returned by measure().
+        baseline: Name of the row the speedup is computed against.
+    """
+    base = dict(rows).get(baseline) if baseline else None
+    print(f"\n{title}")
+    print(f"{'path':<40} {'best (ms)':>12} {'median (ms)':>12} {'speedup':>9}")
+    for name, result in rows:
+        speedup = f"{base['median'] / result['median']:.2f}x" if base else "-"
+        print(f"{name:<40} {result['best'] * 1000:>12.2f} {result['median'] * 1000:>12.2f} {speedup:>9}")
@@ -0,0 +1,606 @@
+"""
+End-to-end HTTP + WebSocket load test.
+
+Runs realistic scenarios concurrently and reports p50/p95/p99 latency and
+throughput per endpoint as JSON:
+
+- drivers:     location pings to DeliveryLocationUpdate
+- updaters:    status updates to DeliveryStatusUpdate
+- pollers:     public tracking polls to DeliveryDetailView
+- subscribers: WebSocket clients of DeliveryConsumer
+- logins:      bursts of logins
+
+By default requests go through the ASGI application in-process, with the
+hot state flusher and the outbox relay running in the same event loop, so
+subscribers get the updates. Pass --base-url to load a running server over
+the network instead, which runs its own. --stand-ins
+swaps MongoDB and Redis for mongomock/fakeredis and uses the in-memory
+channel layer (in-process only), see requirements-bench.txt.
+
+    python benchmarks/loadtest.py --duration 30 --stand-ins
+    python benchmarks/loadtest.py --base-url http://localhost:8000 --output results.json
+"""
+import os
+import sys
+import ssl
+import json
+import time
+import inspect
+import base64
+import random
+import struct
+import asyncio
+import argparse
+import statistics
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import setup_django, build_delivery_son
+
+LOADTEST_PASSWORD = "loadtest-password"
+REQUEST_TIMEOUT = 30
+
+
+def install_stand_ins():
+    """Swap MongoDB and Redis for in-process stand-ins, must run before Django setup"""
+    import mongoengine
+    import mongomock
+    import redis
+    import fakeredis
+
+    register_connection = mongoengine.register_connection
+
+    def register_mongomock(alias, db=None, host=None, **kwargs):
+        # Pool and monitoring options don't apply to mongomock
+        return register_connection(alias, db=db, host="mongodb://localhost", mongo_client_class=mongomock.MongoClient)
+
+    mongoengine.register_connection = register_mongomock
+    redis.Redis = fakeredis.FakeRedis
+
+    # pymongo 4.11+ passes sort= to bulk updates, mongomock 4.3 (the latest) doesn't take it
+    from mongomock.collection import BulkOperationBuilder
+
+    add_update = BulkOperationBuilder.add_update
+    if "sort" not in inspect.signature(add_update).parameters:
+        def add_update_unsorted(self, *args, sort=None, **kwargs):
+            if sort is not None:
+                raise NotImplementedError("mongomock can't sort bulk updates")
+            return add_update(self, *args, **kwargs)
+
+        BulkOperationBuilder.add_update = add_update_unsorted
+
+
+class Recorder:
+    """Collects latency samples and errors per endpoint"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    def record(self, name, seconds, ok):
+        if ok:
+            self.samples[name].append(seconds)
+        else:
+            self.errors[name] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for name in sorted(set(self.samples) | set(self.errors)):
+            samples = sorted(self.samples[name])
+            entry = {
+                "requests": len(samples) + self.errors[name],
+                "errors": self.errors[name],
+                "rps": round(len(samples) / elapsed, 2),
+            }
+            if samples:
+                entry["latency_ms"] = {
+                    "p50": round(percentile(samples, 50) * 1000, 3),
+                    "p95": round(percentile(samples, 95) * 1000, 3),
+                    "p99": round(percentile(samples, 99) * 1000, 3),
+                    "mean": round(statistics.fmean(samples) * 1000, 3),
+                    "max": round(samples[-1] * 1000, 3),
+                }
+            endpoints[name] = entry
+        counters = {name: {"count": value, "per_second": round(value / elapsed, 2)}
+                    for name, value in sorted(self.counters.items())}
+        return {"duration_s": round(elapsed, 3), "endpoints": endpoints, "counters": counters}
+
+
+def percentile(sorted_samples, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_samples) - 1, round(pct / 100 * len(sorted_samples) + 0.5) - 1))
+    return sorted_samples[index]
+
+
+# In-process transport
+
+class ASGIClient:
+    """Sends HTTP requests straight into the ASGI application"""
+
+    def __init__(self, application):
+        self.application = application
+
+    async def request(self, method, path, body=None, headers=None):
+        from asgiref.testing import ApplicationCommunicator
+
+        body = body or b""
+        raw_headers = [(b"host", b"localhost"), (b"content-length", str(len(body)).encode())]
+        for key, value in (headers or {}).items():
+            raw_headers.append((key.lower().encode(), value.encode()))
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": b"",
+            "root_path": "",
+            "headers": raw_headers,
+            "client": ("127.0.0.1", 50000),
+            "server": ("localhost", 80),
+        }
+        communicator = ApplicationCommunicator(self.application, scope)
+        await communicator.send_input({"type": "http.request", "body": body, "more_body": False})
+        start = await communicator.receive_output(REQUEST_TIMEOUT)
+        chunks = []
+        while True:
+            message = await communicator.receive_output(REQUEST_TIMEOUT)
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        await communicator.wait(REQUEST_TIMEOUT)
+        return start["status"], b"".join(chunks)
+
+    async def close(self):
+        pass
+
+
+class ASGIWebSocket:
+    """WebSocket session against the ASGI application"""
+
+    def __init__(self, application):
+        self.application = application
+        self.communicator = None
+
+    async def connect(self, path):
+        from asgiref.testing import ApplicationCommunicator
+
+        scope = {
+            "type": "websocket",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": b"",
+            "headers": [(b"host", b"localhost"), (b"origin", b"http://localhost")],
+            "subprotocols": [],
+            "client": ("127.0.0.1", 50000),
+            "server": ("localhost", 80),
+        }
+        self.communicator = ApplicationCommunicator(self.application, scope)
+        await self.communicator.send_input({"type": "websocket.connect"})
+        message = await self.communicator.receive_output(REQUEST_TIMEOUT)
+        return message["type"] == "websocket.accept"
+
+    async def send(self, text):
+        await self.communicator.send_input({"type": "websocket.receive", "text": text})
+
+    async def receive(self, timeout):
+        message = await self.communicator.receive_output(timeout)
+        if message["type"] == "websocket.close":
+            raise ConnectionError("WebSocket closed")
+        return message.get("text") or message.get("bytes")
+
+    async def close(self):
+        if self.communicator:
+            await self.communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+            await self.communicator.wait(REQUEST_TIMEOUT)
+
+
+# Network transport
+
+class HTTPClient:
+    """Minimal HTTP/1.1 keep-alive client, one connection per virtual user"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.reader = self.writer = None
+
+    async def _open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def request(self, method, path, body=None, headers=None):
+        if self.writer is None:
+            await self._open()
+        body = body or b""
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", f"Content-Length: {len(body)}"]
+        lines += [f"{key}: {value}" for key, value in (headers or {}).items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+        try:
+            return await asyncio.wait_for(self._read_response(), REQUEST_TIMEOUT)
+        except Exception:
+            await self.close()
+            raise
+
+    async def _read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            body = b"".join(chunks)
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", 0)))
+        keep_alive = status_line.startswith(b"HTTP/1.1")
+        if headers.get("connection", "").lower() == ("keep-alive" if not keep_alive else "close"):
+            keep_alive = not keep_alive
+        if not keep_alive:
+            await self.close()
+        return status, body
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class NetworkWebSocket:
+    """Minimal RFC 6455 client, text frames only"""
+
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self.origin = f"{parts.scheme}://{parts.netloc}"
+        self.reader = self.writer = None
+
+    async def connect(self, path):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            f"GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nUpgrade: websocket\r\n"
+            f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n"
+            f"Origin: {self.origin}\r\n\r\n"
+        ).encode())
+        status_line = await asyncio.wait_for(self.reader.readline(), REQUEST_TIMEOUT)
+        while (await self.reader.readline()) not in (b"\r\n", b""):
+            pass
+        return b" 101 " in status_line
+
+    def _frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 65536:
+            header += bytes([0x80 | 126]) + struct.pack("!H", length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+        mask = os.urandom(4)
+        return header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+    async def send(self, text):
+        self.writer.write(self._frame(0x1, text.encode()))
+        await self.writer.drain()
+
+    async def receive(self, timeout):
+        while True:
+            head = await asyncio.wait_for(self.reader.readexactly(2), timeout)
+            opcode, length = head[0] & 0x0F, head[1] & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+            payload = await self.reader.readexactly(length)
+            if opcode == 0x8:
+                raise ConnectionError("WebSocket closed")
+            if opcode == 0x9:
+                self.writer.write(self._frame(0xA, payload))
+                continue
+            if opcode in (0x1, 0x2):
+                return payload.decode() if opcode == 0x1 else payload
+
+    async def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.write(self._frame(0x8, struct.pack("!H", 1000)))
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+# Scenarios
+
+class LoadTest:
+    def __init__(self, options):
+        self.options = options
+        self.recorder = Recorder()
+        self.deadline = 0
+        self.delivery_ids = []
+        self.admin_token = None
+        self.login_usernames = []
+        self.application = None
+        self.background_error = None
+
+    def http_client(self):
+        if self.options.base_url:
+            return HTTPClient(self.options.base_url)
+        return ASGIClient(self.application)
+
+    def websocket(self):
+        if self.options.base_url:
+            return NetworkWebSocket(self.options.base_url)
+        return ASGIWebSocket(self.application)
+
+    async def timed(self, name, client, method, path, payload=None, token=None, expected=(200,)):
+        headers = {}
+        body = None
+        if payload is not None:
+            body = json.dumps(payload).encode()
+            headers["Content-Type"] = "application/json"
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        start = time.perf_counter()
+        try:
+            status, response = await client.request(method, path, body, headers)
+            ok = status in expected
+            if status == 429:
+                self.recorder.count("rate_limited")
+        except Exception:
+            status, response, ok = None, b"", False
+        self.recorder.record(name, time.perf_counter() - start, ok)
+        return status, response
+
+    async def paced(self, interval, step):
+        """Run step() until the deadline, at most once per interval (0 = closed loop)"""
+        while time.monotonic() < self.deadline:
+            started = time.monotonic()
+            await step()
+            if interval:
+                await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    async def driver(self, rng):
+        client = self.http_client()
+        delivery_id = rng.choice(self.delivery_ids)
+
+        async def ping():
+            location = {"type": "Point", "coordinates": [rng.uniform(-74.1, -73.9), rng.uniform(40.6, 40.9)]}
+            await self.timed("location_update", client, "PUT", f"/api/v1/deliveries/{delivery_id}/location/",
+                             {"location": location}, self.admin_token)
+
+        await self.paced(self.options.ping_interval, ping)
+        await client.close()
+
+    async def updater(self, rng):
+        client = self.http_client()
+        statuses = ["in transit", "out for delivery", "in transit", "delivered"]
+
+        async def update():
+            location = {"type": "Point", "coordinates": [rng.uniform(-74.1, -73.9), rng.uniform(40.6, 40.9)]}
+            await self.timed("status_update", client, "PUT",
+                             f"/api/v1/deliveries/{rng.choice(self.delivery_ids)}/status/",
+                             {"status": rng.choice(statuses), "location": location}, self.admin_token)
+
+        await self.paced(self.options.status_interval, update)
+        await client.close()
+
+    async def poller(self, rng):
+        client = self.http_client()
+        delivery_id = rng.choice(self.delivery_ids)
+
+        async def poll():
+            await self.timed("delivery_detail", client, "GET", f"/api/v1/deliveries/{delivery_id}/")
+
+        await self.paced(self.options.poll_interval, poll)
+        await client.close()
+
+    async def subscriber(self, rng):
+        websocket = self.websocket()
+        delivery_id = rng.choice(self.delivery_ids)
+        start = time.perf_counter()
+        try:
+            connected = await websocket.connect(f"/ws/delivery/{delivery_id}/")
+        except Exception:
+            connected = False
+        self.recorder.record("ws_connect", time.perf_counter() - start, connected)
+        if not connected:
+            return
+        try:
+            start = time.perf_counter()
+            await websocket.send(json.dumps({"type": "subscribe_delivery"}))
+            await websocket.receive(REQUEST_TIMEOUT)
+            self.recorder.record("ws_subscribe", time.perf_counter() - start, True)
+            while time.monotonic() < self.deadline:
+                try:
+                    await websocket.receive(max(0.01, self.deadline - time.monotonic()))
+                    self.recorder.count("ws_messages_received")
+                except asyncio.TimeoutError:
+                    break
+        except Exception:
+            self.recorder.record("ws_subscribe", time.perf_counter() - start, False)
+        finally:
+            await websocket.close()
+
+    async def login_burst(self, rng):
+        clients = [self.http_client() for _ in range(self.options.login_burst_size)]
+
+        async def burst():
+            await asyncio.gather(*(
+                self.timed("login", client, "POST", "/api/v1/users/login/",
+                           {"username": rng.choice(self.login_usernames), "password": LOADTEST_PASSWORD})
+                for client in clients
+            ))
+
+        await self.paced(self.options.login_burst_interval, burst)
+        for client in clients:
+            await client.close()
+
+    def prepare(self):
+        """Create the load test users and deliveries, returns a cleanup callable"""
+        import bcrypt
+        from users.mongo.user import User
+        from users.utils.jwt_utils import generate_token
+        from deliveries.mongo.delivery import Delivery
+        from deliveries.hot_state import hot_state
+
+        rng = random.Random(self.options.seed)
+        password_hash = bcrypt.hashpw(LOADTEST_PASSWORD.encode(), bcrypt.gensalt()).decode()
+        admin = User(username="loadtest_admin", email="loadtest_admin@example.com",
+                     password_hash=password_hash, is_admin=True)
+        admin.save()
+        self.login_usernames = []
+        for index in range(10):
+            username = f"loadtest_user_{index}"
+            User(username=username, email=f"{username}@example.com", password_hash=password_hash).save()
+            self.login_usernames.append(username)
+
+        docs = []
+        for index in range(self.options.deliveries):
+            son = build_delivery_son(index, 3, rng)
+            son["delivery_id"] = f"LT{index:08d}"
+            docs.append(son)
+        Delivery._get_collection().insert_many(docs)
+        self.delivery_ids = [son["delivery_id"] for son in docs]
+        self.admin_token = generate_token(str(admin.id))
+
+        def cleanup():
+            for delivery_id in self.delivery_ids:
+                hot_state.evict(delivery_id)
+            Delivery.objects(delivery_id__in=self.delivery_ids).delete()
+            User.objects(username__in=["loadtest_admin"] + self.login_usernames).delete()
+
+        return cleanup
+
+    async def background(self):
+        """Flush the hot state and relay the outbox until the deadline, as the workers next to the app would"""
+        from asgiref.sync import sync_to_async
+        from django.conf import settings
+        from deliveries.outbox import OutboxRelay
+        from deliveries.hot_state import HotStateFlusher
+
+        # The relay's publishes run on this loop, where the in-memory channel layer lives
+        flush = sync_to_async(HotStateFlusher().flush_once, thread_sensitive=False)
+        relay = sync_to_async(OutboxRelay().relay_once, thread_sensitive=False)
+        while time.monotonic() < self.deadline:
+            try:
+                flushed = await flush()
+                relayed = await relay()
+            except Exception as e:
+                self.recorder.count("background_errors")
+                self.background_error = repr(e)
+                flushed = relayed = 0
+            self.recorder.count("hot_state_flushed", flushed)
+            self.recorder.count("outbox_events_relayed", relayed)
+            if not (flushed or relayed):
+                await asyncio.sleep(min(settings.HOT_STATE_FLUSH_INTERVAL, settings.OUTBOX_POLL_INTERVAL))
+
+    async def run(self):
+        options = self.options
+        rng = random.Random(options.seed)
+        self.deadline = time.monotonic() + options.duration
+        tasks = []
+        for count, scenario in (
+            (options.drivers, self.driver),
+            (options.updaters, self.updater),
+            (options.pollers, self.poller),
+            (options.subscribers, self.subscriber),
+            (options.logins, self.login_burst),
+        ):
+            for _ in range(count):
+                tasks.append(scenario(random.Random(rng.random())))
+        if not options.base_url:
+            tasks.append(self.background())
+        started = time.monotonic()
+        await asyncio.gather(*tasks)
+        return self.recorder.summary(time.monotonic() - started)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--base-url", help="load a running server instead of the in-process ASGI app")
+    parser.add_argument("--stand-ins", action="store_true", help="use mongomock/fakeredis (in-process only)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--deliveries", type=int, default=200, help="deliveries created for the run")
+    parser.add_argument("--drivers", type=int, default=20)
+    parser.add_argument("--ping-interval", type=float, default=1.0, help="seconds between pings per driver")
+    parser.add_argument("--updaters", type=int, default=2)
+    parser.add_argument("--status-interval", type=float, default=2.0)
+    parser.add_argument("--pollers", type=int, default=50)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--logins", type=int, default=1, help="concurrent login burst generators")
+    parser.add_argument("--login-burst-size", type=int, default=10)
+    parser.add_argument("--login-burst-interval", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep RATE_LIMITS on in-process, all simulated clients share one IP")
+    parser.add_argument("--output", help="write the JSON report to this file as well")
+    options = parser.parse_args(argv)
+    if options.stand_ins and options.base_url:
+        parser.error("--stand-ins only applies to the in-process transport")
+    return options
+
+
+def main():
+    options = parse_args()
+    if options.stand_ins:
+        install_stand_ins()
+    setup_django()
+    if not options.base_url:
+        from django.conf import settings
+        settings.RATE_LIMIT_ENABLED = options.rate_limits
+    if options.stand_ins:
+        from django.conf import settings
+        settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+    loadtest = LoadTest(options)
+    if not options.base_url:
+        from logistics_backend.asgi import application
+        loadtest.application = application
+    cleanup = loadtest.prepare()
+    try:
+        report = asyncio.run(loadtest.run())
+    finally:
+        cleanup()
+    report["config"] = {key: value for key, value in vars(options).items() if key != "output"}
+    if loadtest.background_error:
+        report["background_error"] = loadtest.background_error
+    output = json.dumps(report, indent=2)
+    print(output)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    if loadtest.background_error:
+        # Without the flusher and the relay the run measured a different system
+        sys.exit(f"Hot state flush or outbox relay failed during the run: {loadtest.background_error}")
+
+
+if __name__ == "__main__":
+    main()
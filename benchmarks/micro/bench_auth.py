@@ -0,0 +1,79 @@
+"""Auth checks that run on every authenticated request"""
+import jwt
+import pytest
+from django.conf import settings
+from rest_framework.test import APIRequestFactory
+from users.mongo.user import User
+from users.views import login
+from users.utils.auth_utils import extract_user_from_request
+from users.utils.jwt_utils import decode_token, build_payload, issue_token
+from users.utils.redis_auth import redis_token_manager
+from users.utils.revocation import revoked_tokens
+
+
+def test_extract_user_from_request(benchmark, authorized_request, bench_admin):
+    user = benchmark(extract_user_from_request, authorized_request)
+    assert user.id == bench_admin.id
+
+
+def test_validate_token(benchmark, bench_token):
+    assert benchmark(redis_token_manager.validate_token, bench_token)
+
+
+def test_validate_token_unknown(benchmark):
+    assert not benchmark(redis_token_manager.validate_token, "not-a-token")
+
+
+def test_decode_token(benchmark, bench_token, bench_admin):
+    payload = benchmark(decode_token, bench_token)
+    assert payload["user_id"] == str(bench_admin.id)
+
+
+@pytest.fixture
+def stateless(settings):
+    settings.AUTH_TOKEN_MODE = "stateless"
+    revoked_tokens.reset()
+    revoked_tokens.redis_client = redis_token_manager.redis_client
+    yield
+    revoked_tokens.reset()
+
+
+# fakeredis answers in-process, against a real Redis the redis mode also pays
+# two network round-trips per request that the stateless mode does not
+def test_decode_token_stateless(benchmark, stateless, bench_token, bench_admin):
+    payload = benchmark(decode_token, bench_token)
+    assert payload["user_id"] == str(bench_admin.id)
+
+
+def test_extract_user_from_request_stateless(benchmark, stateless, authorized_request, bench_admin):
+    user = benchmark(extract_user_from_request, authorized_request)
+    assert user.id == bench_admin.id
+
+
+def issue_token_before(user_id):
+    # The login path before issue_token: load the user again, encode, decode again to store
+    user = User.objects(id=user_id).first()
+    token = jwt.encode(build_payload(user.id), settings.JWT_SECRET_KEY, algorithm="HS256")
+    redis_token_manager.store_token(token, str(user.id))
+    return token
+
+
+def test_issue_token_before(benchmark, bench_admin):
+    assert benchmark(issue_token_before, str(bench_admin.id))
+
+
+def test_issue_token(benchmark, bench_admin):
+    assert benchmark(issue_token, bench_admin)
+
+
+def test_login_view(benchmark, bench_admin, monkeypatch):
+    # bcrypt is left out, it costs the same before and after
+    monkeypatch.setattr("users.views.check_password", lambda password, password_hash: True)
+    factory = APIRequestFactory()
+
+    def login_request():
+        request = factory.post("/api/v1/users/login/", {"username": "bench_admin", "password": "bench"}, format="json")
+        return login(request)
+
+    response = benchmark(login_request)
+    assert response.status_code == 200
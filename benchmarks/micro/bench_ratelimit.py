@@ -0,0 +1,57 @@
+"""Rate limit checks that run before every limited request"""
+import uuid
+import pytest
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.urls import resolve
+from logistics_backend.middleware import RateLimitMiddleware
+from logistics_backend.ratelimit import Policy, RateLimiter, client_key
+
+
+@pytest.fixture
+def limiter():
+    fakeredis = pytest.importorskip("fakeredis")
+    limiter = RateLimiter()
+    limiter.redis_client = fakeredis.FakeRedis()
+    return limiter
+
+
+@pytest.fixture
+def generous_policy():
+    # Never runs out, so every round measures the allowed path
+    return Policy(f"bench-{uuid.uuid4()}", "100000000/s")
+
+
+def test_check_local(benchmark, limiter, generous_policy):
+    decision = benchmark(limiter.check, generous_policy, "ip:203.0.113.1")
+    assert decision.allowed
+
+
+def test_check_denied_locally(benchmark, limiter):
+    policy = Policy(f"bench-{uuid.uuid4()}", "1/h")
+    limiter.check(policy, "ip:203.0.113.1")
+    decision = benchmark(limiter.check, policy, "ip:203.0.113.1")
+    assert not decision.allowed
+
+
+def test_client_key(benchmark):
+    request = RequestFactory().get("/", REMOTE_ADDR="203.0.113.1")
+    assert benchmark(client_key, request, "api_key") == "ip:203.0.113.1"
+
+
+def test_middleware_overhead(benchmark, settings, limiter, monkeypatch):
+    settings.RATE_LIMIT_ENABLED = True
+    settings.RATE_LIMITS = {"delivery_detail": {"rate": "100000000/s", "key": "ip"}}
+    monkeypatch.setattr("logistics_backend.middleware.rate_limiter", limiter)
+    middleware = RateLimitMiddleware(lambda request: HttpResponse())
+    path = "/api/v1/deliveries/BENCH0001/"
+    request = RequestFactory().get(path, REMOTE_ADDR="203.0.113.1")
+    request.resolver_match = match = resolve(path)
+    response = HttpResponse()
+
+    def limited_request():
+        middleware.process_view(request, match.func, match.args, match.kwargs)
+        return middleware.process_response(request, response)
+
+    response = benchmark(limited_request)
+    assert response["RateLimit-Limit"] == "100000000"
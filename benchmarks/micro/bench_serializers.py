@@ -0,0 +1,60 @@
+"""Delivery serialization for REST responses and WebSocket broadcasts"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+from deliveries.consumers import DeliveryConsumer
+from deliveries.mongo.delivery import Delivery, StatusHistory
+
+
+def build_delivery(history_length):
+    now = datetime(2025, 1, 1, 12, 0, tzinfo=timezone.utc)
+    location = {"type": "Point", "coordinates": [-73.9855, 40.7580]}
+    return Delivery(
+        delivery_id="BENCH001",
+        title="Benchmark Delivery",
+        status="in transit",
+        customer_id="customer_1",
+        recipient_name="Recipient",
+        current_location=location,
+        destination="1 Broadway, New York, NY 10001",
+        created_at=now,
+        last_updated=now,
+        status_history=[
+            StatusHistory(status="in transit", location=location, timestamp=now - timedelta(seconds=i))
+            for i in range(history_length)
+        ]
+    )
+
+
+@pytest.mark.parametrize("history_length", [1, 100, 10000])
+def test_delivery_to_dict(benchmark, history_length):
+    delivery = build_delivery(history_length)
+    result = benchmark(delivery.to_dict)
+    assert len(result["status_history"]) == history_length
+
+
+@pytest.mark.parametrize("use_msgpack", [False, True], ids=["json", "msgpack"])
+def test_consumer_delivery_update(benchmark, use_msgpack):
+    sent = []
+
+    async def send(text_data=None, bytes_data=None):
+        sent.append(text_data or bytes_data)
+
+    consumer = DeliveryConsumer()
+    consumer.use_msgpack = use_msgpack
+    consumer.send = send
+    event = {
+        "type": "delivery_update",
+        "update_type": "location",
+        "delivery": "BENCH001",
+        "location": {"type": "Point", "coordinates": [-73.9855, 40.7580]},
+        "status": "in transit",
+        "timestamp": "2025-01-01T12:00:00+00:00"
+    }
+
+    loop = asyncio.new_event_loop()
+    try:
+        benchmark(lambda: loop.run_until_complete(consumer.delivery_update(event)))
+    finally:
+        loop.close()
+    assert sent
@@ -0,0 +1,18 @@
+"""Input validation on the location and status update endpoints"""
+import pytest
+from deliveries.utils.validators import validate_lat_lon_input
+
+VALID_LOCATION = {"type": "Point", "coordinates": [-73.9855, 40.7580]}
+INVALID_LOCATION = {"type": "Point", "coordinates": [-73.9855, 400]}
+
+
+def test_validate_lat_lon_input(benchmark):
+    assert benchmark(validate_lat_lon_input, VALID_LOCATION)["coordinates"] == [-73.9855, 40.758]
+
+
+def test_validate_lat_lon_input_invalid(benchmark):
+    def validate():
+        with pytest.raises(ValueError):
+            validate_lat_lon_input(INVALID_LOCATION)
+
+    benchmark(validate)
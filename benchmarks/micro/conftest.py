@@ -0,0 +1,68 @@
+"""
+Fixtures for the micro-benchmarks.
+
+The benchmarks run against mongomock and fakeredis so they need no services and
+measure our code rather than the network. Both are imported inside the fixtures
+so collecting the regular test suite never requires them.
+"""
+import pytest
+import bcrypt
+import mongoengine
+from django.conf import settings
+from django.test import RequestFactory
+from deliveries.mongo.delivery import Delivery
+from users.mongo.user import User
+from users.utils.redis_auth import redis_token_manager
+
+DOCUMENTS = (Delivery, User)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def stand_ins():
+    """Point mongoengine and the token manager at mongomock/fakeredis"""
+    mongomock = pytest.importorskip("mongomock")
+    fakeredis = pytest.importorskip("fakeredis")
+
+    alias = settings.MONGODB_SETTINGS.get("alias", "default")
+    redis_client = redis_token_manager.redis_client
+
+    mongoengine.disconnect(alias)
+    mongoengine.connect(
+        db=settings.MONGODB_SETTINGS["db"],
+        host="mongodb://localhost",
+        alias=alias,
+        mongo_client_class=mongomock.MongoClient
+    )
+    redis_token_manager.redis_client = fakeredis.FakeRedis()
+    for document in DOCUMENTS:
+        document._collection = None
+    yield
+
+    mongoengine.disconnect(alias)
+    redis_token_manager.redis_client = redis_client
+    for document in DOCUMENTS:
+        document._collection = None
+
+
+@pytest.fixture(scope="session")
+def bench_admin(stand_ins):
+    User.objects(username="bench_admin").delete()
+    admin = User(
+        username="bench_admin",
+        email="bench_admin@example.com",
+        password_hash=bcrypt.hashpw(b"bench", bcrypt.gensalt(rounds=4)).decode(),
+        is_admin=True
+    )
+    admin.save()
+    return admin
+
+
+@pytest.fixture(scope="session")
+def bench_token(bench_admin):
+    from users.utils.jwt_utils import generate_token
+    return generate_token(str(bench_admin.id))
+
+
+@pytest.fixture
+def authorized_request(bench_token):
+    return RequestFactory().get("/api/v1/deliveries/", HTTP_AUTHORIZATION=f"Bearer {bench_token}")
@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def rate_limits_off(settings):
+    """Every test client comes from the same IP, tests of the rate limits turn them back on"""
+    settings.RATE_LIMIT_ENABLED = False
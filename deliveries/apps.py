@@ -1,6 +1,4 @@
 from django.apps import AppConfig
-from mongoengine import connect
-from django.conf import settings
 
 
 class DeliveriesConfig(AppConfig):
@@ -8,8 +6,10 @@ class DeliveriesConfig(AppConfig):
     name = "deliveries"
     
     def ready(self):
-        connect(
-            db=settings.MONGODB_SETTINGS["db"],
-            host=settings.MONGODB_SETTINGS["host"],
-            alias=settings.MONGODB_SETTINGS.get("alias", "default")
-        )
+        from logistics_backend.mongo import register_connections
+        from logistics_backend import prefork
+
+        # Registers only, the client connects on first use
+        register_connections()
+        # Forked workers drop inherited clients and connect on their own
+        prefork.install()
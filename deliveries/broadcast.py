@@ -0,0 +1,146 @@
+"""
+Conflation and delta encoding of the events a relay broadcasts.
+
+A device pinging faster than anyone watches would make every ping a
+delivery_update for every subscriber. BroadcastScheduler sends status
+changes and other events at once, but at most one location update per
+delivery every settings.BROADCAST_LOCATION_INTERVAL seconds: updates coming
+sooner are held back, each replacing the one before, and the latest goes
+out when the interval is over. A status change drops the location update
+held back for its delivery, its own snapshot being newer.
+
+Location updates are sent as deltas: their delivery snapshot only has the
+id and the fields that changed since the last event sent for the delivery,
+"delta" is true, and the status and location the snapshot already has are
+left out. Status changes and other events carry the full snapshot, and so
+does a location update once settings.BROADCAST_DELTA_WINDOW seconds have
+passed since the last full one, however often the delivery pings. Clients
+merge deltas into the snapshot they have; the WebSocket and SSE streams of a
+delivery start with a full one. A delta keeps its full message under "full",
+for the customer and fleet groups whose streams start with no snapshot
+(deliveries.events.publish).
+
+A relay that stops without flush() loses the location updates it holds
+back, for at most one interval; the delivery itself is up to date.
+"""
+import time
+from django.conf import settings
+from monitoring.metrics import BROADCAST_EVENTS
+
+
+class BroadcastScheduler:
+    """
+    Decides which events of a relay are sent, when, and in what form.
+    The scheduler belongs to one relay and is not thread safe.
+    Args:
+        interval: Minimum seconds between location updates of a delivery,
+            settings.BROADCAST_LOCATION_INTERVAL by default, 0 to send all.
+        delta_window: Seconds after which a delivery gets a full snapshot again,
+            settings.BROADCAST_DELTA_WINDOW by default.
+        clock: Monotonic clock, for tests.
+    """
+
+    def __init__(self, interval=None, delta_window=None, clock=time.monotonic):
+        self.interval = settings.BROADCAST_LOCATION_INTERVAL if interval is None else interval
+        self.delta_window = settings.BROADCAST_DELTA_WINDOW if delta_window is None else delta_window
+        self.clock = clock
+        # delivery_id -> (time sent, full snapshot sent, time a full message was last sent)
+        self.last_sent = {}
+        # delivery_id -> (delivery, message) held back
+        self.held = {}
+
+    def submit(self, delivery, message):
+        """
+        Schedule the event of a delivery.
+        Args:
+            delivery: The delivery the event is about.
+            message: The delivery_update channel message, with a full snapshot.
+        Returns:
+            list: The (delivery, message) pairs to publish now, in order.
+        """
+        delivery_id = delivery.get("delivery_id")
+        now = self.clock()
+        if message["update_type"] == "location":
+            last = self.last_sent.get(delivery_id)
+            if last is not None and now - last[0] < self.interval:
+                if delivery_id in self.held:
+                    BROADCAST_EVENTS.inc(outcome="conflated")
+                self.held[delivery_id] = (delivery, message)
+                return []
+        elif self.held.pop(delivery_id, None) is not None:
+            BROADCAST_EVENTS.inc(outcome="conflated")
+        return [self._prepare(delivery, message, now)]
+
+    def due(self):
+        """
+        Take the held back location updates whose interval is over.
+        Returns:
+            list: The (delivery, message) pairs to publish.
+        """
+        now = self.clock()
+        ready = [delivery_id for delivery_id in self.held if now - self._sent_at(delivery_id) >= self.interval]
+        return [self._prepare(*self.held.pop(delivery_id), now) for delivery_id in ready]
+
+    def flush(self):
+        """
+        Take every held back location update, e.g. before the relay stops.
+        Returns:
+            list: The (delivery, message) pairs to publish.
+        """
+        now = self.clock()
+        held, self.held = self.held, {}
+        return [self._prepare(delivery, message, now) for delivery, message in held.values()]
+
+    def next_due(self):
+        """
+        Returns:
+            float: Seconds until a held back update is due, None if none is held.
+        """
+        if not self.held:
+            return None
+        now = self.clock()
+        return max(0.0, min(self._sent_at(delivery_id) + self.interval - now for delivery_id in self.held))
+
+    def failed(self, delivery):
+        """
+        Forget what was sent for a delivery after its message could not be
+        published, so the next one carries the full snapshot.
+        """
+        self.last_sent.pop(delivery.get("delivery_id"), None)
+
+    def sweep(self):
+        """
+        Drop the state of deliveries with no event for longer than the delta window.
+        """
+        horizon = self.clock() - max(self.delta_window, self.interval)
+        for delivery_id in [key for key, (sent_at, _, _) in self.last_sent.items() if sent_at < horizon]:
+            if delivery_id not in self.held:
+                del self.last_sent[delivery_id]
+
+    def _sent_at(self, delivery_id):
+        last = self.last_sent.get(delivery_id)
+        return last[0] if last is not None else float("-inf")
+
+    def _prepare(self, delivery, message, now):
+        delivery_id = delivery.get("delivery_id")
+        snapshot = message.get("delivery") or {}
+        last = self.last_sent.get(delivery_id)
+        full = message["update_type"] != "location" or last is None or now - last[2] >= self.delta_window
+        if message["update_type"] == "deleted" or \
+                message["update_type"] == "status" and snapshot.get("status") == "delivered":
+            # Nothing follows, the state is dropped
+            self.last_sent.pop(delivery_id, None)
+        else:
+            self.last_sent[delivery_id] = (now, snapshot, now if full else last[2])
+        if full:
+            BROADCAST_EVENTS.inc(outcome="full")
+            return delivery, message
+        sent = last[1]
+        changed = {key: value for key, value in snapshot.items() if key == "id" or sent.get(key) != value}
+        BROADCAST_EVENTS.inc(outcome="delta")
+        # status and location are in the merged snapshot
+        delta = {key: value for key, value in message.items() if key not in ("status", "location")}
+        delta["delivery"] = changed
+        delta["delta"] = True
+        delta["full"] = message
+        return delivery, delta
@@ -0,0 +1,303 @@
+"""
+Delivery events and cache invalidations from the Mongo change stream.
+
+The API publishes its own changes through the outbox (deliveries.outbox), but
+writes made elsewhere, by scripts, bulk jobs or the shell, reach no one that
+way. ChangeStreamRelay tails the deliveries collection instead: every change
+invalidates the caches of its delivery, and changes that came without an
+outbox event become delivery_update events for the delivery's groups. Changes
+are read in batches, bursts of location updates are coalesced into the last
+one and rate capped by deliveries.broadcast, and the resume token is saved after each batch so a restarted relay
+carries on where it stopped. Deliveries changed outside the API lose their
+hot state (deliveries.hot_state) and are read from Mongo until their next
+change. Change streams need a replica set.
+"""
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from pymongo.errors import OperationFailure
+from deliveries.mongo.delivery import Delivery
+from deliveries.broadcast import BroadcastScheduler
+from deliveries.events import publish, event_history
+from deliveries.hot_state import hot_state
+from deliveries.outbox import event_message
+from monitoring.metrics import CHANGE_STREAM_CHANGES, CHANGE_STREAM_EVENTS_PUBLISHED, CHANGE_STREAM_LAG
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ["insert", "update", "replace", "delete"]
+# Changes that can't be resumed from the saved token: the oplog moved past it
+HISTORY_LOST_CODES = (280, 286)
+# Seconds between saves of the resume token while no changes come in
+IDLE_CHECKPOINT_INTERVAL = 10
+
+PIPELINE = [
+    {"$match": {"operationType": {"$in": OPERATIONS}}},
+    # Events only need the snapshot fields
+    {"$project": {
+        "fullDocument.status_history": 0, "fullDocument.outbox": 0,
+        "fullDocumentBeforeChange.status_history": 0, "fullDocumentBeforeChange.outbox": 0,
+    }},
+]
+
+
+def change_event(change):
+    """
+    Turn a change into the delivery it concerns and the event to publish.
+    Args:
+        change: A change stream document.
+    Returns:
+        tuple: (delivery, event). delivery is the document after the change,
+            or before it for a delete, None if unknown or if the change only
+            removed published outbox events. event is None when the change
+            came with its own outbox event.
+    """
+    operation = change["operationType"]
+    if operation == "delete":
+        # Only there if the collection records pre-images
+        delivery = change.get("fullDocumentBeforeChange")
+        update_type = "deleted"
+    else:
+        delivery = change.get("fullDocument")
+        if operation == "insert":
+            update_type = "created"
+        elif operation == "replace":
+            update_type = "updated"
+        else:
+            description = change.get("updateDescription", {})
+            updated = description.get("updatedFields", {})
+            outbox_fields = [field for field in updated if field.split(".")[0] == "outbox"]
+            if outbox_fields:
+                # The relay removing published events changes nothing anyone sees
+                if len(outbox_fields) == len(updated) and not description.get("removedFields"):
+                    return None, None
+                return delivery, None
+            if "status" in updated:
+                update_type = "status"
+            elif "current_location" in updated:
+                update_type = "location"
+            else:
+                update_type = "updated"
+    if delivery is None:
+        return None, None
+    return delivery, {
+        # Derived from the change, so a replayed change keeps its event id
+        "event_id": hashlib.blake2b(change["_id"]["_data"].encode(), digest_size=16).hexdigest(),
+        "update_type": update_type,
+        "status": delivery.get("status") if update_type == "status" else None,
+        "location": delivery.get("current_location"),
+        "created_at": _change_time(change),
+    }
+
+
+def coalesce(changes):
+    """
+    Group the events of a batch of changes by delivery.
+    Location updates directly following each other are reduced to the last
+    one, and a delete replaces the events before it.
+    Args:
+        changes: Change stream documents, in order.
+    Returns:
+        tuple: (events, invalidated). events maps delivery_id to
+            (delivery, [event, ...]) in order, invalidated is the list of
+            every delivery_id changed.
+    """
+    events = {}
+    invalidated = {}
+    for change in changes:
+        CHANGE_STREAM_CHANGES.inc(operation=change["operationType"])
+        delivery, event = change_event(change)
+        if delivery is None:
+            continue
+        delivery_id = delivery.get("delivery_id")
+        invalidated[delivery_id] = None
+        if event is None:
+            continue
+        _, pending = events.get(delivery_id, (None, []))
+        if event["update_type"] == "deleted":
+            pending = []
+        elif event["update_type"] == "location" and pending and pending[-1]["update_type"] == "location":
+            pending.pop()
+        pending.append(event)
+        events[delivery_id] = (delivery, pending)
+    return events, list(invalidated)
+
+
+class ChangeStreamRelay:
+    """
+    Tails the deliveries collection and publishes its changes.
+    Args:
+        name: Name the resume token is saved under, one per relay.
+        collection: The collection to watch, the Delivery collection by default.
+        checkpoints: Collection for resume tokens, settings.CHANGE_STREAM_CHECKPOINTS
+            in the watched collection's database by default.
+        channel_layer: The channel layer, the default one if None.
+        batch_size: Changes per batch, settings.CHANGE_STREAM_BATCH_SIZE by default.
+        max_wait: Seconds to wait for a batch to fill, settings.CHANGE_STREAM_MAX_WAIT by default.
+        scheduler: The BroadcastScheduler conflating location updates, one
+            with the settings by default.
+    """
+
+    def __init__(self, name="deliveries", collection=None, checkpoints=None, channel_layer=None,
+                 batch_size=None, max_wait=None, scheduler=None):
+        self.name = name
+        self.collection = collection if collection is not None else Delivery._get_collection()
+        self.checkpoints = checkpoints if checkpoints is not None else \
+            self.collection.database[settings.CHANGE_STREAM_CHECKPOINTS]
+        self.channel_layer = channel_layer
+        self.batch_size = batch_size or settings.CHANGE_STREAM_BATCH_SIZE
+        self.max_wait = max_wait or settings.CHANGE_STREAM_MAX_WAIT
+        self.scheduler = scheduler or BroadcastScheduler()
+        self._redis_client = None
+
+    @property
+    def redis_client(self):
+        if self._redis_client is None:
+            from monitoring.redis_client import create_client
+
+            self._redis_client = create_client()
+        return self._redis_client
+
+    def load_token(self):
+        checkpoint = self.checkpoints.find_one({"_id": self.name})
+        return checkpoint["resume_token"] if checkpoint else None
+
+    def save_token(self, token):
+        self.checkpoints.update_one(
+            {"_id": self.name},
+            {"$set": {"resume_token": token, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    def watch(self, resume_token=None):
+        """
+        Open the change stream, after resume_token if given.
+        Returns:
+            ChangeStream: The stream.
+        """
+        options = {}
+        if settings.CHANGE_STREAM_PRE_IMAGES:
+            options["full_document_before_change"] = "whenAvailable"
+        return self.collection.watch(
+            PIPELINE,
+            full_document="updateLookup",
+            resume_after=resume_token,
+            max_await_time_ms=max(1, int(self.max_wait * 1000)),
+            **options
+        )
+
+    def read_batch(self, stream):
+        """
+        Read changes until the batch is full or max_wait has passed.
+        Returns:
+            list: The changes, empty if none came in.
+        """
+        changes = []
+        deadline = time.monotonic() + self.max_wait
+        while len(changes) < self.batch_size and stream.alive:
+            change = stream.try_next()
+            if change is not None:
+                changes.append(change)
+            if time.monotonic() >= deadline:
+                break
+        return changes
+
+    def handle(self, changes):
+        """
+        Publish the events and invalidations of a batch of changes, and the
+        held back location updates that are due.
+        Args:
+            changes: Change stream documents, in order.
+        Returns:
+            int: Number of events published.
+        Raises:
+            Exception: If an event could not be published, the batch is to be read again.
+        """
+        events, invalidated = coalesce(changes)
+        if invalidated:
+            self.redis_client.publish(settings.DELIVERY_INVALIDATION_CHANNEL, json.dumps(invalidated))
+        if events:
+            # Changes without an outbox event were made outside the API, the hot state missed them
+            hot_state.discard(list(events))
+        due = self.scheduler.due()
+        if not events and not due:
+            return 0
+        published = async_to_sync(self._publish)(events, due)
+        event_history.record(published)
+        return len(published)
+
+    def run(self, stop=None):
+        """
+        Relay changes until stop is set. A publish that fails reopens the
+        stream from the last saved token, so no change is lost.
+        Args:
+            stop: A threading.Event that ends the loop.
+        """
+        while stop is None or not stop.is_set():
+            token = self.load_token()
+            try:
+                with self.watch(token) as stream:
+                    saved_at = swept_at = time.monotonic()
+                    while stop is None or not stop.is_set():
+                        changes = self.read_batch(stream)
+                        # Also sends the held back location updates that are due
+                        self.handle(changes)
+                        if changes or time.monotonic() - saved_at > IDLE_CHECKPOINT_INTERVAL:
+                            self.save_token(stream.resume_token)
+                            saved_at = time.monotonic()
+                        if time.monotonic() - swept_at > self.scheduler.delta_window:
+                            self.scheduler.sweep()
+                            swept_at = time.monotonic()
+            except OperationFailure as e:
+                if e.code not in HISTORY_LOST_CODES:
+                    raise
+                logger.warning("Change stream %s can't resume, starting from now: %s", self.name, e)
+                self.checkpoints.delete_one({"_id": self.name})
+            except Exception as e:
+                logger.warning("Change stream relay %s failed, resuming: %s", self.name, e)
+                time.sleep(1)
+        held = self.scheduler.flush()
+        if held:
+            event_history.record(async_to_sync(self._publish)({}, held))
+
+    async def _publish(self, events, due):
+        channel_layer = self.channel_layer or get_channel_layer()
+        # Held back updates are older than the batch's, they go first
+        await asyncio.gather(*(self._send(channel_layer, delivery, message) for delivery, message in due))
+        results = await asyncio.gather(*(
+            self._publish_delivery(channel_layer, delivery, pending) for delivery, pending in events.values()
+        ))
+        return due + [sent for published in results for sent in published]
+
+    async def _publish_delivery(self, channel_layer, delivery, pending):
+        published = []
+        for event in pending:
+            for ready in self.scheduler.submit(delivery, event_message(delivery, event)):
+                await self._send(channel_layer, *ready)
+                published.append(ready)
+            CHANGE_STREAM_LAG.observe((datetime.now(timezone.utc) - event["created_at"]).total_seconds())
+        return published
+
+    async def _send(self, channel_layer, delivery, message):
+        try:
+            await publish(channel_layer, delivery, message)
+        except Exception:
+            self.scheduler.failed(delivery)
+            raise
+        CHANGE_STREAM_EVENTS_PUBLISHED.inc(update_type=message["update_type"])
+
+
+def _change_time(change):
+    # wallTime is there from MongoDB 6.0, clusterTime has second precision
+    wall_time = change.get("wallTime")
+    if wall_time is not None:
+        return wall_time if wall_time.tzinfo else wall_time.replace(tzinfo=timezone.utc)
+    if change.get("clusterTime") is not None:
+        return change["clusterTime"].as_datetime()
+    return datetime.now(timezone.utc)
@@ -1,62 +1,163 @@
 import json
+from collections import OrderedDict
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from deliveries.mongo.delivery import Delivery
+from deliveries.events import delivery_group, customer_group, fleet_group, event_payload
+from deliveries.mongo.delivery import VALID_STATUSES
+from deliveries.mongo.readers import get_delivery_reader
+from deliveries.hot_state import hot_state
+from deliveries.utils.serializers import msgpack_dumps, msgpack_loads
+from logistics_backend.mongo import primary_pinned, primary_reads
+from monitoring.metrics import WEBSOCKET_CONNECTIONS, group_joined, group_left
+from users.utils.auth_utils import extract_user_from_scope
 
-class DeliveryConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.delivery_id = self.scope['url_route']['kwargs']['delivery_id']
-        self.room_group_name = f'delivery_{self.delivery_id}'
+# WebSocket subprotocols, in order of preference
+MSGPACK_SUBPROTOCOL = 'msgpack'
+JSON_SUBPROTOCOL = 'json'
+# Event ids remembered per connection to drop events the outbox relay sends twice
+RECENT_EVENTS = 256
+
+
+class EventConsumer(AsyncWebsocketConsumer):
+    """
+    Base of the consumers that forward delivery_update events of groups.
+    Subclasses call join() from connect() with the groups to receive.
+    """
+    consumer_name = None
 
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        await self.accept()
+    async def join(self, groups):
+        """
+        Join groups and accept the connection.
+        Args:
+            groups: The group names.
+        """
+        self.groups_joined = []
+        self.recent_events = OrderedDict()
+
+        # Binary frames are used only when the client offers the msgpack subprotocol
+        subprotocols = self.scope.get('subprotocols') or []
+        self.use_msgpack = MSGPACK_SUBPROTOCOL in subprotocols
+        if self.use_msgpack:
+            subprotocol = MSGPACK_SUBPROTOCOL
+        elif JSON_SUBPROTOCOL in subprotocols:
+            subprotocol = JSON_SUBPROTOCOL
+        else:
+            subprotocol = None
+
+        for group in groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.groups_joined.append(group)
+        await self.accept(subprotocol=subprotocol)
+        WEBSOCKET_CONNECTIONS.inc(consumer=self.consumer_name)
+        for group in groups:
+            group_joined(group)
 
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        if not getattr(self, 'groups_joined', None):
+            return
+        WEBSOCKET_CONNECTIONS.dec(consumer=self.consumer_name)
+        for group in self.groups_joined:
+            group_left(group)
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def send_payload(self, payload):
+        """
+        Send a payload using the encoding negotiated on connect.
+        """
+        if self.use_msgpack:
+            await self.send(bytes_data=msgpack_dumps(payload))
+        else:
+            await self.send(text_data=json.dumps(payload))
+
+    # Receive message from a joined group
+    async def delivery_update(self, event):
+        event_id = event.get('event_id')
+        if event_id is not None:
+            if event_id in self.recent_events:
+                return
+            self.recent_events[event_id] = None
+            if len(self.recent_events) > RECENT_EVENTS:
+                self.recent_events.popitem(last=False)
+        # Send message to WebSocket
+        await self.send_payload(event_payload(event))
+
+    @database_sync_to_async
+    def authenticate(self):
+        return extract_user_from_scope(self.scope)
+
+
+class DeliveryConsumer(EventConsumer):
+    consumer_name = 'delivery'
+
+    async def connect(self):
+        self.delivery_id = self.scope['url_route']['kwargs']['delivery_id']
+        self.room_group_name = delivery_group(self.delivery_id)
+        # Admins that just wrote read their snapshot from the primary
+        self.primary_pinned = primary_pinned(self.scope.get('cookies') or {})
+        await self.join([self.room_group_name])
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message_type = text_data_json.get('type')
-        
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            if bytes_data is not None:
+                data = msgpack_loads(bytes_data)
+            else:
+                data = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+        message_type = data.get('type')
+
         if message_type == 'subscribe_delivery':
             delivery = await self.get_delivery_info(self.delivery_id)
             if delivery:
-                await self.send(text_data=json.dumps({
+                await self.send_payload({
                     'type': 'delivery_info',
                     'delivery': delivery
-                }))
-
-    # Receive message from room group
-    async def delivery_update(self, event):
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'delivery_update',
-            'update_type': event.get('update_type', 'status'),
-            'delivery': event.get('delivery'),
-            'location': event.get('location'),
-            'status': event.get('status'),
-            'timestamp': event.get('timestamp')
-        }))
+                })
 
     @database_sync_to_async
     def get_delivery_info(self, delivery_id):
-        delivery = Delivery.objects(delivery_id=delivery_id).first()
-        if delivery:
-            return {
-                'id': delivery.delivery_id,
-                'status': delivery.status,
-                'location': delivery.current_location,
-                'title': delivery.title,
-                'recipient_name': delivery.recipient_name,
-                'last_updated': delivery.last_updated.isoformat() if delivery.last_updated else None
-            }
-        return None 
\ No newline at end of file
+        snapshot = hot_state.snapshot(delivery_id)
+        if snapshot is not None:
+            return snapshot
+        with primary_reads(self.primary_pinned):
+            return get_delivery_reader(route='tracking').snapshot(delivery_id)
+
+
+class CustomerConsumer(EventConsumer):
+    """
+    Events of every delivery of a customer. Customers subscribe to their own
+    deliveries, admins to any customer's.
+    """
+    consumer_name = 'customer'
+
+    async def connect(self):
+        user = await self.authenticate()
+        customer_id = self.scope['url_route']['kwargs']['customer_id']
+        if user is None or (user.username != customer_id and not user.is_admin):
+            await self.close()
+            return
+        await self.join([customer_group(customer_id)])
+
+
+class FleetConsumer(EventConsumer):
+    """
+    Events of every delivery, for admins. The status query parameter, which
+    can be repeated, limits them to deliveries currently in those statuses.
+    """
+    consumer_name = 'fleet'
+
+    async def connect(self):
+        user = await self.authenticate()
+        if user is None or not user.is_admin:
+            await self.close()
+            return
+        statuses = parse_qs(self.scope.get('query_string', b'').decode('latin-1')).get('status') or []
+        if any(status not in VALID_STATUSES for status in statuses):
+            await self.close()
+            return
+        # One event reaches one status group, the groups can't overlap
+        await self.join([fleet_group(status) for status in dict.fromkeys(statuses)] or [fleet_group()])
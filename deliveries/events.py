@@ -0,0 +1,194 @@
+"""
+Channel layer groups delivery events are published to.
+
+Every event goes to the group of its delivery, of its customer, and of the
+fleet, once for all and once for the delivery's status. Subscribers join the
+groups they want, so one event is a fixed number of group sends however many
+deliveries or subscribers there are.
+
+Location deltas (deliveries.broadcast) only go to the delivery's group, whose
+subscribers start with a full snapshot. The other groups get the full message.
+
+The events of delivery and customer groups are also kept in short capped
+Redis streams (EventHistory), so SSE clients can resume after a reconnect.
+"""
+import json
+import asyncio
+import hashlib
+import logging
+from django.conf import settings
+from monitoring.metrics import CHANNEL_SEND_LATENCY
+
+logger = logging.getLogger(__name__)
+
+FLEET_GROUP = "fleet"
+HISTORY_KEY = "events:{group}"
+DELTA_KEYS = ("type", "event_id", "update_type", "delivery", "timestamp", "delta")
+
+
+def delivery_group(delivery_id):
+    return f"delivery_{delivery_id}"
+
+
+def customer_group(customer_id):
+    # Group names only allow a few characters, customer ids are usernames
+    return "customer_" + hashlib.blake2b(str(customer_id).encode(), digest_size=12).hexdigest()
+
+
+def fleet_group(status=None):
+    """
+    Args:
+        status: A delivery status, None for the group of every event.
+    Returns:
+        str: The fleet group for status.
+    """
+    if status is None:
+        return FLEET_GROUP
+    return f"{FLEET_GROUP}_{status.replace(' ', '-')}"
+
+
+def event_groups(delivery):
+    """
+    Get the groups an event of a delivery is published to.
+    Args:
+        delivery: The delivery, with delivery_id, customer_id and status.
+    Returns:
+        list: The group names.
+    """
+    groups = [delivery_group(delivery.get("delivery_id")), fleet_group()]
+    if delivery.get("customer_id"):
+        groups.append(customer_group(delivery["customer_id"]))
+    if delivery.get("status"):
+        groups.append(fleet_group(delivery["status"]))
+    return groups
+
+
+def group_message(message, group, delivery_id):
+    """
+    Get the message a group is sent: deltas for the delivery's own group, the
+    full message for the others.
+    Args:
+        message: The channel message, a delta may hold the full one under "full".
+        group: The group name.
+        delivery_id: The ID of the delivery the event is about.
+    Returns:
+        dict: The message.
+    """
+    if "full" not in message:
+        return message
+    if group != delivery_group(delivery_id):
+        return message["full"]
+    return {key: value for key, value in message.items() if key != "full"}
+
+
+async def publish(channel_layer, delivery, message):
+    """
+    Send an event to every group of its delivery, concurrently.
+    Args:
+        channel_layer: The channel layer.
+        delivery: The delivery the event is about.
+        message: The channel message.
+    Raises:
+        Exception: If a group send failed, the event is to be published again.
+    """
+    with CHANNEL_SEND_LATENCY.time(message_type=message["type"]):
+        results = await asyncio.gather(
+            *(channel_layer.group_send(group, group_message(message, group, delivery.get("delivery_id")))
+              for group in event_groups(delivery)),
+            return_exceptions=True
+        )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+def event_payload(message):
+    """
+    Build what subscribers receive for a delivery_update channel message.
+    Deltas (deliveries.broadcast) only have the keys they were sent with, and
+    their delivery only the id and the fields that changed.
+    Args:
+        message: The channel message.
+    Returns:
+        dict: The payload.
+    """
+    if message.get("delta"):
+        return {key: message[key] for key in DELTA_KEYS if key in message}
+    return {
+        "type": "delivery_update",
+        "event_id": message.get("event_id"),
+        "update_type": message.get("update_type", "status"),
+        "delivery": message.get("delivery"),
+        "location": message.get("location"),
+        "status": message.get("status"),
+        "timestamp": message.get("timestamp"),
+        "delta": message.get("delta", False)
+    }
+
+
+class EventHistory:
+    """
+    The last settings.SSE_HISTORY_LENGTH events of each delivery and customer
+    group, in Redis streams that expire settings.SSE_HISTORY_TTL seconds after
+    their last event.
+    """
+
+    def __init__(self):
+        self._redis_client = None
+
+    @property
+    def redis_client(self):
+        if self._redis_client is None:
+            from monitoring.redis_client import create_client
+
+            self._redis_client = create_client()
+        return self._redis_client
+
+    def reset(self):
+        self._redis_client = None
+
+    def record(self, published):
+        """
+        Add published events to the history of their groups. Failures are
+        logged, clients that can't resume get a new snapshot instead.
+        Args:
+            published: (delivery, message) pairs, in publish order.
+        """
+        if not published:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for delivery, message in published:
+            groups = [delivery_group(delivery.get("delivery_id"))]
+            if delivery.get("customer_id"):
+                groups.append(customer_group(delivery["customer_id"]))
+            for group in groups:
+                payload = event_payload(group_message(message, group, delivery.get("delivery_id")))
+                entry = {"id": message["event_id"], "payload": json.dumps(payload)}
+                key = HISTORY_KEY.format(group=group)
+                pipe.xadd(key, entry, maxlen=settings.SSE_HISTORY_LENGTH, approximate=True)
+                pipe.expire(key, settings.SSE_HISTORY_TTL)
+        try:
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Could not record the history of %d events: %s", len(published), e)
+
+    def since(self, group, event_id):
+        """
+        Get the events of a group published after event_id.
+        Args:
+            group: The group name.
+            event_id: The last event the client received.
+        Returns:
+            list: The payloads in order, or None if event_id is no longer in
+                the history.
+        """
+        entries = self.redis_client.xrevrange(HISTORY_KEY.format(group=group), count=settings.SSE_HISTORY_LENGTH * 2)
+        newer = []
+        for _, fields in entries:
+            if fields[b"id"].decode() == event_id:
+                return [json.loads(payload) for payload in reversed(newer)]
+            newer.append(fields[b"payload"])
+        return None
+
+
+event_history = EventHistory()
@@ -0,0 +1,521 @@
+"""
+Hot state of active deliveries, in Redis.
+
+The status, location and last update of a delivery in flight are written and
+read far more often than the rest of its document. HotStateStore keeps them,
+with the other snapshot fields, in a Redis hash per delivery: status and
+location changes update it in the request, and the detail view, the tracker
+and the WebSocket and SSE snapshots read it before Mongo.
+
+Each field has a durability in settings.HOT_STATE_DURABILITY, the most seconds
+a change to it may live in Redis only. A change to a field with 0 is written
+through to Mongo in the request, with its outbox event, as before. A change
+to fields that all allow a delay is written behind: queued in Redis with its
+event, and written to Mongo by HotStateFlusher (`python manage.py
+flush_hot_state`) in bulk writes, before the earliest deadline of its fields.
+Changes reach Mongo in order, a delivery's queue is flushed before a change is
+written through, and their events reach subscribers once flushed.
+
+A delivery's hash is made by its first write-through, which reads the snapshot
+fields back, and dropped once it is delivered, deleted or changed outside the
+API (deliveries.changes), or settings.HOT_STATE_TTL seconds after its last
+change. A delivery is flushed under a lock, by the flusher or by a request
+writing a change through, so its queued changes are written once and in
+order; changes arriving meanwhile are written through after it. While Redis
+fails, reads go to Mongo and changes are written straight to Mongo, ahead of
+any changes still queued, which are written when Redis is back. Changes
+written behind are lost if Redis loses them before the flush, only give a
+delay to fields that can take it.
+"""
+import time
+import uuid
+import logging
+from bson import json_util
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from redis.exceptions import RedisError
+from django.conf import settings
+from deliveries.mongo.delivery import Delivery
+from deliveries.mongo.readers import SNAPSHOT_FIELDS, build_snapshot
+from deliveries.outbox import push_events
+from monitoring.metrics import HOT_STATE_READS, HOT_STATE_WRITES, HOT_STATE_FLUSHED
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = "hot:delivery:{delivery_id}"
+QUEUE_KEY = "hot:queue:{delivery_id}"
+# Held while a delivery's queue is flushed
+LOCK_KEY = "hot:lock:{delivery_id}"
+# Deliveries with queued changes, scored by the time they are due in Mongo
+DIRTY_KEY = "hot:dirty"
+HOT_FIELDS = ("status", "current_location", "last_updated")
+STATE_FIELDS = SNAPSHOT_FIELDS + ("customer_id",)
+PROJECTION = {"_id": 0, **{field: 1 for field in STATE_FIELDS}}
+# Seconds a flush may hold a delivery's lock before another may take it
+FLUSH_LEASE = 30
+# Seconds a write-through waits for a flush of its delivery to finish
+LOCK_WAIT = 2
+
+# Update the hash and queue the change, unless the delivery isn't hot or is
+# being flushed: the write-through that follows waits for the flush, and its
+# hash, read back from Mongo, then has the change
+WRITE_BEHIND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('EXISTS', KEYS[4]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('RPUSH', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[3], 'LT', ARGV[2], ARGV[1])
+return 1
+"""
+
+# Lock the deliveries due that no one else is flushing
+CLAIM_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+local claimed = {}
+for _, delivery_id in ipairs(due) do
+    if redis.call('SET', ARGV[3] .. delivery_id, ARGV[4], 'NX', 'PX', ARGV[5]) then
+        table.insert(claimed, delivery_id)
+    end
+end
+return claimed
+"""
+
+# Remove the changes written, if they are still the head of the queue and the
+# lock is still ours, and reschedule the changes queued since
+SETTLE_SCRIPT = """
+if redis.call('GET', KEYS[4]) ~= ARGV[4] then
+    return 0
+end
+local count = tonumber(ARGV[1])
+if count > 0 then
+    if redis.call('LINDEX', KEYS[1], count - 1) ~= ARGV[5] then
+        if ARGV[7] == '1' then
+            redis.call('DEL', KEYS[4])
+        end
+        return -1
+    end
+    redis.call('LTRIM', KEYS[1], count, -1)
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    if ARGV[3] == '1' then
+        redis.call('DEL', KEYS[3])
+    end
+else
+    redis.call('ZADD', KEYS[2], ARGV[6], ARGV[2])
+end
+if ARGV[7] == '1' then
+    redis.call('DEL', KEYS[4])
+end
+return 1
+"""
+
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# A delivered delivery's hash goes, changes queued after it stay for the flusher
+RETIRE_SCRIPT = """
+redis.call('DEL', KEYS[1])
+if redis.call('LLEN', KEYS[2]) == 0 then
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+return 1
+"""
+
+
+class HotStateUnavailable(Exception):
+    """Raised when a change can't be written because the hot state failed"""
+
+
+def merge_changes(changes):
+    """
+    Build the Mongo update of a delivery's queued changes.
+    Args:
+        changes: The changes, in order.
+    Returns:
+        dict: The update, setting the last value of each field and pushing
+            every event and status history entry in order.
+    """
+    fields = {}
+    events = []
+    history = []
+    for change in changes:
+        fields.update(change["set"])
+        events.append(change["event"])
+        if change.get("history"):
+            history.append(change["history"])
+    update = {"$set": fields, "$push": {"outbox": push_events(events)}}
+    if history:
+        update["$push"]["status_history"] = {"$each": history}
+    return update
+
+
+class HotStateStore:
+    """
+    The Redis hashes of active deliveries and the queues of their changes
+    written behind.
+    """
+
+    def __init__(self):
+        self._redis_client = None
+        self._scripts = {}
+
+    @property
+    def redis_client(self):
+        if self._redis_client is None:
+            from monitoring.redis_client import create_client
+
+            self._redis_client = create_client()
+        return self._redis_client
+
+    def script(self, name, source):
+        """The script registered on the current client"""
+        client = self.redis_client
+        if name not in self._scripts:
+            self._scripts[name] = client.register_script(source)
+        return self._scripts[name]
+
+    def reset(self):
+        self._redis_client = None
+        self._scripts = {}
+
+    def durability(self, field):
+        """
+        Returns:
+            float: Seconds a change to field may live in Redis only, 0 to write it through.
+        """
+        return settings.HOT_STATE_DURABILITY.get(field, 0)
+
+    def update(self, delivery_id, event, fields, history=None):
+        """
+        Apply a status or location change to a delivery, with its outbox event.
+        Args:
+            delivery_id: The ID of the delivery.
+            event: The OutboxEvent describing the change.
+            fields: The hot fields changed, e.g. {"current_location": ..., "last_updated": ...}.
+            history: The StatusHistory entry to add, if any.
+        Returns:
+            bool: False if the delivery does not exist.
+        """
+        change = {
+            "set": fields,
+            "event": event.to_mongo().to_dict(),
+            "history": history.to_mongo().to_dict() if history is not None else None
+        }
+        if settings.HOT_STATE_ENABLED:
+            delay = min(self.durability(field) for field in fields)
+            if delay > 0 and self._write_behind(delivery_id, change, delay):
+                return True
+        return self._write_through(delivery_id, change)
+
+    def _write_behind(self, delivery_id, change, delay):
+        values = []
+        for field, value in change["set"].items():
+            values += [field, json_util.dumps(value)]
+        try:
+            queued = self.script("write_behind", WRITE_BEHIND_SCRIPT)(
+                keys=[STATE_KEY.format(delivery_id=delivery_id), QUEUE_KEY.format(delivery_id=delivery_id), DIRTY_KEY,
+                      LOCK_KEY.format(delivery_id=delivery_id)],
+                args=[delivery_id, time.time() + delay, settings.HOT_STATE_TTL, json_util.dumps(change), *values]
+            )
+        except Exception as e:
+            logger.warning("Writing the change of %s through, Redis failed: %s", delivery_id, e)
+            return False
+        if queued:
+            HOT_STATE_WRITES.inc(mode="behind")
+        return bool(queued)
+
+    def _write_through(self, delivery_id, change):
+        if not settings.HOT_STATE_ENABLED:
+            return self._write_mongo(delivery_id, change) is not None
+        try:
+            token = self._lock(delivery_id)
+        except RedisError as e:
+            # The hot state is a cache, writes go on without it
+            logger.warning("Writing the change of %s straight to Mongo, Redis failed: %s", delivery_id, e)
+            return self._write_mongo(delivery_id, change) is not None
+        try:
+            # Changes queued before this one go first, nothing is written if they can't
+            try:
+                flushed = self.flush([delivery_id], token, claimed=False)
+            except RedisError as e:
+                raise HotStateUnavailable(f"Hot state failed: {e}") from e
+            if delivery_id not in flushed:
+                raise HotStateUnavailable(f"Could not flush the queued changes of {delivery_id}")
+            son = self._write_mongo(delivery_id, change)
+            if son is not None:
+                self._store(son)
+        finally:
+            self._unlock(delivery_id, token)
+        return son is not None
+
+    def _write_mongo(self, delivery_id, change):
+        update = {"$set": change["set"], "$push": {"outbox": push_events([change["event"]])}}
+        if change["history"] is not None:
+            update["$push"]["status_history"] = change["history"]
+        son = Delivery._get_collection().find_one_and_update(
+            {"delivery_id": delivery_id}, update, projection=PROJECTION, return_document=ReturnDocument.AFTER
+        )
+        if son is not None:
+            HOT_STATE_WRITES.inc(mode="through")
+        return son
+
+    def _lock(self, delivery_id):
+        """
+        Take a delivery's lock, waiting up to LOCK_WAIT seconds for a flush to finish.
+        Returns:
+            str: The lock token.
+        Raises:
+            HotStateUnavailable: If the lock was not released in time.
+            RedisError: If Redis failed.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + LOCK_WAIT
+        while not self.redis_client.set(LOCK_KEY.format(delivery_id=delivery_id), token,
+                                        nx=True, px=FLUSH_LEASE * 1000):
+            if time.monotonic() > deadline:
+                raise HotStateUnavailable(f"{delivery_id} is being flushed")
+            time.sleep(0.01)
+        return token
+
+    def _unlock(self, delivery_id, token):
+        try:
+            self.script("unlock", UNLOCK_SCRIPT)(keys=[LOCK_KEY.format(delivery_id=delivery_id)], args=[token])
+        except Exception as e:
+            # It expires after FLUSH_LEASE
+            logger.warning("Could not release the hot state lock of %s: %s", delivery_id, e)
+
+    def _store(self, son):
+        delivery_id = son["delivery_id"]
+        try:
+            if son.get("status") == "delivered":
+                self.script("retire", RETIRE_SCRIPT)(
+                    keys=[STATE_KEY.format(delivery_id=delivery_id), QUEUE_KEY.format(delivery_id=delivery_id),
+                          DIRTY_KEY],
+                    args=[delivery_id]
+                )
+                return
+            key = STATE_KEY.format(delivery_id=delivery_id)
+            pipe = self.redis_client.pipeline()
+            pipe.hset(key, mapping={field: json_util.dumps(son.get(field)) for field in STATE_FIELDS})
+            pipe.expire(key, settings.HOT_STATE_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Could not store the hot state of %s: %s", delivery_id, e)
+
+    def evict(self, delivery_id):
+        """
+        Drop a deleted delivery's hash and queue.
+        Failures are logged, the hash expires after settings.HOT_STATE_TTL.
+        """
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.delete(STATE_KEY.format(delivery_id=delivery_id), QUEUE_KEY.format(delivery_id=delivery_id))
+            pipe.zrem(DIRTY_KEY, delivery_id)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Could not evict the hot state of %s: %s", delivery_id, e)
+
+    def discard(self, delivery_ids):
+        """
+        Drop the hashes of deliveries changed outside the API, so they are
+        read from Mongo until their next change. Their queued changes are kept.
+        Failures are logged, the hashes expire after settings.HOT_STATE_TTL.
+        """
+        try:
+            self.redis_client.delete(*(STATE_KEY.format(delivery_id=delivery_id) for delivery_id in delivery_ids))
+        except Exception as e:
+            logger.warning("Could not discard the hot state of %d deliveries: %s", len(delivery_ids), e)
+
+    def claim(self, batch_size, everything=False):
+        """
+        Lock the deliveries whose queued changes are due in Mongo. Deliveries
+        being flushed by someone else are left for a later claim.
+        Args:
+            batch_size: Most deliveries to look at.
+            everything: Take deliveries whose changes are not due yet too.
+        Returns:
+            tuple: (delivery ids, lock token).
+        """
+        token = uuid.uuid4().hex
+        due = self.script("claim", CLAIM_SCRIPT)(
+            keys=[DIRTY_KEY],
+            args=["+inf" if everything else time.time(), batch_size, LOCK_KEY.format(delivery_id=""), token,
+                  FLUSH_LEASE * 1000]
+        )
+        return [delivery_id.decode() for delivery_id in due], token
+
+    def flush(self, delivery_ids, token, claimed=True):
+        """
+        Write the queued changes of locked deliveries to Mongo in one bulk write.
+        Deliveries whose update fails keep their changes for the next flush.
+        Args:
+            delivery_ids: The deliveries to flush.
+            token: The token of their locks.
+            claimed: True if they were taken with claim(), their locks are
+                then released. Otherwise the caller keeps the lock, and
+                deliveries with nothing queued are left as they are.
+        Returns:
+            list: The deliveries flushed.
+        """
+        try:
+            return self._flush(delivery_ids, token, claimed)
+        except Exception:
+            if claimed:
+                for delivery_id in delivery_ids:
+                    self._unlock(delivery_id, token)
+            raise
+
+    def _flush(self, delivery_ids, token, claimed):
+        pipe = self.redis_client.pipeline(transaction=False)
+        for delivery_id in delivery_ids:
+            pipe.lrange(QUEUE_KEY.format(delivery_id=delivery_id), 0, -1)
+        raw_queues = pipe.execute()
+        queues = [[json_util.loads(change) for change in queue] for queue in raw_queues]
+        queued = [(delivery_id, changes) for delivery_id, changes in zip(delivery_ids, queues) if changes]
+        failed = set()
+        if queued:
+            requests = [UpdateOne({"delivery_id": delivery_id}, merge_changes(changes)) for delivery_id, changes in queued]
+            try:
+                Delivery._get_collection().bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", ())
+                logger.warning("Could not flush the changes of %d deliveries: %s", len(errors), errors[:1])
+                failed = {queued[error["index"]][0] for error in errors}
+
+        settle = self.script("settle", SETTLE_SCRIPT)
+        unlock = self.script("unlock", UNLOCK_SCRIPT)
+        pipe = self.redis_client.pipeline(transaction=False)
+        settling = []
+        flushed = []
+        for delivery_id, raw, changes in zip(delivery_ids, raw_queues, queues):
+            if delivery_id in failed:
+                # Kept queued, retried once the lock is released
+                if claimed:
+                    unlock(keys=[LOCK_KEY.format(delivery_id=delivery_id)], args=[token], client=pipe)
+                    settling.append(None)
+                continue
+            if not (changes or claimed):
+                flushed.append(delivery_id)
+                continue
+            statuses = [change["set"]["status"] for change in changes if "status" in change["set"]]
+            delivered = bool(statuses) and statuses[-1] == "delivered"
+            settle(keys=[QUEUE_KEY.format(delivery_id=delivery_id), DIRTY_KEY, STATE_KEY.format(delivery_id=delivery_id),
+                         LOCK_KEY.format(delivery_id=delivery_id)],
+                   args=[len(changes), delivery_id, int(delivered), token, raw[-1] if raw else b"", time.time(),
+                         int(claimed)],
+                   client=pipe)
+            settling.append((delivery_id, changes))
+        results = pipe.execute() if settling else []
+        for settled_delivery, settled in zip(settling, results):
+            if settled_delivery is None:
+                continue
+            delivery_id, changes = settled_delivery
+            if settled != 1:
+                # Written to Mongo but left queued, they will be written again
+                logger.warning("Could not settle the flushed changes of %s: %s", delivery_id,
+                               "lock lost" if settled == 0 else "queue changed")
+                continue
+            HOT_STATE_FLUSHED.inc(len(changes))
+            flushed.append(delivery_id)
+        return flushed
+
+    def snapshot(self, delivery_id):
+        """
+        Get the compact snapshot of a hot delivery.
+        Args:
+            delivery_id: The ID of the delivery.
+        Returns:
+            dict: The snapshot, or None if the delivery is not hot.
+        """
+        state = self._state(delivery_id, SNAPSHOT_FIELDS)
+        if state is None:
+            return None
+        return build_snapshot(*(state[field] for field in SNAPSHOT_FIELDS))
+
+    def overlay(self, delivery):
+        """
+        Put the hot fields of a delivery over the ones read from Mongo, which
+        lag behind by the changes not flushed yet.
+        Args:
+            delivery: The delivery in the public wire schema, or None.
+        Returns:
+            dict: The delivery.
+        """
+        if delivery:
+            state = self._state(delivery["delivery_id"], HOT_FIELDS)
+            if state is not None:
+                delivery.update(state)
+        return delivery
+
+    def _state(self, delivery_id, fields):
+        if not settings.HOT_STATE_ENABLED:
+            return None
+        try:
+            values = self.redis_client.hmget(STATE_KEY.format(delivery_id=delivery_id), fields)
+        except Exception as e:
+            logger.warning("Could not read the hot state of %s: %s", delivery_id, e)
+            HOT_STATE_READS.inc(outcome="error")
+            return None
+        if any(value is None for value in values):
+            HOT_STATE_READS.inc(outcome="miss")
+            return None
+        HOT_STATE_READS.inc(outcome="hit")
+        return {field: json_util.loads(value) for field, value in zip(fields, values)}
+
+
+hot_state = HotStateStore()
+
+
+class HotStateFlusher:
+    """
+    Writes the changes queued in the hot state to Mongo as they fall due.
+    Running more than one flusher is safe, each delivery is flushed under its
+    lock, and one that stops mid-batch leaves its deliveries to the others
+    after FLUSH_LEASE seconds.
+    Args:
+        store: The HotStateStore, the module's by default.
+        batch_size: Deliveries per bulk write, settings.HOT_STATE_FLUSH_BATCH_SIZE by default.
+    """
+
+    def __init__(self, store=None, batch_size=None):
+        self.store = store or hot_state
+        self.batch_size = batch_size or settings.HOT_STATE_FLUSH_BATCH_SIZE
+
+    def flush_once(self, everything=False):
+        """
+        Flush one batch of deliveries.
+        Args:
+            everything: Flush deliveries whose changes are not due yet too.
+        Returns:
+            int: Number of deliveries flushed.
+        """
+        delivery_ids, token = self.store.claim(self.batch_size, everything)
+        if not delivery_ids:
+            return 0
+        return len(self.store.flush(delivery_ids, token))
+
+    def run(self, interval=None, stop=None):
+        """
+        Flush until stop is set, polling every interval seconds while nothing
+        is due. Everything queued is flushed before returning.
+        Args:
+            interval: Seconds between polls, settings.HOT_STATE_FLUSH_INTERVAL by default.
+            stop: A threading.Event that ends the loop.
+        """
+        interval = interval or settings.HOT_STATE_FLUSH_INTERVAL
+        while stop is None or not stop.is_set():
+            try:
+                if self.flush_once():
+                    continue
+            except Exception as e:
+                logger.warning("Hot state flush failed: %s", e)
+            time.sleep(interval)
+        while self.flush_once(everything=True):
+            pass
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from deliveries.hot_state import HotStateFlusher
+
+
+class Command(BaseCommand):
+    help = "Write the delivery changes queued in the Redis hot state to Mongo"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Deliveries per bulk write")
+        parser.add_argument("--interval", type=float, default=None, help="Seconds between polls while nothing is due")
+        parser.add_argument("--once", action="store_true", help="Flush everything queued and exit")
+
+    def handle(self, *args, **options):
+        flusher = HotStateFlusher(batch_size=options["batch_size"])
+        if not options["once"]:
+            self.stdout.write("Flushing the hot state, press Ctrl+C to stop")
+            flusher.run(interval=options["interval"])
+            return
+
+        total = 0
+        while flushed := flusher.flush_once(everything=True):
+            total += flushed
+        self.stdout.write(f"Flushed {total} deliveries")
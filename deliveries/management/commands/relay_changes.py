@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from deliveries.changes import ChangeStreamRelay
+
+
+class Command(BaseCommand):
+    help = "Publish events and cache invalidations for delivery changes read from the Mongo change stream"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", default="deliveries", help="Name the resume token is saved under")
+        parser.add_argument("--batch-size", type=int, default=None, help="Changes per batch")
+        parser.add_argument("--max-wait", type=float, default=None, help="Seconds to wait for a batch to fill")
+        parser.add_argument("--from-now", action="store_true", help="Drop the saved resume token first")
+
+    def handle(self, *args, **options):
+        relay = ChangeStreamRelay(options["name"], batch_size=options["batch_size"], max_wait=options["max_wait"])
+        if options["from_now"]:
+            relay.checkpoints.delete_one({"_id": relay.name})
+        self.stdout.write(f"Relaying changes as {relay.name}, press Ctrl+C to stop")
+        relay.run()
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from deliveries.outbox import OutboxRelay
+
+
+class Command(BaseCommand):
+    help = "Publish the delivery events waiting in the outbox to the channel layer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="Deliveries per batch")
+        parser.add_argument("--interval", type=float, default=None, help="Seconds between polls while idle")
+        parser.add_argument("--once", action="store_true", help="Publish everything pending and exit")
+
+    def handle(self, *args, **options):
+        relay = OutboxRelay(batch_size=options["batch_size"])
+        if not options["once"]:
+            self.stdout.write("Relaying outbox events, press Ctrl+C to stop")
+            relay.run(interval=options["interval"])
+            return
+
+        total = 0
+        while published := relay.relay_once():
+            total += published
+        # Location updates held back for conflation only live in the relay
+        relay.flush()
+        self.stdout.write(f"Published {total} events")
@@ -18,6 +18,16 @@ class StatusHistory(EmbeddedDocument):
             "timestamp": self.timestamp.isoformat()
         }
 
+class OutboxEvent(EmbeddedDocument):
+    """
+    An event of a delivery waiting to be published, see deliveries.outbox.
+    """
+    event_id = StringField(required=True)
+    update_type = StringField(required=True, choices=['status', 'location'])
+    status = StringField()
+    location = DictField()
+    created_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
+
 class Delivery(Document):
     """
     Document to store delivery information.
@@ -32,10 +42,19 @@ class Delivery(Document):
     created_at = DateTimeField(default=lambda: datetime.now(timezone.utc))
     last_updated = DateTimeField(default=lambda: datetime.now(timezone.utc))
     status_history = ListField(EmbeddedDocumentField(StatusHistory), default=list)
+    # Events written with the change that caused them, removed once published
+    outbox = ListField(EmbeddedDocumentField(OutboxEvent), default=list)
 
     meta = {
         "collection": "deliveries",
-        "db_alias": "default"
+        "db_alias": "default",
+        "indexes": [
+            # Only deliveries with pending events are indexed, the relay scans these
+            {
+                "fields": ["outbox.created_at"],
+                "partialFilterExpression": {"outbox.created_at": {"$exists": True}}
+            }
+        ]
     }
 
     def to_dict(self):
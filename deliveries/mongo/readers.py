@@ -0,0 +1,152 @@
+from django.conf import settings
+from deliveries.mongo.delivery import Delivery
+from logistics_backend.mongo import read_preference
+from deliveries.utils.serializers import DELIVERY_FIELDS, delivery_from_son
+
+SNAPSHOT_FIELDS = ("delivery_id", "status", "current_location", "title", "recipient_name", "last_updated")
+
+
+def build_snapshot(delivery_id, status, location, title, recipient_name, last_updated):
+    """
+    Build the compact delivery snapshot sent to WebSocket subscribers.
+    Returns:
+        dict: The snapshot, with last_updated as an ISO string.
+    """
+    return {
+        "id": delivery_id,
+        "status": status,
+        "location": location,
+        "title": title,
+        "recipient_name": recipient_name,
+        "last_updated": last_updated.isoformat() if last_updated else None
+    }
+
+
+class DocumentDeliveryReader:
+    """
+    Reads deliveries through mongoengine Documents.
+    Kept as the reference implementation for the raw reader.
+    """
+
+    def __init__(self, read_preference=None):
+        self.read_preference = read_preference
+
+    def _objects(self, **filters):
+        queryset = Delivery.objects(**filters)
+        if self.read_preference is not None:
+            queryset = queryset.read_preference(self.read_preference)
+        return queryset
+
+    def get(self, delivery_id):
+        """
+        Get a delivery in the public wire schema.
+        Args:
+            delivery_id: The ID of the delivery.
+        Returns:
+            dict: The delivery, or None if it does not exist.
+        """
+        delivery = self._objects(delivery_id=delivery_id).first()
+        return delivery.to_dict() if delivery else None
+
+    def list(self, **filters):
+        """
+        List deliveries in the public wire schema.
+        Args:
+            **filters: Equality filters on delivery fields.
+        Returns:
+            list: The matching deliveries.
+        """
+        return list(self.iter(**filters))
+
+    def iter(self, **filters):
+        """
+        Iterate over deliveries in the public wire schema without buffering them.
+        Args:
+            **filters: Equality filters on delivery fields.
+        Yields:
+            dict: The matching deliveries.
+        """
+        for delivery in self._objects(**filters):
+            yield delivery.to_dict()
+
+    def snapshot(self, delivery_id):
+        """
+        Get the compact snapshot of a delivery.
+        Args:
+            delivery_id: The ID of the delivery.
+        Returns:
+            dict: The snapshot, or None if the delivery does not exist.
+        """
+        delivery = self._objects(delivery_id=delivery_id).first()
+        if not delivery:
+            return None
+        return build_snapshot(
+            delivery.delivery_id,
+            delivery.status,
+            delivery.current_location,
+            delivery.title,
+            delivery.recipient_name,
+            delivery.last_updated
+        )
+
+
+class RawDeliveryReader:
+    """
+    Reads deliveries with raw pymongo cursors and projections.
+    No Document is instantiated, rows are turned straight into plain dicts.
+    """
+
+    projection = {"_id": 0, **{field: 1 for field in DELIVERY_FIELDS}}
+    snapshot_projection = {"_id": 0, **{field: 1 for field in SNAPSHOT_FIELDS}}
+
+    def __init__(self, read_preference=None):
+        self.read_preference = read_preference
+
+    def _collection(self):
+        collection = Delivery._get_collection()
+        if self.read_preference is not None:
+            collection = collection.with_options(read_preference=self.read_preference)
+        return collection
+
+    def get(self, delivery_id):
+        son = self._collection().find_one({"delivery_id": delivery_id}, self.projection)
+        return delivery_from_son(son) if son else None
+
+    def list(self, **filters):
+        return list(self.iter(**filters))
+
+    def iter(self, **filters):
+        for son in self._collection().find(filters, self.projection):
+            yield delivery_from_son(son)
+
+    def snapshot(self, delivery_id):
+        son = self._collection().find_one({"delivery_id": delivery_id}, self.snapshot_projection)
+        if not son:
+            return None
+        return build_snapshot(
+            son.get("delivery_id"),
+            son.get("status"),
+            son.get("current_location"),
+            son.get("title"),
+            son.get("recipient_name"),
+            son.get("last_updated")
+        )
+
+
+READERS = {
+    "document": DocumentDeliveryReader,
+    "raw": RawDeliveryReader,
+}
+
+
+def get_delivery_reader(route=None):
+    """
+    Get the delivery reader selected by settings.DELIVERY_READ_PATH.
+    Args:
+        route: The read route, e.g. "tracking", that picks the read preference
+            from settings.MONGODB_READ_ROUTES. None reads from the primary.
+    Returns:
+        The reader instance, "raw" unless configured otherwise.
+    """
+    reader_class = READERS[getattr(settings, "DELIVERY_READ_PATH", "raw")]
+    return reader_class(read_preference(route) if route else None)
@@ -0,0 +1,221 @@
+"""
+Transactional outbox for delivery events.
+
+A status or location change pushes its event onto the delivery's outbox in the
+same update that makes the change, so the event is stored if and only if the
+change is, and the request never waits on the channel layer. OutboxRelay
+publishes the pending events in batches and removes them once published. An
+event is delivered at least once: consumers drop repeats by event_id.
+
+An outbox holds at most settings.OUTBOX_MAX_EVENTS events. While no relay runs
+the oldest are dropped, so a delivery pinging for hours doesn't grow its
+document toward Mongo's 16 MB limit; subscribers miss those events.
+"""
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timezone
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from deliveries.mongo.delivery import Delivery, OutboxEvent
+from deliveries.mongo.readers import SNAPSHOT_FIELDS, build_snapshot
+from deliveries.broadcast import BroadcastScheduler
+from deliveries.events import publish, event_history
+from monitoring.metrics import OUTBOX_EVENTS_PUBLISHED, OUTBOX_PUBLISH_FAILURES, OUTBOX_LAG
+
+logger = logging.getLogger(__name__)
+
+PROJECTION = {**{field: 1 for field in SNAPSHOT_FIELDS}, "customer_id": 1, "outbox": 1}
+
+
+def new_event(update_type, location, status=None, timestamp=None):
+    """
+    Build an outbox event, to be pushed with the update it describes.
+    Args:
+        update_type: "status" or "location".
+        location: The new location.
+        status: The new status, for status updates.
+        timestamp: When the change was made, now by default.
+    Returns:
+        OutboxEvent: The event, with a new event_id.
+    """
+    return OutboxEvent(
+        event_id=uuid.uuid4().hex,
+        update_type=update_type,
+        status=status,
+        location=location,
+        created_at=timestamp or datetime.now(timezone.utc)
+    )
+
+
+def push_events(events):
+    """
+    Build the $push of events onto a delivery's outbox.
+    Args:
+        events: The events, as documents, in order.
+    Returns:
+        dict: The $push modifier, keeping the last settings.OUTBOX_MAX_EVENTS events.
+    """
+    return {"$each": list(events), "$slice": -settings.OUTBOX_MAX_EVENTS}
+
+
+def event_message(son, event):
+    """
+    Build the delivery_update channel message of an outbox event.
+    Args:
+        son: The delivery, with the snapshot fields.
+        event: The event as stored in the outbox.
+    Returns:
+        dict: The message for the delivery's groups.
+    """
+    return {
+        "type": "delivery_update",
+        "event_id": event["event_id"],
+        "update_type": event["update_type"],
+        "delivery": build_snapshot(
+            son.get("delivery_id"),
+            son.get("status"),
+            son.get("current_location"),
+            son.get("title"),
+            son.get("recipient_name"),
+            son.get("last_updated")
+        ),
+        "status": event.get("status") or son.get("status"),
+        "location": event.get("location"),
+        "timestamp": _utc(event["created_at"]).isoformat()
+    }
+
+
+class OutboxRelay:
+    """
+    Publishes outbox events to the channel layer groups of their delivery
+    (deliveries.events), through a BroadcastScheduler that holds back and
+    conflates frequent location updates and sends them as deltas.
+    Deliveries are published concurrently, the events of one delivery in order.
+    A delivery whose publish fails keeps the failed event and the ones after
+    it for the next batch. Running more than one relay is safe but publishes
+    some events twice.
+    Args:
+        batch_size: Deliveries per batch, settings.OUTBOX_BATCH_SIZE by default.
+        channel_layer: The channel layer, the default one if None.
+        scheduler: The BroadcastScheduler, one with the settings by default.
+    """
+
+    def __init__(self, batch_size=None, channel_layer=None, scheduler=None):
+        self.batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+        self.channel_layer = channel_layer
+        self.scheduler = scheduler or BroadcastScheduler()
+
+    def relay_once(self):
+        """
+        Publish one batch of pending events, and the held back location
+        updates that are due.
+        Returns:
+            int: Number of events handled: published, conflated or held back.
+        """
+        collection = Delivery._get_collection()
+        sons = list(collection.find({"outbox.created_at": {"$exists": True}}, PROJECTION).limit(self.batch_size))
+        due = self.scheduler.due()
+        if not sons and not due:
+            return 0
+        published, handled = async_to_sync(self._publish)(sons, due)
+        event_history.record(published)
+
+        # Event ids are unique, one update removes the handled events of every delivery
+        delivery_ids = [son["_id"] for son, event_ids in zip(sons, handled) if event_ids]
+        event_ids = [event_id for ids in handled for event_id in ids]
+        if event_ids:
+            collection.update_many(
+                {"_id": {"$in": delivery_ids}}, {"$pull": {"outbox": {"event_id": {"$in": event_ids}}}}
+            )
+        return len(event_ids) + len(due)
+
+    def run(self, interval=None, stop=None):
+        """
+        Relay until stop is set, polling every interval seconds while idle.
+        Held back location updates are sent before returning.
+        Args:
+            interval: Seconds between polls, settings.OUTBOX_POLL_INTERVAL by default.
+            stop: A threading.Event that ends the loop.
+        """
+        interval = interval or settings.OUTBOX_POLL_INTERVAL
+        swept_at = time.monotonic()
+        while stop is None or not stop.is_set():
+            try:
+                if self.relay_once():
+                    continue
+            except Exception as e:
+                logger.warning("Outbox relay failed: %s", e)
+            if time.monotonic() - swept_at > self.scheduler.delta_window:
+                self.scheduler.sweep()
+                swept_at = time.monotonic()
+            due = self.scheduler.next_due()
+            time.sleep(interval if due is None else min(interval, due))
+        self.flush()
+
+    def flush(self):
+        """
+        Publish every held back location update, before the relay stops.
+        They were removed from the outbox when held back, only the relay has them.
+        Returns:
+            int: Number of updates published.
+        """
+        published = async_to_sync(self._publish_held)(self.scheduler.flush())
+        event_history.record(published)
+        return len(published)
+
+    async def _publish(self, sons, due):
+        channel_layer = self.channel_layer or get_channel_layer()
+        # Held back updates are older than the batch's, they go first
+        published = await self._publish_held(due, channel_layer)
+        results = await asyncio.gather(*(self._publish_delivery(channel_layer, son) for son in sons))
+        for messages, _ in results:
+            published += messages
+        return published, [event_ids for _, event_ids in results]
+
+    async def _publish_held(self, held, channel_layer=None):
+        channel_layer = channel_layer or self.channel_layer or get_channel_layer()
+        results = await asyncio.gather(
+            *(publish(channel_layer, delivery, message) for delivery, message in held), return_exceptions=True
+        )
+        published = []
+        for (delivery, message), result in zip(held, results):
+            if isinstance(result, BaseException):
+                # The next location update of the delivery goes out in full
+                logger.warning("Could not publish event %s of %s: %s",
+                               message["event_id"], delivery["delivery_id"], result)
+                OUTBOX_PUBLISH_FAILURES.inc()
+                self.scheduler.failed(delivery)
+                continue
+            published.append((delivery, message))
+            OUTBOX_EVENTS_PUBLISHED.inc(update_type=message["update_type"])
+        return published
+
+    async def _publish_delivery(self, channel_layer, son):
+        published = []
+        handled = []
+        for event in son.get("outbox") or []:
+            try:
+                for delivery, message in self.scheduler.submit(son, event_message(son, event)):
+                    try:
+                        await publish(channel_layer, delivery, message)
+                    except Exception:
+                        self.scheduler.failed(delivery)
+                        raise
+                    published.append((delivery, message))
+                    OUTBOX_EVENTS_PUBLISHED.inc(update_type=event["update_type"])
+            except Exception as e:
+                # Later events wait too, so subscribers never see them out of order
+                logger.warning("Could not publish event %s of %s: %s", event["event_id"], son["delivery_id"], e)
+                OUTBOX_PUBLISH_FAILURES.inc()
+                break
+            handled.append(event["event_id"])
+            OUTBOX_LAG.observe((datetime.now(timezone.utc) - _utc(event["created_at"])).total_seconds())
+        return published, handled
+
+
+def _utc(value):
+    # pymongo returns naive datetimes in UTC
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
@@ -0,0 +1,28 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+from deliveries.utils.serializers import loads, msgpack_loads
+
+
+class FastJSONParser(JSONParser):
+    """
+    JSON parser backed by the compiled decoder in deliveries.utils.serializers.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(f"JSON parse error - {exc}")
+
+
+class MessagePackParser(BaseParser):
+    """
+    Parser for application/msgpack request bodies.
+    """
+    media_type = "application/msgpack"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack_loads(stream.read())
+        except ValueError as exc:
+            raise ParseError(str(exc))
@@ -0,0 +1,48 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from deliveries.utils.serializers import dumps, msgpack_dumps, ndjson_lines
+from monitoring.timing import timed
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSON renderer backed by the compiled encoder in deliveries.utils.serializers.
+    Handles datetimes natively, so views can return raw Mongo documents.
+    """
+
+    @timed("render")
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return dumps(data)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renderer for application/msgpack responses.
+    """
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    @timed("render")
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack_dumps(data)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renderer for application/x-ndjson responses, one JSON document per line.
+    List views stream NDJSON themselves, this covers everything else.
+    """
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+
+    @timed("render")
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return b"".join(ndjson_lines(data if isinstance(data, list) else [data]))
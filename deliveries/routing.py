@@ -3,4 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/delivery/(?P<delivery_id>\w+)/$', consumers.DeliveryConsumer.as_asgi()),
+    re_path(r'ws/customer/(?P<customer_id>[\w.@+-]+)/$', consumers.CustomerConsumer.as_asgi()),
+    re_path(r'ws/fleet/$', consumers.FleetConsumer.as_asgi()),
 ] 
\ No newline at end of file
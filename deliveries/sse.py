@@ -0,0 +1,331 @@
+"""
+Server-Sent Events streams of delivery events.
+
+For integrations behind proxies that break WebSockets. A stream receives the
+same channel layer events as the WebSocket consumers, through the EventHub of
+its worker: a group followed by any number of local streams is joined once,
+and each event is encoded once and queued for every stream of its group. An
+idle stream is a small queue and a suspended generator, with no task, timer or
+channel layer channel of its own, so one worker can hold tens of thousands.
+
+Clients that reconnect with Last-Event-ID get the events they missed from the
+group's history (deliveries.events.EventHistory). When the history no longer
+goes back that far, delivery streams send a new snapshot and customer streams
+a reset event, after which the client reloads its deliveries.
+"""
+import json
+import asyncio
+import weakref
+import logging
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import AuthenticationFailed
+from deliveries.events import delivery_group, customer_group, event_payload, event_history
+from deliveries.mongo.readers import get_delivery_reader
+from deliveries.hot_state import hot_state
+from logistics_backend.middleware import compression_exempt
+from monitoring.metrics import SSE_STREAMS, SSE_RESUMES, group_joined, group_left
+from users.utils.auth_utils import extract_user_from_request, user_from_token
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT = b": heartbeat\n\n"
+# Event ids remembered per group to drop events the outbox relay sends twice
+RECENT_EVENTS = 256
+# Frames queued for a stream before it is closed as too slow. The client
+# reconnects and resumes from the history.
+STREAM_BACKLOG = 256
+
+
+def sse_frame(payload, event="delivery_update"):
+    """
+    Encode an SSE frame.
+    Args:
+        payload: The data, sent as JSON. Its event_id, if any, is the frame id.
+        event: The event name.
+    Returns:
+        bytes: The frame.
+    """
+    frame = f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+    if payload.get("event_id"):
+        frame = f"id: {payload['event_id']}\n" + frame
+    return frame.encode()
+
+
+class Stream:
+    """
+    What the hub keeps of one open SSE response: the frames not sent yet and,
+    while the response waits for more, a future. Lighter than an asyncio.Queue,
+    which matters with tens of thousands of streams.
+    """
+    __slots__ = ("pending", "waiter", "overflowed")
+
+    def __init__(self):
+        self.pending = []
+        self.waiter = None
+        self.overflowed = False
+
+    def put(self, event_id, frame):
+        if len(self.pending) >= STREAM_BACKLOG:
+            self.overflowed = True
+        else:
+            self.pending.append((event_id, frame))
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self):
+        """
+        Wait for frames.
+        Returns:
+            list: The (event_id, frame) pairs queued since the last call.
+        """
+        while not self.pending and not self.overflowed:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        pending, self.pending = self.pending, []
+        return pending
+
+
+class GroupSubscription:
+    __slots__ = ("streams", "channel", "task", "joined", "recent_events")
+
+    def __init__(self):
+        self.streams = set()
+        self.channel = None
+        self.task = None
+        self.joined = asyncio.Event()
+        self.recent_events = OrderedDict()
+
+
+class EventHub:
+    """
+    Fans the events of channel layer groups out to the streams of one event loop.
+    Args:
+        channel_layer: The channel layer.
+    """
+
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        self.groups = {}
+        self._heartbeat = None
+
+    async def subscribe(self, group, stream):
+        """
+        Add a stream to a group. Returns once the group is joined, so no event
+        published after that is missed.
+        Raises:
+            Exception: If the group could not be joined.
+        """
+        subscription = self.groups.get(group)
+        if subscription is not None:
+            subscription.streams.add(stream)
+            await subscription.joined.wait()
+            if self.groups.get(group) is not subscription:
+                raise ConnectionError(f"Could not join {group}")
+            return
+
+        subscription = self.groups[group] = GroupSubscription()
+        subscription.streams.add(stream)
+        try:
+            subscription.channel = await self.channel_layer.new_channel()
+            await self.channel_layer.group_add(group, subscription.channel)
+        except BaseException:
+            # Streams waiting on the join see it failed
+            del self.groups[group]
+            subscription.joined.set()
+            raise
+        group_joined(group)
+        subscription.task = asyncio.create_task(self._receive(group, subscription))
+        subscription.joined.set()
+        if self._heartbeat is None:
+            self._heartbeat = asyncio.create_task(self._beat())
+
+    async def unsubscribe(self, group, stream):
+        """
+        Remove a stream from a group, leaving the group after its last stream.
+        """
+        subscription = self.groups.get(group)
+        if subscription is None:
+            return
+        subscription.streams.discard(stream)
+        if subscription.streams or subscription.task is None:
+            return
+        del self.groups[group]
+        subscription.task.cancel()
+        group_left(group)
+        if not self.groups and self._heartbeat is not None:
+            self._heartbeat.cancel()
+            self._heartbeat = None
+        await self.channel_layer.group_discard(group, subscription.channel)
+
+    async def _receive(self, group, subscription):
+        recent_events = subscription.recent_events
+        while True:
+            try:
+                message = await self.channel_layer.receive(subscription.channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Could not receive the events of %s: %s", group, e)
+                await asyncio.sleep(1)
+                continue
+            if message.get("type") != "delivery_update":
+                continue
+            event_id = message.get("event_id")
+            if event_id is not None:
+                if event_id in recent_events:
+                    continue
+                recent_events[event_id] = None
+                if len(recent_events) > RECENT_EVENTS:
+                    recent_events.popitem(last=False)
+            frame = sse_frame(event_payload(message))
+            for stream in subscription.streams:
+                stream.put(event_id, frame)
+
+    async def _beat(self):
+        # One timer for every stream of the loop, not one per stream
+        while True:
+            await asyncio.sleep(settings.SSE_HEARTBEAT_SECONDS)
+            for subscription in list(self.groups.values()):
+                for stream in subscription.streams:
+                    stream.put(None, HEARTBEAT)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    """
+    Returns:
+        EventHub: The hub of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = EventHub(get_channel_layer())
+    return hub
+
+
+async def event_stream(kind, group, last_event_id, missed):
+    """
+    Generate the frames of an SSE stream.
+    Args:
+        kind: "delivery" or "customer", for metrics.
+        group: The channel layer group to follow.
+        last_event_id: The Last-Event-ID the client reconnected with, or None.
+        missed: Frame to send when the client has no Last-Event-ID or the
+            history no longer has it, or None.
+    Yields:
+        bytes: SSE frames and heartbeat comments.
+    """
+    hub = get_hub()
+    stream = Stream()
+    SSE_STREAMS.inc(stream=kind)
+    try:
+        await hub.subscribe(group, stream)
+        yield f"retry: {settings.SSE_RETRY_MS}\n\n".encode()
+        replayed = ()
+        history = None
+        if last_event_id:
+            try:
+                history = await sync_to_async(event_history.since, thread_sensitive=False)(group, last_event_id)
+                SSE_RESUMES.inc(outcome="resumed" if history is not None else "expired")
+            except Exception as e:
+                logger.warning("Could not read the history of %s: %s", group, e)
+                SSE_RESUMES.inc(outcome="unavailable")
+        if history is not None:
+            # Events published while the history was read are queued too
+            replayed = {payload["event_id"] for payload in history}
+            for payload in history:
+                yield sse_frame(payload)
+        elif missed is not None:
+            yield missed
+
+        while not stream.overflowed:
+            # A burst goes out in one write
+            frames = [frame for event_id, frame in await stream.get() if event_id not in replayed]
+            if frames:
+                yield b"".join(frames)
+    finally:
+        SSE_STREAMS.dec(stream=kind)
+        await hub.unsubscribe(group, stream)
+
+
+def sse_response(frames):
+    response = StreamingHttpResponse(frames, content_type="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Keeps nginx from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def last_event_id(request):
+    # EventSource sends the header on reconnect, the query parameter is for first connects
+    return request.headers.get("Last-Event-ID") or request.GET.get("last_event_id")
+
+
+def authenticate(request):
+    """
+    Get the user of a stream request. EventSource can't send headers, so the
+    token may come in the token query parameter instead.
+    Returns:
+        User: The user, or None.
+    """
+    if "token" in request.GET and not request.headers.get("Authorization"):
+        return user_from_token(request.GET["token"])
+    try:
+        return extract_user_from_request(request)
+    except AuthenticationFailed:
+        return None
+
+
+def get_snapshot(delivery_id):
+    return hot_state.snapshot(delivery_id) or get_delivery_reader(route="tracking").snapshot(delivery_id)
+
+
+@compression_exempt
+@require_GET
+async def delivery_events(request, delivery_id):
+    """
+    Stream the events of a delivery. The stream starts with a delivery_info
+    snapshot, like the WebSocket subscribe_delivery reply.
+    Args:
+        request: The HTTP request object.
+        delivery_id: The ID of the delivery.
+    Returns:
+        StreamingHttpResponse: The text/event-stream response, or a 404.
+    """
+    delivery = await sync_to_async(get_snapshot)(delivery_id)
+    if not delivery:
+        return JsonResponse({"error": "Delivery not found"}, status=404)
+    snapshot = sse_frame({"type": "delivery_info", "delivery": delivery}, event="delivery_info")
+    return sse_response(event_stream("delivery", delivery_group(delivery_id), last_event_id(request), snapshot))
+
+
+@compression_exempt
+@require_GET
+async def customer_events(request, customer_id):
+    """
+    Stream the events of every delivery of a customer. Customers may follow
+    their own deliveries, admins any customer's.
+    Args:
+        request: The HTTP request object.
+        customer_id: The customer.
+    Returns:
+        StreamingHttpResponse: The text/event-stream response, or a 401 or 403.
+    """
+    user = await sync_to_async(authenticate)(request)
+    if user is None:
+        return JsonResponse({"error": "Authentication required"}, status=401)
+    if user.username != customer_id and not user.is_admin:
+        return JsonResponse({"error": "Not allowed to follow this customer"}, status=403)
+    resume_id = last_event_id(request)
+    reset = sse_frame({"type": "reset"}, event="reset") if resume_id else None
+    return sse_response(event_stream("customer", customer_group(customer_id), resume_id, reset))
@@ -2,13 +2,36 @@ from django.test import TestCase
 import pytest
 from django.utils import timezone
 from .mongo.delivery import Delivery, StatusHistory, VALID_STATUSES
-from django.test import Client
+from django.test import Client, AsyncClient
 from rest_framework.test import APIClient
 from users.mongo.user import User
 from users.utils.jwt_utils import generate_token
 from users.utils.redis_auth import redis_token_manager
 import bcrypt
+import json
 from datetime import datetime, timezone
+from rest_framework.renderers import JSONRenderer
+from .renderers import FastJSONRenderer
+from .utils.serializers import DELIVERY_FIELDS, delivery_from_son
+from .mongo.readers import get_delivery_reader
+from .outbox import OutboxRelay
+from .broadcast import BroadcastScheduler
+from .events import event_groups, customer_group, event_history, publish
+from .changes import ChangeStreamRelay, coalesce
+from .hot_state import hot_state, HotStateFlusher
+from .routing import websocket_urlpatterns
+from .utils.serializers import msgpack_dumps, msgpack_loads
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from logistics_backend.middleware import negotiate_encoding
+from logistics_backend.mongo import pin_primary, primary_pinned, primary_reads
+from django.http import HttpResponse
+import gzip
+import asyncio
+import os
+import time
 
 # Create your tests here.
 
@@ -17,6 +40,9 @@ def cleanup_data():
     """Clean up users and deliveries before each test"""
     User.objects.delete()
     Delivery.objects.delete()
+    stale = hot_state.redis_client.keys("hot:*")
+    if stale:
+        hot_state.redis_client.delete(*stale)
     yield
 
 @pytest.fixture
@@ -89,6 +115,54 @@ def sample_delivery():
     yield delivery
     delivery.delete()
 
+@pytest.fixture(params=["document", "raw"])
+def read_path(request, settings):
+    """Run a test against both the mongoengine and the raw read path"""
+    settings.DELIVERY_READ_PATH = request.param
+    return request.param
+
+@pytest.fixture
+def many_deliveries():
+    """Create enough deliveries for list responses to cross the compression threshold"""
+    deliveries = []
+    for i in range(10):
+        delivery = Delivery(
+            delivery_id=f"BULK{i}",
+            title=f"Bulk Delivery {i}",
+            status="in transit",
+            customer_id="testuser",
+            recipient_name="John Doe",
+            current_location={
+                "type": "Point",
+                "coordinates": [-73.935242, 40.730610]
+            },
+            destination="123 Test St, New York, NY 10001"
+        )
+        delivery.save()
+        deliveries.append(delivery)
+    return deliveries
+
+def ws_exchange(path, frame, subprotocols=()):
+    """Connect to a WebSocket route, send one frame and return the accept message and the reply"""
+    async def run():
+        scope = {
+            "type": "websocket",
+            "path": path,
+            "headers": [],
+            "query_string": b"",
+            "subprotocols": list(subprotocols)
+        }
+        communicator = ApplicationCommunicator(URLRouter(websocket_urlpatterns), scope)
+        await communicator.send_input({"type": "websocket.connect"})
+        accepted = await communicator.receive_output(timeout=2)
+        await communicator.send_input({"type": "websocket.receive", **frame})
+        reply = await communicator.receive_output(timeout=2)
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(timeout=2)
+        return accepted, reply
+
+    return async_to_sync(run)()
+
 @pytest.fixture
 def sample_status_history():
     return StatusHistory(
@@ -395,3 +469,994 @@ def test_status_history_tracking(sample_delivery):
     updated = Delivery.objects(delivery_id=sample_delivery.delivery_id).first()
     assert len(updated.status_history) == initial_history_count + 1
     assert updated.status_history[-1].status == "in transit"
+
+def test_delivery_from_son_matches_to_dict(sample_delivery):
+    """Test the raw read path renders the same payload as to_dict()"""
+    stored = Delivery.objects(delivery_id=sample_delivery.delivery_id).first()
+    raw = Delivery.objects(delivery_id=sample_delivery.delivery_id).as_pymongo().first()
+    assert FastJSONRenderer().render(delivery_from_son(raw)) == JSONRenderer().render(stored.to_dict())
+
+def test_fast_json_renderer_datetimes():
+    """Test the fast renderer formats datetimes like isoformat()"""
+    now = datetime.now(timezone.utc)
+    rendered = FastJSONRenderer().render({"timestamp": now})
+    assert json.loads(rendered)["timestamp"] == now.isoformat()
+
+def test_list_deliveries_response_shape(read_path, api_client, admin_auth_headers, sample_delivery):
+    """Test the delivery list keeps the public wire schema"""
+    response = api_client.get("/api/v1/deliveries/", **admin_auth_headers)
+    assert response.status_code == 200
+    body = json.loads(response.content)
+    assert len(body) == 1
+    assert tuple(body[0].keys()) == DELIVERY_FIELDS
+    assert body[0]["status_history"][0]["status"] == "pending"
+
+def test_my_deliveries_response_shape(read_path, api_client, auth_headers, sample_delivery):
+    """Test the user's delivery list keeps the public wire schema"""
+    response = api_client.get("/api/v1/deliveries/my/", **auth_headers)
+    assert response.status_code == 200
+    body = json.loads(response.content)
+    assert len(body) == 1
+    assert tuple(body[0].keys()) == DELIVERY_FIELDS
+    assert body[0]["customer_id"] == "testuser"
+
+def test_delivery_detail_response_shape(read_path, api_client, sample_delivery):
+    """Test the delivery detail keeps the public wire schema"""
+    response = api_client.get(f"/api/v1/deliveries/{sample_delivery.delivery_id}/")
+    assert response.status_code == 200
+    body = json.loads(response.content)
+    assert tuple(body.keys()) == DELIVERY_FIELDS
+    assert body["current_location"]["coordinates"] == [-73.935242, 40.730610]
+
+def test_read_paths_render_identically(api_client, admin_auth_headers, sample_delivery, settings):
+    """Test both read paths produce byte-identical responses"""
+    settings.DELIVERY_READ_PATH = "document"
+    document_response = api_client.get("/api/v1/deliveries/", **admin_auth_headers)
+    settings.DELIVERY_READ_PATH = "raw"
+    raw_response = api_client.get("/api/v1/deliveries/", **admin_auth_headers)
+    assert document_response.content == raw_response.content
+
+def test_delivery_snapshot(read_path, sample_delivery):
+    """Test the WebSocket snapshot of a delivery"""
+    snapshot = get_delivery_reader().snapshot(sample_delivery.delivery_id)
+    assert snapshot["id"] == sample_delivery.delivery_id
+    assert snapshot["status"] == "pending"
+    assert snapshot["location"]["type"] == "Point"
+    assert isinstance(snapshot["last_updated"], str)
+    assert get_delivery_reader().snapshot("NONEXISTENT") is None
+
+def test_create_delivery_invalid_json(api_client, admin_auth_headers):
+    """Test the fast JSON parser rejects malformed bodies"""
+    response = api_client.post(
+        "/api/v1/deliveries/",
+        "{not json",
+        content_type="application/json",
+        **admin_auth_headers
+    )
+    assert response.status_code == 400
+
+def test_get_delivery_msgpack(api_client, sample_delivery):
+    """Test delivery details can be negotiated as MessagePack"""
+    response = api_client.get(
+        f"/api/v1/deliveries/{sample_delivery.delivery_id}/",
+        HTTP_ACCEPT="application/msgpack"
+    )
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/msgpack"
+    body = msgpack_loads(response.content)
+    assert body["delivery_id"] == sample_delivery.delivery_id
+    assert body == json.loads(FastJSONRenderer().render(response.data))
+
+def test_create_delivery_msgpack(api_client, admin_auth_headers):
+    """Test creating a delivery with a MessagePack body"""
+    data = {
+        "title": "Packed Delivery",
+        "status": "pending",
+        "customer_id": "testuser",
+        "recipient_name": "John Doe",
+        "current_location": {
+            "type": "Point",
+            "coordinates": [-73.935242, 40.730610]
+        },
+        "destination": "123 Test St, New York, NY 10001"
+    }
+    response = api_client.post(
+        "/api/v1/deliveries/",
+        msgpack_dumps(data),
+        content_type="application/msgpack",
+        HTTP_ACCEPT="application/msgpack",
+        **admin_auth_headers
+    )
+    assert response.status_code == 201
+    assert msgpack_loads(response.content)["title"] == "Packed Delivery"
+
+def test_consumer_msgpack_subprotocol(sample_delivery):
+    """Test the delivery consumer speaks binary frames when msgpack is negotiated"""
+    accepted, reply = ws_exchange(
+        f"/ws/delivery/{sample_delivery.delivery_id}/",
+        {"bytes": msgpack_dumps({"type": "subscribe_delivery"})},
+        subprotocols=["msgpack", "json"]
+    )
+    assert accepted["subprotocol"] == "msgpack"
+    message = msgpack_loads(reply["bytes"])
+    assert message["type"] == "delivery_info"
+    assert message["delivery"]["id"] == sample_delivery.delivery_id
+
+def test_consumer_defaults_to_json(sample_delivery):
+    """Test the delivery consumer keeps text frames without a subprotocol"""
+    accepted, reply = ws_exchange(
+        f"/ws/delivery/{sample_delivery.delivery_id}/",
+        {"text": json.dumps({"type": "subscribe_delivery"})}
+    )
+    assert accepted["subprotocol"] is None
+    message = json.loads(reply["text"])
+    assert message["delivery"]["status"] == "pending"
+
+def test_negotiate_encoding():
+    """Test Accept-Encoding negotiation"""
+    assert negotiate_encoding("gzip, deflate") == "gzip"
+    assert negotiate_encoding("identity") is None
+    assert negotiate_encoding("gzip;q=0") is None
+    assert negotiate_encoding("") is None
+    assert negotiate_encoding("*") is not None
+
+def test_list_deliveries_compressed(api_client, admin_auth_headers, many_deliveries):
+    """Test large delivery lists are gzip compressed"""
+    response = api_client.get("/api/v1/deliveries/", HTTP_ACCEPT_ENCODING="gzip", **admin_auth_headers)
+    assert response.status_code == 200
+    assert response["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response["Vary"]
+    assert len(json.loads(gzip.decompress(response.content))) == len(many_deliveries)
+
+def test_small_response_not_compressed(api_client):
+    """Test responses under the size threshold are sent as-is"""
+    response = api_client.get("/api/v1/deliveries/NONEXISTENT/", HTTP_ACCEPT_ENCODING="gzip")
+    assert response.status_code == 404
+    assert not response.has_header("Content-Encoding")
+
+def test_compression_exempt_route(api_client, admin_auth_headers, sample_delivery, settings):
+    """Test routes marked compression_exempt are never compressed"""
+    settings.COMPRESSION_MIN_SIZE = 0
+    data = {
+        "location": {
+            "type": "Point",
+            "coordinates": [-74.006, 40.7128]
+        }
+    }
+    response = api_client.put(
+        f"/api/v1/deliveries/{sample_delivery.delivery_id}/location/",
+        data,
+        format="json",
+        HTTP_ACCEPT_ENCODING="gzip",
+        **admin_auth_headers
+    )
+    assert response.status_code == 200
+    assert not response.has_header("Content-Encoding")
+
+def test_list_deliveries_ndjson_stream(read_path, api_client, admin_auth_headers, many_deliveries):
+    """Test delivery lists stream as compressed NDJSON"""
+    response = api_client.get(
+        "/api/v1/deliveries/",
+        HTTP_ACCEPT="application/x-ndjson",
+        HTTP_ACCEPT_ENCODING="gzip",
+        **admin_auth_headers
+    )
+    assert response.status_code == 200
+    assert response.streaming
+    assert response["Content-Type"] == "application/x-ndjson"
+    assert response["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(b"".join(async_to_sync(read_stream)(response))).splitlines()
+    assert len(lines) == len(many_deliveries)
+    assert tuple(json.loads(lines[0]).keys()) == DELIVERY_FIELDS
+
+async def read_stream(response):
+    """Read the chunks of an async streaming response"""
+    return [chunk async for chunk in response.streaming_content]
+
+def test_list_deliveries_ndjson_streams_under_asgi(admin_auth_headers, monkeypatch):
+    """Test delivery lists reach ASGI clients chunk by chunk, not buffered into one body"""
+    import threading
+    from django.core.handlers.asgi import ASGIHandler
+    from deliveries import views
+
+    Delivery._get_collection().insert_many([
+        Delivery(delivery_id=f"STREAM{i}", title="Stream", status="pending", customer_id="testuser",
+                 recipient_name="John Doe", destination="Somewhere",
+                 current_location={"type": "Point", "coordinates": [0, 0]}).to_mongo()
+        for i in range(250)
+    ])
+    # The rest of the list is only read once the client has the first chunk
+    first_received = threading.Event()
+    ndjson_lines = views.ndjson_lines
+
+    def held_lines(deliveries):
+        for index, chunk in enumerate(ndjson_lines(deliveries)):
+            if index == 1:
+                assert first_received.wait(5)
+            yield chunk
+
+    monkeypatch.setattr(views, "ndjson_lines", held_lines)
+
+    async def run():
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": "/api/v1/deliveries/", "raw_path": b"/api/v1/deliveries/",
+            "query_string": b"", "root_path": "", "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+            "headers": [(b"host", b"testserver"), (b"accept", b"application/x-ndjson"),
+                        (b"authorization", admin_auth_headers["HTTP_AUTHORIZATION"].encode())],
+        }
+        communicator = ApplicationCommunicator(ASGIHandler(), scope)
+        await communicator.send_input({"type": "http.request", "body": b"", "more_body": False})
+        start = await communicator.receive_output(timeout=5)
+        bodies = [(await communicator.receive_output(timeout=2))["body"]]
+        first_received.set()
+        while True:
+            message = await communicator.receive_output(timeout=5)
+            bodies.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        await communicator.wait(timeout=5)
+        return start, bodies
+
+    start, bodies = async_to_sync(run)()
+    assert start["status"] == 200
+    # 100 lines per chunk
+    assert [body.count(b"\n") for body in bodies if body] == [100, 100, 50]
+
+def test_read_routes(settings):
+    """Test the read preference of each read route"""
+    settings.MONGODB_READ_ROUTES = {"tracking": "secondaryPreferred"}
+    assert get_delivery_reader().read_preference is None
+    assert get_delivery_reader(route="tracking").read_preference.mongos_mode == "secondaryPreferred"
+    assert get_delivery_reader(route="unknown").read_preference.mongos_mode == "primary"
+
+def test_tracking_reads_use_read_route(api_client, sample_delivery, settings):
+    """Test that tracking reads work through a read route"""
+    settings.MONGODB_READ_ROUTES = {"tracking": "nearest"}
+    response = api_client.get(f"/api/v1/deliveries/{sample_delivery.delivery_id}/")
+    assert response.status_code == 200
+    assert response.json()["delivery_id"] == sample_delivery.delivery_id
+
+def test_read_routes_bound_staleness(settings):
+    """Test the max staleness of read routes and primary_reads() overriding them"""
+    settings.MONGODB_READ_ROUTES = {"tracking": "secondaryPreferred"}
+    settings.MONGODB_MAX_STALENESS_SECONDS = 120
+    assert get_delivery_reader(route="tracking").read_preference.max_staleness == 120
+    with primary_reads():
+        assert get_delivery_reader(route="tracking").read_preference.mongos_mode == "primary"
+
+def test_admin_write_pins_primary(api_client, admin_auth_headers, sample_delivery, settings, monkeypatch):
+    """Test that an admin write sends the client's next reads to the primary"""
+    settings.MONGODB_READ_ROUTES = {"tracking": "secondaryPreferred"}
+    read_preferences = []
+
+    def recording_reader(route=None):
+        reader = get_delivery_reader(route)
+        read_preferences.append(reader.read_preference.mongos_mode)
+        return reader
+
+    monkeypatch.setattr("deliveries.views.get_delivery_reader", recording_reader)
+    url = f"/api/v1/deliveries/{sample_delivery.delivery_id}/"
+    api_client.get(url)
+    response = api_client.put(f"{url}status/", {
+        "status": "in transit",
+        "location": {"type": "Point", "coordinates": [-74.006, 40.7128]}
+    }, format="json", **admin_auth_headers)
+    assert response.status_code == 200
+    assert settings.MONGODB_PRIMARY_PIN_COOKIE in response.cookies
+    response = api_client.get(url)
+    assert response.json()["status"] == "in transit"
+    assert read_preferences == ["secondaryPreferred", "primary"]
+
+def test_detail_writes_pin_primary(api_client, admin_auth_headers, sample_delivery, settings):
+    """Test location updates and deletes through the detail view pin the client to the primary"""
+    url = f"/api/v1/deliveries/{sample_delivery.delivery_id}/"
+    response = api_client.put(url, {
+        "location": {"type": "Point", "coordinates": [-74.006, 40.7128]}
+    }, format="json", **admin_auth_headers)
+    assert response.status_code == 200
+    assert settings.MONGODB_PRIMARY_PIN_COOKIE in response.cookies
+
+    response = api_client.delete(url, **admin_auth_headers)
+    assert response.status_code == 204
+    assert settings.MONGODB_PRIMARY_PIN_COOKIE in response.cookies
+
+def test_primary_pin_is_signed(settings):
+    """Test that an unsigned primary pin cookie is ignored"""
+    assert not primary_pinned({settings.MONGODB_PRIMARY_PIN_COOKIE: "1"})
+    response = HttpResponse()
+    pin_primary(response)
+    assert primary_pinned({settings.MONGODB_PRIMARY_PIN_COOKIE: response.cookies[settings.MONGODB_PRIMARY_PIN_COOKIE].value})
+
+def test_delivery_tracker_page(sample_delivery):
+    """Test the tracker page renders for a delivery and 404s for a missing one"""
+    client = Client()
+    response = client.get(f"/api/v1/deliveries/track/{sample_delivery.delivery_id}/")
+    assert response.status_code == 200
+    assert f"const deliveryId = '{sample_delivery.delivery_id}';" in response.content.decode()
+    assert client.get("/api/v1/deliveries/track/missing/").status_code == 404
+
+def update_status_and_location(api_client, headers, delivery_id):
+    location = {"type": "Point", "coordinates": [-74.006, 40.7128]}
+    response = api_client.put(f"/api/v1/deliveries/{delivery_id}/status/", {
+        "status": "in transit", "location": location
+    }, format="json", **headers)
+    assert response.status_code == 200
+    response = api_client.put(f"/api/v1/deliveries/{delivery_id}/location/", {
+        "location": {"type": "Point", "coordinates": [-73.99, 40.73]}
+    }, format="json", **headers)
+    assert response.status_code == 200
+    # The location is written behind
+    HotStateFlusher().flush_once(everything=True)
+
+def test_updates_write_outbox_events(api_client, admin_auth_headers, sample_delivery, monkeypatch):
+    """Test that updates store their events in the outbox instead of publishing them"""
+    monkeypatch.setattr("channels.layers.get_channel_layer", lambda *args: pytest.fail("published inline"))
+    update_status_and_location(api_client, admin_auth_headers, sample_delivery.delivery_id)
+    delivery = Delivery.objects(delivery_id=sample_delivery.delivery_id).first()
+    assert delivery.status == "in transit"
+    assert delivery.current_location["coordinates"] == [-73.99, 40.73]
+    assert [event.update_type for event in delivery.outbox] == ["status", "location"]
+    assert len({event.event_id for event in delivery.outbox}) == 2
+
+    response = api_client.put("/api/v1/deliveries/missing/location/", {
+        "location": {"type": "Point", "coordinates": [-73.99, 40.73]}
+    }, format="json", **admin_auth_headers)
+    assert response.status_code == 404
+
+class FailingLayer:
+    def __init__(self, layer, failures):
+        self.layer = layer
+        self.failures = failures
+
+    async def group_send(self, group, message):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("channel layer down")
+        await self.layer.group_send(group, message)
+
+def test_outbox_relay_publishes_at_least_once(api_client, admin_auth_headers, sample_delivery, settings):
+    """Test that outbox events stay queued until published"""
+    settings.BROADCAST_LOCATION_INTERVAL = 0
+    layer = get_channel_layer()
+    channel = async_to_sync(layer.new_channel)()
+    async_to_sync(layer.group_add)(f"delivery_{sample_delivery.delivery_id}", channel)
+    update_status_and_location(api_client, admin_auth_headers, sample_delivery.delivery_id)
+
+    # The publish fails, both events stay for the next batch
+    assert OutboxRelay(channel_layer=FailingLayer(layer, 1)).relay_once() == 0
+    assert len(Delivery.objects(delivery_id=sample_delivery.delivery_id).first().outbox) == 2
+
+    assert OutboxRelay(channel_layer=layer).relay_once() == 2
+    messages = [async_to_sync(layer.receive)(channel) for _ in range(2)]
+    assert [message["update_type"] for message in messages] == ["status", "location"]
+    assert messages[0]["status"] == "in transit"
+    assert messages[0]["delivery"]["id"] == sample_delivery.delivery_id
+    # Both events were read with the delivery as it is now, the location is in the first snapshot
+    assert messages[0]["delivery"]["location"]["coordinates"] == [-73.99, 40.73]
+    assert messages[1]["delta"] is True
+    assert Delivery.objects(delivery_id=sample_delivery.delivery_id).first().outbox == []
+    assert OutboxRelay(channel_layer=layer).relay_once() == 0
+    # Kept for SSE clients to resume
+    missed = event_history.since(f"delivery_{sample_delivery.delivery_id}", messages[0]["event_id"])
+    assert [payload["event_id"] for payload in missed] == [messages[1]["event_id"]]
+
+def test_consumer_drops_repeated_events(sample_delivery):
+    """Test that the WebSocket consumer sends a repeated event only once"""
+    async def run():
+        scope = {"type": "websocket", "path": f"/ws/delivery/{sample_delivery.delivery_id}/",
+                 "headers": [], "query_string": b"", "subprotocols": []}
+        communicator = ApplicationCommunicator(URLRouter(websocket_urlpatterns), scope)
+        await communicator.send_input({"type": "websocket.connect"})
+        await communicator.receive_output(timeout=2)
+        layer = get_channel_layer()
+        for event_id in ["a", "a", "b"]:
+            await layer.group_send(f"delivery_{sample_delivery.delivery_id}", {
+                "type": "delivery_update", "event_id": event_id, "update_type": "location",
+                "location": {"type": "Point", "coordinates": [0, 0]}
+            })
+        frames = [json.loads((await communicator.receive_output(timeout=2))["text"]) for _ in range(2)]
+        assert await communicator.receive_nothing(timeout=0.1)
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(timeout=2)
+        return frames
+
+    frames = async_to_sync(run)()
+    assert [frame["event_id"] for frame in frames] == ["a", "b"]
+    assert frames[0]["location"] == {"type": "Point", "coordinates": [0, 0]}
+
+def test_event_groups():
+    """Test the groups an event is published to"""
+    groups = event_groups({"delivery_id": "D1", "customer_id": "testuser", "status": "out for delivery"})
+    assert groups == ["delivery_D1", "fleet", customer_group("testuser"), "fleet_out-for-delivery"]
+    assert customer_group("a@b.c") != customer_group("a_b_c")
+    assert event_groups({"delivery_id": "D2"}) == ["delivery_D2", "fleet"]
+
+def test_customer_and_fleet_streams(api_client, auth_headers, admin_auth_headers, sample_delivery, settings):
+    """Test the customer and fleet WebSocket streams and who may join them"""
+    settings.BROADCAST_LOCATION_INTERVAL = 0
+    user_token = auth_headers["HTTP_AUTHORIZATION"].split()[1]
+    admin_token = admin_auth_headers["HTTP_AUTHORIZATION"].split()[1]
+
+    async def connect(path, query_string=b"", headers=()):
+        scope = {"type": "websocket", "path": path, "headers": list(headers),
+                 "query_string": query_string, "subprotocols": []}
+        communicator = ApplicationCommunicator(URLRouter(websocket_urlpatterns), scope)
+        await communicator.send_input({"type": "websocket.connect"})
+        return communicator, (await communicator.receive_output(timeout=2))["type"]
+
+    async def frames(communicator, count):
+        received = [json.loads((await communicator.receive_output(timeout=2))["text"]) for _ in range(count)]
+        assert await communicator.receive_nothing(timeout=0.1)
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(timeout=2)
+        return received
+
+    async def run():
+        # Customers only see their own deliveries, the fleet is for admins
+        rejected = [
+            (await connect("/ws/customer/testuser/"))[1],
+            (await connect("/ws/customer/otheruser/", f"token={user_token}".encode()))[1],
+            (await connect("/ws/fleet/", f"token={user_token}".encode()))[1],
+            (await connect("/ws/fleet/", f"token={admin_token}&status=lost".encode()))[1],
+        ]
+        customer, accepted = await connect("/ws/customer/testuser/", f"token={user_token}".encode())
+        assert accepted == "websocket.accept"
+        # Admins can follow any customer
+        customer_admin, accepted = await connect(
+            "/ws/customer/testuser/", headers=[(b"authorization", f"Bearer {admin_token}".encode())]
+        )
+        assert accepted == "websocket.accept"
+        fleet, _ = await connect("/ws/fleet/", f"token={admin_token}".encode())
+        in_transit, _ = await connect("/ws/fleet/", f"token={admin_token}&status=in+transit&status=pending".encode())
+        delivered, _ = await connect("/ws/fleet/", f"token={admin_token}&status=delivered".encode())
+
+        await sync_to_async(update_status_and_location)(api_client, admin_auth_headers, sample_delivery.delivery_id)
+        assert await sync_to_async(OutboxRelay().relay_once)() == 2
+        return rejected, [await frames(stream, count) for stream, count in
+                          [(customer, 2), (customer_admin, 2), (fleet, 2), (in_transit, 2), (delivered, 0)]]
+
+    rejected, streams = async_to_sync(run)()
+    assert rejected == ["websocket.close"] * 4
+    for received in streams[:4]:
+        assert [frame["update_type"] for frame in received] == ["status", "location"]
+        assert received[0]["delivery"]["id"] == sample_delivery.delivery_id
+
+def put_location(api_client, headers, delivery_id, lon):
+    response = api_client.put(f"/api/v1/deliveries/{delivery_id}/location/", {
+        "location": {"type": "Point", "coordinates": [lon, 40.0]}
+    }, format="json", **headers)
+    assert response.status_code == 200
+
+def test_hot_state_writes_locations_behind(api_client, admin_auth_headers, sample_delivery):
+    """Test that location pings are read from the hot state and written behind"""
+    delivery_id = sample_delivery.delivery_id
+    for lon in range(3):
+        put_location(api_client, admin_auth_headers, delivery_id, lon)
+    # The first change was written through and made the hash, the others are queued
+    assert Delivery.objects(delivery_id=delivery_id).first().current_location["coordinates"] == [0, 40.0]
+    assert api_client.get(f"/api/v1/deliveries/{delivery_id}/").json()["current_location"]["coordinates"] == [2, 40.0]
+    _, reply = ws_exchange(f"/ws/delivery/{delivery_id}/", {"text": json.dumps({"type": "subscribe_delivery"})})
+    snapshot = json.loads(reply["text"])["delivery"]
+    assert (snapshot["location"]["coordinates"], snapshot["title"]) == ([2, 40.0], "Test Delivery")
+
+    flusher = HotStateFlusher()
+    assert flusher.flush_once() == 0
+    assert flusher.flush_once(everything=True) == 1
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert delivery.current_location["coordinates"] == [2, 40.0]
+    assert [event.location["coordinates"][0] for event in delivery.outbox] == [0, 1, 2]
+
+    # Written through after the queued location, and evicted once delivered
+    put_location(api_client, admin_auth_headers, delivery_id, 3)
+    response = api_client.put(f"/api/v1/deliveries/{delivery_id}/status/", {
+        "status": "delivered", "location": {"type": "Point", "coordinates": [4, 40.0]}
+    }, format="json", **admin_auth_headers)
+    assert response.status_code == 200
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert [event.update_type for event in delivery.outbox][-2:] == ["location", "status"]
+    assert delivery.status == "delivered"
+    assert hot_state.snapshot(delivery_id) is None
+    assert hot_state.redis_client.keys("hot:*") == []
+    assert flusher.flush_once(everything=True) == 0
+
+def test_hot_state_durability_per_field(api_client, admin_auth_headers, sample_delivery, settings):
+    """Test that each field is written to Mongo within its own durability"""
+    delivery_id = sample_delivery.delivery_id
+    settings.HOT_STATE_DURABILITY = {"status": 5, "current_location": 1.0, "last_updated": 1.0}
+    location = {"type": "Point", "coordinates": [-74.006, 40.7128]}
+    for status_value in ["in transit", "out for delivery"]:
+        response = api_client.put(f"/api/v1/deliveries/{delivery_id}/status/", {
+            "status": status_value, "location": location
+        }, format="json", **admin_auth_headers)
+        assert response.status_code == 200
+    assert Delivery.objects(delivery_id=delivery_id).first().status == "in transit"
+    assert api_client.get(f"/api/v1/deliveries/{delivery_id}/").json()["status"] == "out for delivery"
+    assert HotStateFlusher().flush_once(everything=True) == 1
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert delivery.status == "out for delivery"
+    assert [entry.status for entry in delivery.status_history] == ["pending", "in transit", "out for delivery"]
+
+    # No delay, written through
+    settings.HOT_STATE_DURABILITY = {"status": 0, "current_location": 0, "last_updated": 0}
+    put_location(api_client, admin_auth_headers, delivery_id, 5)
+    assert Delivery.objects(delivery_id=delivery_id).first().current_location["coordinates"] == [5, 40.0]
+    assert hot_state.snapshot(delivery_id)["location"]["coordinates"] == [5, 40.0]
+
+def test_outbox_keeps_the_latest_events(api_client, admin_auth_headers, sample_delivery, settings):
+    """Test that the outbox only keeps the latest OUTBOX_MAX_EVENTS events"""
+    delivery_id = sample_delivery.delivery_id
+    settings.OUTBOX_MAX_EVENTS = 3
+    settings.HOT_STATE_DURABILITY = {"status": 0, "current_location": 0, "last_updated": 0}
+    put_location(api_client, admin_auth_headers, delivery_id, 0)
+    put_location(api_client, admin_auth_headers, delivery_id, 1)
+    settings.HOT_STATE_DURABILITY = {"status": 0, "current_location": 1.0, "last_updated": 1.0}
+    for lon in range(2, 5):
+        put_location(api_client, admin_auth_headers, delivery_id, lon)
+    HotStateFlusher().flush_once(everything=True)
+    outbox = Delivery.objects(delivery_id=delivery_id).first().outbox
+    assert [event.location["coordinates"][0] for event in outbox] == [2, 3, 4]
+
+def test_hot_state_write_through_waits_for_flush(api_client, admin_auth_headers, sample_delivery, monkeypatch):
+    """Test that a write through waits for a flush holding the delivery's lock"""
+    delivery_id = sample_delivery.delivery_id
+    put_location(api_client, admin_auth_headers, delivery_id, 0)
+    put_location(api_client, admin_auth_headers, delivery_id, 1)
+    # A flusher holds the delivery's lock
+    monkeypatch.setattr("deliveries.hot_state.LOCK_WAIT", 0.05)
+    delivery_ids, token = hot_state.claim(10, everything=True)
+    assert delivery_ids == [delivery_id]
+    response = api_client.put(f"/api/v1/deliveries/{delivery_id}/status/", {
+        "status": "in transit", "location": {"type": "Point", "coordinates": [2, 40.0]}
+    }, format="json", **admin_auth_headers)
+    assert response.status_code == 503
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert (delivery.status, delivery.current_location["coordinates"]) == ("pending", [0, 40.0])
+
+    assert hot_state.flush(delivery_ids, token) == [delivery_id]
+    response = api_client.put(f"/api/v1/deliveries/{delivery_id}/status/", {
+        "status": "in transit", "location": {"type": "Point", "coordinates": [2, 40.0]}
+    }, format="json", **admin_auth_headers)
+    assert response.status_code == 200
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert [event.update_type for event in delivery.outbox] == ["location", "location", "status"]
+
+def test_hot_state_ping_during_flush_written_through_after_it(api_client, admin_auth_headers, sample_delivery,
+                                                              monkeypatch):
+    """Test that a location arriving mid-flush waits for the flush and leaves its value in the hash"""
+    import threading
+    from deliveries import hot_state as hot_state_module
+
+    delivery_id = sample_delivery.delivery_id
+    put_location(api_client, admin_auth_headers, delivery_id, 0)
+    put_location(api_client, admin_auth_headers, delivery_id, 1)
+    merge_changes = hot_state_module.merge_changes
+    pings = []
+
+    def merge_and_ping(changes):
+        # Another location arrives while the flush holds the lock
+        monkeypatch.setattr(hot_state_module, "merge_changes", merge_changes)
+        ping = threading.Thread(target=put_location, args=(APIClient(), admin_auth_headers, delivery_id, 2))
+        ping.start()
+        pings.append(ping)
+        time.sleep(0.1)
+        return merge_changes(changes)
+
+    monkeypatch.setattr(hot_state_module, "merge_changes", merge_and_ping)
+    assert HotStateFlusher().flush_once(everything=True) == 1
+    pings[0].join(5)
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert delivery.current_location["coordinates"] == [2, 40.0]
+    assert [event.location["coordinates"][0] for event in delivery.outbox] == [0, 1, 2]
+    assert hot_state.snapshot(delivery_id)["location"]["coordinates"] == [2, 40.0]
+    assert hot_state.redis_client.llen(f"hot:queue:{delivery_id}") == 0
+
+def test_hot_state_keeps_changes_queued_mid_flush(api_client, admin_auth_headers, sample_delivery, monkeypatch):
+    """Test that a flush only takes the changes it wrote off the queue"""
+    from bson import json_util
+    from deliveries import hot_state as hot_state_module
+    from deliveries.outbox import new_event
+
+    delivery_id = sample_delivery.delivery_id
+    put_location(api_client, admin_auth_headers, delivery_id, 0)
+    put_location(api_client, admin_auth_headers, delivery_id, 1)
+    merge_changes = hot_state_module.merge_changes
+    location = {"type": "Point", "coordinates": [2, 40.0]}
+
+    def merge_and_queue(changes):
+        # Queued by a writer that missed the lock, e.g. after the lease ran out
+        hot_state.redis_client.rpush(f"hot:queue:{delivery_id}", json_util.dumps({
+            "set": {"current_location": location}, "event": new_event("location", location).to_mongo().to_dict(),
+            "history": None
+        }))
+        return merge_changes(changes)
+
+    monkeypatch.setattr(hot_state_module, "merge_changes", merge_and_queue)
+    assert HotStateFlusher().flush_once(everything=True) == 1
+    assert Delivery.objects(delivery_id=delivery_id).first().current_location["coordinates"] == [1, 40.0]
+    assert hot_state.redis_client.llen(f"hot:queue:{delivery_id}") == 1
+    monkeypatch.setattr(hot_state_module, "merge_changes", merge_changes)
+    assert HotStateFlusher().flush_once(everything=True) == 1
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert delivery.current_location["coordinates"] == [2, 40.0]
+    assert [event.location["coordinates"][0] for event in delivery.outbox] == [0, 1, 2]
+
+def test_hot_state_discard_survives_redis_errors(monkeypatch):
+    """Test that discarding hashes logs Redis errors instead of failing the relay's batch"""
+    import redis
+
+    def unreachable(*args, **kwargs):
+        raise redis.ConnectionError("unreachable")
+
+    monkeypatch.setattr(hot_state.redis_client, "delete", unreachable)
+    hot_state.discard(["D1", "D2"])
+
+def test_hot_state_writes_to_mongo_while_redis_is_down(api_client, admin_auth_headers, sample_delivery,
+                                                       monkeypatch):
+    """Test that updates still reach Mongo when the hot state can't be locked"""
+    import redis
+
+    delivery_id = sample_delivery.delivery_id
+
+    def unreachable(*args, **kwargs):
+        raise redis.ConnectionError("unreachable")
+
+    monkeypatch.setattr(hot_state.redis_client, "set", unreachable)
+    response = api_client.put(f"/api/v1/deliveries/{delivery_id}/status/", {
+        "status": "in transit", "location": {"type": "Point", "coordinates": [2, 40.0]}
+    }, format="json", **admin_auth_headers)
+    assert response.status_code == 200
+    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    assert (delivery.status, [event.update_type for event in delivery.outbox]) == ("in transit", ["status"])
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+def location_message(index, status="in transit"):
+    location = {"type": "Point", "coordinates": [index, 0]}
+    return {
+        "type": "delivery_update", "event_id": f"e{index}", "update_type": "location", "status": status,
+        "location": location, "delivery": {"id": "D1", "status": status, "location": location,
+                                           "title": "Parcel", "last_updated": f"t{index}"}
+    }
+
+def test_broadcast_scheduler_conflates_locations():
+    """Test that location updates sooner than the interval are held back and conflated"""
+    clock = FakeClock()
+    scheduler = BroadcastScheduler(interval=1.0, delta_window=60, clock=clock)
+    delivery = {"delivery_id": "D1"}
+    status = {**location_message(0), "update_type": "status", "event_id": "s0"}
+    assert scheduler.submit(delivery, status) == [(delivery, status)]
+
+    # Sooner than the interval: held back, the latest replacing the others
+    for index in range(1, 4):
+        clock.now += 0.25
+        assert scheduler.submit(delivery, location_message(index)) == []
+    assert scheduler.due() == []
+    assert scheduler.next_due() == 0.25
+    clock.now += 0.25
+    [(_, delta)] = scheduler.due()
+    assert delta["event_id"] == "e3"
+    assert delta["delta"] is True
+    assert delta["delivery"] == {"id": "D1", "location": {"type": "Point", "coordinates": [3, 0]}, "last_updated": "t3"}
+    assert "status" not in delta and "location" not in delta
+    assert scheduler.due() == []
+
+    # A status change goes out at once and drops the held back location
+    clock.now += 0.5
+    assert scheduler.submit(delivery, location_message(4)) == []
+    delivered = {**location_message(5, "delivered"), "update_type": "status", "event_id": "s1"}
+    assert scheduler.submit(delivery, delivered) == [(delivery, delivered)]
+    assert scheduler.next_due() is None
+    # Nothing is kept once delivered, the next event is full
+    [(_, message)] = scheduler.submit(delivery, location_message(6))
+    assert "delta" not in message
+
+    clock.now += 61
+    scheduler.sweep()
+    assert scheduler.last_sent == {}
+
+def test_broadcast_scheduler_sends_full_snapshot_every_window():
+    """Test that a full snapshot goes out at least once per delta window"""
+    clock = FakeClock()
+    scheduler = BroadcastScheduler(interval=1.0, delta_window=60, clock=clock)
+    delivery = {"delivery_id": "D1"}
+    full = []
+    # A delivery pinging every second, without pause
+    for index in range(400):
+        clock.now += 1
+        [(_, message)] = scheduler.submit(delivery, location_message(index))
+        if not message.get("delta"):
+            full.append(index)
+        else:
+            assert message["full"] == location_message(index)
+    assert full == [0, 60, 120, 180, 240, 300, 360]
+
+def test_publish_sends_deltas_to_the_delivery_group_only():
+    """Test that deltas only go to the delivery group"""
+    layer = get_channel_layer()
+    delivery = {"delivery_id": "D1", "customer_id": "c1", "status": "in transit"}
+    channels = {}
+    for group in event_groups(delivery):
+        channels[group] = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(group, channels[group])
+    scheduler = BroadcastScheduler(interval=0, delta_window=60, clock=FakeClock())
+    for index in range(2):
+        for _, message in scheduler.submit(delivery, location_message(index)):
+            async_to_sync(publish)(layer, delivery, message)
+    for group, channel in channels.items():
+        messages = [async_to_sync(layer.receive)(channel) for _ in range(2)]
+        assert all("full" not in message for message in messages)
+        if group == "delivery_D1":
+            assert messages[1]["delta"] is True
+        else:
+            assert messages[1] == location_message(1)
+
+def test_relay_outbox_once_publishes_held_updates(api_client, admin_auth_headers, sample_delivery, settings):
+    """Test that relay_outbox --once publishes the location updates it held back before exiting"""
+    from django.core.management import call_command
+    from io import StringIO
+
+    settings.BROADCAST_LOCATION_INTERVAL = 60
+    delivery_id = sample_delivery.delivery_id
+    layer = get_channel_layer()
+    channel = async_to_sync(layer.new_channel)()
+    async_to_sync(layer.group_add)(f"delivery_{delivery_id}", channel)
+    for lon in range(2):
+        put_location(api_client, admin_auth_headers, delivery_id, lon)
+    HotStateFlusher().flush_once(everything=True)
+
+    call_command("relay_outbox", "--once", stdout=StringIO())
+    assert Delivery.objects(delivery_id=delivery_id).first().outbox == []
+    messages = [async_to_sync(layer.receive)(channel) for _ in range(2)]
+    assert messages[0]["location"]["coordinates"] == [0, 40.0]
+    assert messages[1]["delta"] is True
+    # Read in the same batch as the first, the snapshot already had its location
+    assert messages[1]["delivery"] == {"id": delivery_id}
+
+def test_outbox_relay_conflates_location_bursts(api_client, admin_auth_headers, sample_delivery):
+    """Test that the outbox relay conflates a burst of location updates"""
+    clock = FakeClock()
+    layer = get_channel_layer()
+    channel = async_to_sync(layer.new_channel)()
+    async_to_sync(layer.group_add)(f"delivery_{sample_delivery.delivery_id}", channel)
+    relay = OutboxRelay(channel_layer=layer, scheduler=BroadcastScheduler(interval=1.0, clock=clock))
+    url = f"/api/v1/deliveries/{sample_delivery.delivery_id}/location/"
+    for lon in range(5):
+        response = api_client.put(url, {"location": {"type": "Point", "coordinates": [lon, 40.0]}},
+                                  format="json", **admin_auth_headers)
+        assert response.status_code == 200
+    HotStateFlusher().flush_once(everything=True)
+
+    assert relay.relay_once() == 5
+    assert Delivery.objects(delivery_id=sample_delivery.delivery_id).first().outbox == []
+    first = async_to_sync(layer.receive)(channel)
+    assert first["location"]["coordinates"] == [0, 40.0]
+    assert first["delivery"]["location"]["coordinates"] == [4, 40.0]
+    assert relay.relay_once() == 0
+    clock.now += 1
+    assert relay.relay_once() == 1
+    latest = async_to_sync(layer.receive)(channel)
+    assert (latest["update_type"], latest["delta"]) == ("location", True)
+    # Read in the same batch as the first, nothing changed since
+    assert latest["delivery"] == {"id": sample_delivery.delivery_id}
+
+async def next_frames(frames, count):
+    """Read count SSE frames, a chunk can hold several"""
+    received = []
+    while len(received) < count:
+        chunk = await asyncio.wait_for(anext(frames), 2)
+        received += [frame + b"\n\n" for frame in chunk.split(b"\n\n") if frame]
+    assert len(received) == count
+    return received
+
+async def next_frame(frames):
+    return (await next_frames(frames, 1))[0]
+
+async def disconnect(frames):
+    # The ASGI handler cancels the response when the client goes away
+    pending = asyncio.ensure_future(anext(frames))
+    await asyncio.sleep(0.01)
+    pending.cancel()
+    await asyncio.gather(pending, return_exceptions=True)
+
+def sse_data(frame):
+    fields = dict(line.split(": ", 1) for line in frame.decode().strip().splitlines())
+    return fields.get("id"), fields["event"], json.loads(fields["data"])
+
+def test_delivery_sse_stream(sample_delivery, settings):
+    """Test the delivery event stream with its snapshot, events and heartbeats"""
+    settings.SSE_HEARTBEAT_SECONDS = 0.2
+    delivery = {"delivery_id": sample_delivery.delivery_id, "customer_id": "testuser", "status": "in transit"}
+    group = f"delivery_{sample_delivery.delivery_id}"
+
+    async def run():
+        client = AsyncClient()
+        assert (await client.get("/api/v1/deliveries/missing/events/")).status_code == 404
+        streams = []
+        for _ in range(2):
+            response = await client.get(f"/api/v1/deliveries/{sample_delivery.delivery_id}/events/")
+            assert response["Content-Type"] == "text/event-stream"
+            frames = response.streaming_content
+            assert await next_frame(frames) == f"retry: {settings.SSE_RETRY_MS}\n\n".encode()
+            assert sse_data(await next_frame(frames))[1] == "delivery_info"
+            streams.append(frames)
+
+        # The worker's streams share one channel layer subscription
+        layer = get_channel_layer()
+        assert len(layer.groups[group]) == 1
+        message = {"type": "delivery_update", "event_id": "e1", "update_type": "status", "status": "in transit"}
+        await publish(layer, delivery, message)
+        await publish(layer, delivery, message)
+        for frames in streams:
+            frame, heartbeat = await next_frames(frames, 2)
+            event_id, event, data = sse_data(frame)
+            assert (event_id, event, data["status"]) == ("e1", "delivery_update", "in transit")
+            assert heartbeat == b": heartbeat\n\n"
+        for frames in streams:
+            await disconnect(frames)
+        assert group not in layer.groups
+
+    async_to_sync(run)()
+
+def test_sse_resumes_from_history(sample_delivery, auth_headers, settings):
+    """Test that a reconnecting SSE client gets the events it missed"""
+    delivery = {"delivery_id": sample_delivery.delivery_id, "customer_id": "testuser", "status": "in transit"}
+    event_history.record([
+        (delivery, {"type": "delivery_update", "event_id": f"e{index}", "update_type": "location",
+                    "location": {"type": "Point", "coordinates": [index, 0]}})
+        for index in range(3)
+    ])
+    token = auth_headers["HTTP_AUTHORIZATION"].split()[1]
+
+    async def run():
+        client = AsyncClient()
+        url = f"/api/v1/deliveries/{sample_delivery.delivery_id}/events/"
+        response = await client.get(url, headers={"Last-Event-ID": "e0"})
+        frames = response.streaming_content
+        await next_frame(frames)
+        replayed = [sse_data(frame) for frame in await next_frames(frames, 2)]
+        await disconnect(frames)
+
+        # Too old for the history: a new snapshot
+        response = await client.get(url, headers={"Last-Event-ID": "unknown"})
+        frames = response.streaming_content
+        await next_frame(frames)
+        expired = sse_data(await next_frame(frames))[1]
+        await disconnect(frames)
+
+        url = "/api/v1/deliveries/customers/testuser/events/"
+        statuses = [(await client.get(url)).status_code,
+                    (await client.get("/api/v1/deliveries/customers/other/events/", {"token": token})).status_code]
+        response = await client.get(url, {"token": token, "last_event_id": "e1"})
+        frames = response.streaming_content
+        await next_frame(frames)
+        customer = sse_data(await next_frame(frames))
+        await disconnect(frames)
+        return replayed, expired, statuses, customer
+
+    replayed, expired, statuses, customer = async_to_sync(run)()
+    assert [(event_id, data["location"]["coordinates"]) for event_id, _, data in replayed] == [("e1", [1, 0]), ("e2", [2, 0])]
+    assert expired == "delivery_info"
+    assert statuses == [401, 403]
+    assert customer[0] == "e2"
+
+def change(operation, delivery, token, updated=None):
+    key = "fullDocumentBeforeChange" if operation == "delete" else "fullDocument"
+    change = {"_id": {"_data": token}, "operationType": operation, key: delivery,
+              "wallTime": datetime.now(timezone.utc)}
+    if updated is not None:
+        change["updateDescription"] = {"updatedFields": updated, "removedFields": []}
+    return change
+
+def test_change_stream_events_coalesced():
+    """Test that change stream events of the same delivery are coalesced"""
+    first = {"delivery_id": "D1", "status": "in transit", "current_location": {"type": "Point", "coordinates": [1, 1]}}
+    second = {"delivery_id": "D2", "status": "pending", "current_location": {"type": "Point", "coordinates": [2, 2]}}
+    events, invalidated = coalesce([
+        change("update", first, "01", {"current_location": {}}),
+        change("update", first, "02", {"current_location": {}}),
+        change("update", first, "03", {"status": "in transit", "status_history.1": {}}),
+        change("update", first, "04", {"current_location": {}, "last_updated": 0}),
+        # Came with an outbox event: invalidated, published by the outbox relay
+        change("update", second, "05", {"status": "pending", "outbox.0": {}}),
+        # The outbox relay removing published events
+        change("update", second, "06", {"outbox": []}),
+        change("insert", {"delivery_id": "D3", "status": "pending"}, "07"),
+        change("update", {"delivery_id": "D3", "status": "pending"}, "08", {"title": "Renamed"}),
+        change("delete", {"delivery_id": "D3"}, "09"),
+        change("delete", None, "10"),
+    ])
+    assert invalidated == ["D1", "D2", "D3"]
+    assert [event["update_type"] for event in events["D1"][1]] == ["location", "status", "location"]
+    assert events["D1"][1][1]["status"] == "in transit"
+    assert "D2" not in events
+    assert [event["update_type"] for event in events["D3"][1]] == ["deleted"]
+    # Event ids come from the change, a replay keeps them
+    assert events["D1"][1][0]["event_id"] == coalesce([change("update", first, "02", {"current_location": {}})])[0]["D1"][1][0]["event_id"]
+
+def test_change_stream_relay_publishes(sample_delivery, settings):
+    """Test that the change stream relay publishes events and invalidations"""
+    layer = get_channel_layer()
+    channel = async_to_sync(layer.new_channel)()
+    async_to_sync(layer.group_add)(f"delivery_{sample_delivery.delivery_id}", channel)
+    relay = ChangeStreamRelay(channel_layer=layer)
+    pubsub = relay.redis_client.pubsub()
+    pubsub.subscribe(settings.DELIVERY_INVALIDATION_CHANNEL)
+    pubsub.get_message(timeout=1)
+
+    delivery = Delivery.objects(delivery_id=sample_delivery.delivery_id).as_pymongo().first()
+    delivery["status"] = "delivered"
+    assert relay.handle([change("update", delivery, "0A", {"status": "delivered"})]) == 1
+    message = async_to_sync(layer.receive)(channel)
+    assert message["update_type"] == "status"
+    assert message["status"] == "delivered"
+    assert message["delivery"]["id"] == sample_delivery.delivery_id
+    assert json.loads(pubsub.get_message(timeout=1)["data"]) == [sample_delivery.delivery_id]
+
+    relay.save_token({"_data": "0A"})
+    assert ChangeStreamRelay(channel_layer=layer).load_token() == {"_data": "0A"}
+
+def test_change_stream_relay_discards_hot_state(api_client, admin_auth_headers, sample_delivery):
+    """Test that a change made outside the API drops the delivery's hot state"""
+    update_status_and_location(api_client, admin_auth_headers, sample_delivery.delivery_id)
+    assert hot_state.snapshot(sample_delivery.delivery_id)["status"] == "in transit"
+    delivery = Delivery.objects(delivery_id=sample_delivery.delivery_id).as_pymongo().first()
+    delivery["title"] = "Renamed"
+    ChangeStreamRelay(channel_layer=get_channel_layer()).handle([change("update", delivery, "0B", {"title": "Renamed"})])
+    # Read from Mongo until the next change
+    assert hot_state.snapshot(sample_delivery.delivery_id) is None
+
+REPLICA_SET_URI = os.environ.get("MONGODB_REPLICA_SET_URI")
+
+@pytest.mark.skipif(not REPLICA_SET_URI, reason="MONGODB_REPLICA_SET_URI not set")
+def test_change_stream_relay_resumes(settings):
+    """Test that the change stream relay resumes from its checkpoint"""
+    from pymongo import MongoClient
+
+    settings.CHANGE_STREAM_PRE_IMAGES = False
+    client = MongoClient(REPLICA_SET_URI)
+    database = client.get_database("logistics_change_stream_test")
+    collection, checkpoints = database.deliveries, database.checkpoints
+    layer = get_channel_layer()
+    channel = async_to_sync(layer.new_channel)()
+    async_to_sync(layer.group_add)("delivery_CS1", channel)
+
+    def relay_changes():
+        relay = ChangeStreamRelay("test", collection, checkpoints, layer, max_wait=0.5)
+        # The stream is opened here, before the writes
+        with relay.watch(relay.load_token()) as stream:
+            yield
+            published = relay.handle(relay.read_batch(stream))
+            relay.save_token(stream.resume_token)
+        yield published
+
+    try:
+        collection.delete_many({})
+        checkpoints.delete_many({})
+        relay = relay_changes()
+        next(relay)
+        # Written directly, as a script would
+        collection.insert_one({"delivery_id": "CS1", "status": "pending", "current_location": {"type": "Point", "coordinates": [0, 0]}})
+        for lon in range(1, 4):
+            collection.update_one({"delivery_id": "CS1"}, {"$set": {"current_location": {"type": "Point", "coordinates": [lon, 0]}}})
+        assert next(relay) == 2
+        messages = [async_to_sync(layer.receive)(channel) for _ in range(2)]
+        assert [message["update_type"] for message in messages] == ["created", "location"]
+        assert messages[1]["location"]["coordinates"] == [3, 0]
+
+        # Changed while no relay runs, picked up from the saved token
+        collection.update_one({"delivery_id": "CS1"}, {"$set": {"status": "delivered"}})
+        relay = relay_changes()
+        next(relay)
+        assert next(relay) == 1
+        message = async_to_sync(layer.receive)(channel)
+        assert (message["update_type"], message["status"]) == ("status", "delivered")
+    finally:
+        client.drop_database("logistics_change_stream_test")
+        client.close()
+
@@ -7,6 +7,7 @@ from deliveries.views import (
     DeliveryStatusUpdate,
     delivery_tracker
 )
+from deliveries.sse import delivery_events, customer_events
 
 urlpatterns = [
     # Admin routes
@@ -16,8 +17,10 @@ urlpatterns = [
 
     # User routes
     path('my/', MyDeliveriesView.as_view(), name='my_deliveries'),
+    path('customers/<str:customer_id>/events/', customer_events, name='customer_events'),
 
     # Public routes
     path('<str:delivery_id>/', DeliveryDetailView.as_view(), name='delivery_detail'),
+    path('<str:delivery_id>/events/', delivery_events, name='delivery_events'),
     path('track/<str:delivery_id>/', delivery_tracker, name='delivery_tracker'),
 ] 
\ No newline at end of file
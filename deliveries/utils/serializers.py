@@ -0,0 +1,158 @@
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import UUID
+
+import msgpack
+from bson import ObjectId
+from django.utils.functional import Promise
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Wire order of the public delivery schema, see Delivery.to_dict()
+DELIVERY_FIELDS = (
+    "delivery_id",
+    "title",
+    "status",
+    "customer_id",
+    "recipient_name",
+    "current_location",
+    "destination",
+    "created_at",
+    "last_updated",
+    "status_history",
+)
+
+
+def _default(obj):
+    """
+    Fallback for types the encoder does not handle natively.
+    Args:
+        obj: The object to serialize.
+    Returns:
+        A JSON-compatible representation of the object.
+    Raises:
+        TypeError: If the object cannot be serialized.
+    """
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, (ObjectId, UUID, Decimal, Promise)):
+        return str(obj)
+    if hasattr(obj, "__iter__"):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(data):
+    """
+    Serialize data to compact UTF-8 JSON.
+    datetimes are written in the same format as datetime.isoformat(), so
+    payloads are byte-compatible with the ones built by to_dict().
+    Args:
+        data: The data to serialize.
+    Returns:
+        bytes: The encoded JSON document.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_default)
+    return json.dumps(data, default=_default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loads(data):
+    """
+    Deserialize a JSON document.
+    Args:
+        data: The JSON document as bytes or str.
+    Returns:
+        The decoded data.
+    Raises:
+        ValueError: If the document is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+
+def ndjson_lines(items, batch_size=100):
+    """
+    Encode items as newline-delimited JSON.
+    Lines are yielded in batches to keep the number of chunks written to the
+    socket (and flushed by the compression middleware) low.
+    Args:
+        items: An iterable of JSON-serializable items.
+        batch_size: Number of lines per yielded chunk.
+    Yields:
+        bytes: A chunk of one or more encoded lines.
+    """
+    batch = []
+    for item in items:
+        batch.append(dumps(item))
+        if len(batch) >= batch_size:
+            yield b"\n".join(batch) + b"\n"
+            batch = []
+    if batch:
+        yield b"\n".join(batch) + b"\n"
+
+
+def msgpack_dumps(data):
+    """
+    Serialize data to MessagePack.
+    datetimes are written as ISO strings, the same as in JSON payloads.
+    Args:
+        data: The data to serialize.
+    Returns:
+        bytes: The encoded MessagePack document.
+    """
+    return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+def msgpack_loads(data):
+    """
+    Deserialize a MessagePack document.
+    Args:
+        data: The MessagePack document as bytes.
+    Returns:
+        The decoded data.
+    Raises:
+        ValueError: If the document is not valid MessagePack.
+    """
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except (ValueError, TypeError) as exc:
+        raise ValueError(f"MessagePack decode error - {exc}")
+
+
+def delivery_from_son(son):
+    """
+    Build the public delivery representation straight from a raw Mongo document.
+    This skips mongoengine Document instantiation, datetimes are left as-is
+    and formatted by the encoder.
+    Args:
+        son: The raw document as returned by pymongo or QuerySet.as_pymongo().
+    Returns:
+        dict: The delivery in the same shape as Delivery.to_dict().
+    """
+    return {
+        "delivery_id": son.get("delivery_id"),
+        "title": son.get("title"),
+        "status": son.get("status"),
+        "customer_id": son.get("customer_id"),
+        "recipient_name": son.get("recipient_name"),
+        "current_location": son.get("current_location"),
+        "destination": son.get("destination"),
+        "created_at": son.get("created_at"),
+        "last_updated": son.get("last_updated"),
+        "status_history": [
+            {
+                "status": entry.get("status"),
+                "location": entry.get("location"),
+                "timestamp": entry.get("timestamp")
+            }
+            for entry in son.get("status_history", ())
+        ]
+    }
@@ -1,4 +1,7 @@
 from django.shortcuts import render
+from django.conf import settings
+from django.http import Http404, StreamingHttpResponse
+from asgiref.sync import sync_to_async
 from rest_framework.views import APIView
 from deliveries.mongo.delivery import Delivery, StatusHistory, VALID_STATUSES
 from users.mongo.user import User
@@ -7,16 +10,40 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from users.utils.auth_utils import extract_user_from_request
 from deliveries.utils.validators import validate_lat_lon_input
+from deliveries.mongo.readers import get_delivery_reader
+from deliveries.renderers import NDJSONRenderer
+from deliveries.utils.serializers import ndjson_lines
+from deliveries.outbox import new_event
+from deliveries.hot_state import hot_state, HotStateUnavailable
 from datetime import datetime, timezone
 import random
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from rest_framework import status
 from rest_framework.permissions import AllowAny
 from rest_framework.exceptions import AuthenticationFailed
 
 # Create your views here.
 
+def ndjson_response(deliveries):
+    """
+    Stream deliveries as newline-delimited JSON.
+    The body is an async iterator, so ASGI servers send each batch of lines
+    as it is read instead of buffering the whole list.
+    Args:
+        deliveries: An iterable of deliveries in the public wire schema.
+    Returns:
+        StreamingHttpResponse: The streaming response.
+    """
+    return StreamingHttpResponse(ndjson_chunks(deliveries), content_type=NDJSONRenderer.media_type, status=200)
+
+
+async def ndjson_chunks(deliveries):
+    # Each batch is read from the cursor in a worker thread
+    chunks = ndjson_lines(deliveries)
+    next_chunk = sync_to_async(next, thread_sensitive=False)
+    while (chunk := await next_chunk(chunks, None)) is not None:
+        yield chunk
+
+
 class DeliveryDetailView(APIView):
     """
     View to handle delivery details.
@@ -47,11 +74,12 @@ class DeliveryDetailView(APIView):
         Returns:
             Response: A response object with the delivery details or an error message.
         """
-        delivery = Delivery.objects(delivery_id=delivery_id).first()
+        # The hot state is ahead of Mongo by the changes not flushed yet
+        delivery = hot_state.overlay(get_delivery_reader(route="tracking").get(delivery_id))
         if not delivery:
             return Response({"error": "Delivery not found"}, status=404)
 
-        return Response(delivery.to_dict(), status=200)
+        return Response(delivery, status=200)
 
     def delete(self, request, delivery_id):
         """
@@ -68,6 +96,7 @@ class DeliveryDetailView(APIView):
                 return Response({"error": "Delivery not found"}, status=404)
 
             delivery.delete()
+            hot_state.evict(delivery_id)
             return Response({"message": "Delivery deleted"}, status=204)
         except AuthenticationFailed as e:
             return Response({"error": str(e)}, status=401)
@@ -95,18 +124,20 @@ class DeliveryDetailView(APIView):
             except (ValueError, TypeError):
                 return Response({"error": "Coordinates must be numeric"}, status=400)
 
-            delivery = Delivery.objects(delivery_id=delivery_id).first()
-            if not delivery:
-                return Response({"error": "Delivery not found"}, status=404)
-
-            delivery.current_location = {
+            location = {
                 "type": "Point",
                 "coordinates": [lon, lat]
             }
-            delivery.last_updated = datetime.now(timezone.utc)
-            delivery.save()
+            now = datetime.now(timezone.utc)
+            if not hot_state.update(
+                delivery_id, new_event("location", location, timestamp=now),
+                {"current_location": location, "last_updated": now}
+            ):
+                return Response({"error": "Delivery not found"}, status=404)
 
             return Response({"message": "Location updated"}, status=200)
+        except HotStateUnavailable as e:
+            return Response({"error": str(e)}, status=503)
         except AuthenticationFailed as e:
             return Response({"error": str(e)}, status=401)
         except Exception as e:
@@ -133,8 +164,10 @@ class MyDeliveriesView(APIView):
         """
         try:
             user = extract_user_from_request(request)
-            deliveries = Delivery.objects(customer_id=user.username)
-            return Response([delivery.to_dict() for delivery in deliveries], status=200)
+            if request.accepted_renderer.format == NDJSONRenderer.format:
+                return ndjson_response(get_delivery_reader().iter(customer_id=user.username))
+            deliveries = get_delivery_reader().list(customer_id=user.username)
+            return Response(deliveries, status=200)
 
         except Exception:
             return Response({"error": "User not found"}, status=404)
@@ -161,8 +194,10 @@ class DeliveryListCreate(APIView):
         Returns:
             Response: A response object with the list of deliveries.
         """
-        deliveries = Delivery.objects()
-        return Response([delivery.to_dict() for delivery in deliveries], status=200)
+        if request.accepted_renderer.format == NDJSONRenderer.format:
+            return ndjson_response(get_delivery_reader().iter())
+        deliveries = get_delivery_reader().list()
+        return Response(deliveries, status=200)
 
     def post(self, request):
         try:
@@ -211,6 +246,8 @@ class DeliveryListCreate(APIView):
 
 class DeliveryLocationUpdate(APIView):
     permission_classes = [IsAuthenticated, IsAdminUser]
+    # Responses are tiny, skip negotiating compression on this hot path
+    compression_exempt = True
 
     def handle_exception(self, exc):
         if isinstance(exc, AuthenticationFailed):
@@ -222,15 +259,17 @@ class DeliveryLocationUpdate(APIView):
             location_input = request.data.get("location")
             location = validate_lat_lon_input(location_input)
 
-            delivery = Delivery.objects(delivery_id=delivery_id).first()
-            if not delivery:
+            # The change and its event together, the event is published by the outbox relay
+            now = datetime.now(timezone.utc)
+            if not hot_state.update(
+                delivery_id, new_event("location", location, timestamp=now),
+                {"current_location": location, "last_updated": now}
+            ):
                 return Response({"error": "Delivery not found"}, status=404)
 
-            delivery.current_location = location
-            delivery.last_updated = datetime.now(timezone.utc)
-            delivery.save()
-
             return Response({"message": "Location updated"}, status=200)
+        except HotStateUnavailable as e:
+            return Response({"error": str(e)}, status=503)
         except AuthenticationFailed as e:
             return Response({"error": str(e)}, status=401)
         except ValueError as e:
@@ -239,6 +278,7 @@ class DeliveryLocationUpdate(APIView):
 
 class DeliveryStatusUpdate(APIView):
     permission_classes = [IsAuthenticated, IsAdminUser]
+    compression_exempt = True
 
     def handle_exception(self, exc):
         if isinstance(exc, AuthenticationFailed):
@@ -262,10 +302,6 @@ class DeliveryStatusUpdate(APIView):
             except ValueError as e:
                 return Response({"error": str(e)}, status=400)
 
-            delivery = Delivery.objects(delivery_id=delivery_id).first()
-            if not delivery:
-                return Response({"error": "Delivery not found"}, status=404)
-
             try:
                 status_history = StatusHistory(
                     status=status_value,
@@ -274,27 +310,18 @@ class DeliveryStatusUpdate(APIView):
             except Exception:
                 return Response({"error": "Invalid status"}, status=400)
 
-            delivery.status = status_value
-            delivery.current_location = location
-            delivery.last_updated = datetime.now(timezone.utc)
-            delivery.status_history.append(status_history)
-            delivery.save()
-
-            # Send WebSocket update
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f"delivery_{delivery_id}",
-                {
-                    "type": "delivery_update",
-                    "message": {
-                        "status": status_value,
-                        "location": location,
-                        "timestamp": datetime.now(timezone.utc).isoformat()
-                    }
-                }
-            )
+            # The change and its event together, the event is published by the outbox relay
+            now = datetime.now(timezone.utc)
+            if not hot_state.update(
+                delivery_id, new_event("status", location, status=status_value, timestamp=now),
+                {"status": status_value, "current_location": location, "last_updated": now},
+                history=status_history
+            ):
+                return Response({"error": "Delivery not found"}, status=404)
 
             return Response({"message": "Status updated"}, status=200)
+        except HotStateUnavailable as e:
+            return Response({"error": str(e)}, status=503)
         except AuthenticationFailed as e:
             return Response({"error": str(e)}, status=401)
         except Exception as e:
@@ -304,12 +331,13 @@ def delivery_tracker(request, delivery_id):
     """
     Render the delivery tracking page.
     """
-    delivery = Delivery.objects(delivery_id=delivery_id).first()
+    delivery = hot_state.overlay(get_delivery_reader(route="tracking").get(delivery_id))
     if not delivery:
-        return render(request, "deliveries/error.html", {"error": "Delivery not found"}, status=404)
+        raise Http404("Delivery not found")
 
-    return render(request, "deliveries/tracker.html", {
-        "delivery": delivery.to_dict(),
+    return render(request, "delivery_tracker.html", {
+        "delivery": delivery,
+        "delivery_id": delivery_id,
         "api_key": settings.MAPS_API_KEY
     })
 
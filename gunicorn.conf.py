@@ -0,0 +1,21 @@
+"""
+Gunicorn settings for preforked ASGI workers: gunicorn -c gunicorn.conf.py logistics_backend.asgi:application
+The app is imported once in the master and forked, so workers share its memory
+copy-on-write. Clients opened before the fork are dropped in each child by
+logistics_backend.prefork and reconnect on first use.
+"""
+import os
+import multiprocessing
+
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.environ.get("WORKER_TIMEOUT", 30))
+graceful_timeout = 30
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded, before any worker is forked
+    from logistics_backend import prefork
+    prefork.preload()
@@ -0,0 +1,292 @@
+import zlib
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.http import JsonResponse
+from django.utils.deprecation import MiddlewareMixin
+from logistics_backend.mongo import pin_primary, primary_pinned, primary_reads
+from logistics_backend.ratelimit import rate_limiter, load_policies, client_key
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/x-ndjson",
+    "application/msgpack",
+    "text/",
+)
+
+
+class GzipCodec:
+    name = "gzip"
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return (
+            lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush
+        )
+
+
+class BrotliCodec:
+    name = "br"
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def stream(self):
+        compressor = brotli.Compressor(quality=self.level)
+        return (
+            lambda chunk: compressor.process(chunk) + compressor.flush(),
+            compressor.finish
+        )
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return (
+            lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush
+        )
+
+
+CODECS = {
+    "gzip": GzipCodec,
+    "br": BrotliCodec if brotli is not None else None,
+    "zstd": ZstdCodec if zstandard is not None else None,
+}
+
+
+def available_encodings():
+    """
+    Get the content encodings this server can produce, in preference order.
+    Returns:
+        list: Encodings from settings.COMPRESSION_ENCODINGS whose codec is installed.
+    """
+    return [name for name in settings.COMPRESSION_ENCODINGS if CODECS.get(name)]
+
+
+def get_codec(encoding):
+    """
+    Build the codec for a content encoding at its configured level.
+    Args:
+        encoding: The content encoding name.
+    Returns:
+        The codec instance.
+    """
+    return CODECS[encoding](settings.COMPRESSION_LEVELS[encoding])
+
+
+def parse_accept_encoding(header):
+    """
+    Parse an Accept-Encoding header.
+    Args:
+        header: The raw header value.
+    Returns:
+        dict: Encoding name to q-value.
+    """
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def negotiate_encoding(header):
+    """
+    Pick the content encoding for a response.
+    The client's q-values win, ties go to the server preference order.
+    Args:
+        header: The raw Accept-Encoding header value.
+    Returns:
+        str: The chosen encoding, or None to send the response uncompressed.
+    """
+    accepted = parse_accept_encoding(header)
+    wildcard = accepted.get("*", 0.0)
+    candidates = []
+    for index, encoding in enumerate(available_encodings()):
+        quality = accepted.get(encoding, wildcard)
+        if quality > 0:
+            candidates.append((quality, -index, encoding))
+    return max(candidates)[2] if candidates else None
+
+
+def compression_exempt(view):
+    """
+    Mark a view as exempt from response compression.
+    Class-based views can set compression_exempt = True instead.
+    """
+    view.compression_exempt = True
+    return view
+
+
+def _is_exempt(view_func):
+    if getattr(view_func, "compression_exempt", False):
+        return True
+    view_class = getattr(view_func, "cls", None) or getattr(view_func, "view_class", None)
+    return getattr(view_class, "compression_exempt", False)
+
+
+def _compress_sequence(sequence, codec):
+    compress, finish = codec.stream()
+    for chunk in sequence:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+async def _compress_async_sequence(sequence, codec):
+    compress, finish = codec.stream()
+    async for chunk in sequence:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compress responses with gzip, brotli or zstd based on Accept-Encoding.
+    Responses under settings.COMPRESSION_MIN_SIZE are sent as-is. Streaming
+    responses are compressed chunk by chunk and flushed after each chunk, so
+    NDJSON lines reach the client as they are produced.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if _is_exempt(view_func):
+            request.compression_exempt = True
+
+    def process_response(self, request, response):
+        if getattr(request, "compression_exempt", False):
+            return response
+
+        # Avoid compressing if we've already got a content-encoding.
+        if response.has_header("Content-Encoding"):
+            return response
+
+        if not response.get("Content-Type", "").startswith(COMPRESSIBLE_TYPES):
+            return response
+
+        # It's not worth compressing small payloads.
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        encoding = negotiate_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None:
+            return response
+        codec = get_codec(encoding)
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = _compress_async_sequence(response.streaming_content, codec)
+            else:
+                response.streaming_content = _compress_sequence(response.streaming_content, codec)
+            # The compressed size is not known until the stream ends.
+            del response.headers["Content-Length"]
+        else:
+            compressed_content = codec.compress(response.content)
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response.headers["Content-Length"] = str(len(response.content))
+
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+        response.headers["Content-Encoding"] = encoding
+
+        return response
+
+
+class ReadRoutingMiddleware:
+    """
+    Keep read-your-writes for admins while tracking reads go to secondaries.
+    A successful admin write pins that client to the primary for
+    settings.MONGODB_PRIMARY_PIN_SECONDS with a signed cookie, and requests
+    carrying the pin run inside primary_reads().
+    """
+
+    SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with primary_reads(primary_pinned(request.COOKIES)):
+            response = self.get_response(request)
+        if request.method not in self.SAFE_METHODS and 200 <= response.status_code < 300 \
+                and getattr(getattr(request, "user", None), "is_admin", False):
+            pin_primary(response)
+        return response
+
+
+class RateLimitMiddleware(MiddlewareMixin):
+    """
+    Apply the token bucket policies of settings.RATE_LIMITS, keyed by URL name.
+    Limited routes get RateLimit-* headers, and a 429 with Retry-After once
+    their bucket is empty.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.policies = load_policies() if settings.RATE_LIMIT_ENABLED else {}
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        policy = self.policies.get(request.resolver_match.url_name)
+        if policy is None:
+            return None
+        decision = rate_limiter.check(policy, client_key(request, policy.key))
+        if decision is None:
+            return None
+        request.rate_limit = decision
+        if not decision.allowed:
+            return JsonResponse({"error": "Rate limit exceeded"}, status=429)
+        return None
+
+    def process_response(self, request, response):
+        decision = getattr(request, "rate_limit", None)
+        if decision is not None:
+            for header, value in decision.headers().items():
+                response.headers[header] = value
+        return response
+
@@ -0,0 +1,218 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+import mongoengine
+from django.conf import settings
+from django.core import signing
+from pymongo import monitoring
+from pymongo.read_preferences import Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest
+from monitoring.instrumentation import MongoTimingListener
+from monitoring.slow_queries import SlowQueryListener
+from monitoring.metrics import (
+    MONGO_POOL_CONNECTIONS, MONGO_POOL_CHECKED_OUT, MONGO_POOL_CHECKOUT_WAIT,
+    MONGO_POOL_CHECKOUT_FAILURES, MONGO_POOL_CLEARED
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# Set while the current request or consumer must read its own writes
+_primary_reads = ContextVar("primary_reads", default=False)
+
+PRIMARY_PIN_SALT = "logistics_backend.mongo.primary_pin"
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+# Wire compressors and whether their package is installed, zlib is built in
+COMPRESSORS = {
+    "zstd": zstandard is not None,
+    "snappy": snappy is not None,
+    "zlib": True,
+}
+
+
+def available_compressors():
+    """
+    Get the wire compressors from settings.MONGODB_COMPRESSORS that can be used.
+    Returns:
+        list: Compressor names in preference order.
+    """
+    return [name for name in settings.MONGODB_COMPRESSORS if COMPRESSORS.get(name)]
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """
+    Records connection pool statistics: open and checked out connections,
+    checkout wait time and checkout failures.
+    """
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        MONGO_POOL_CLEARED.inc(address=_address(event))
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.inc(address=_address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.dec(address=_address(event))
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_CHECKOUT_FAILURES.inc(address=_address(event), reason=str(event.reason))
+
+    def connection_checked_out(self, event):
+        address = _address(event)
+        MONGO_POOL_CHECKED_OUT.inc(address=address)
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            MONGO_POOL_CHECKOUT_WAIT.observe(duration, address=address)
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CHECKED_OUT.dec(address=_address(event))
+
+
+def _address(event):
+    host, port = event.address
+    return f"{host}:{port}"
+
+
+def event_listeners():
+    """
+    Build the listeners attached to every MongoClient.
+    Returns:
+        list: Command and pool listeners.
+    """
+    return [MongoTimingListener(), SlowQueryListener(), PoolMetricsListener()]
+
+
+def client_options():
+    """
+    Build the MongoClient options from settings.MONGODB_POOL.
+    Returns:
+        dict: Keyword arguments for MongoClient.
+    """
+    options = dict(settings.MONGODB_POOL)
+    compressors = available_compressors()
+    if compressors:
+        options["compressors"] = compressors
+    options["event_listeners"] = event_listeners()
+    return options
+
+
+def register_connections():
+    """
+    Register the Mongo connection with mongoengine without connecting.
+    The client and its pool are created on first use, so management commands
+    that never touch Mongo never connect and forked workers each get their own.
+    """
+    mongoengine.register_connection(
+        alias=settings.MONGODB_SETTINGS.get("alias", "default"),
+        db=settings.MONGODB_SETTINGS["db"],
+        host=settings.MONGODB_SETTINGS["host"],
+        **client_options()
+    )
+
+
+def read_preference(route=None):
+    """
+    Get the read preference for a kind of read.
+    Secondary reads are bounded by settings.MONGODB_MAX_STALENESS_SECONDS, and
+    everything reads from the primary inside primary_reads().
+    Args:
+        route: Name of the read route in settings.MONGODB_READ_ROUTES, e.g. "tracking".
+            None, or a route that is not configured, reads from the primary.
+    Returns:
+        The pymongo read preference.
+    """
+    mode = settings.MONGODB_READ_ROUTES.get(route, "primary") if route else "primary"
+    if mode == "primary" or _primary_reads.get():
+        return Primary()
+    max_staleness = settings.MONGODB_MAX_STALENESS_SECONDS
+    return READ_PREFERENCES[mode](max_staleness=max_staleness if max_staleness else -1)
+
+
+@contextmanager
+def primary_reads(enabled=True):
+    """
+    Send every read route to the primary for the duration of the block.
+    Args:
+        enabled: Whether to pin reads, so callers can pass a condition.
+    """
+    token = _primary_reads.set(enabled or _primary_reads.get())
+    try:
+        yield
+    finally:
+        _primary_reads.reset(token)
+
+
+def pin_primary(response):
+    """
+    Pin the client's reads to the primary for settings.MONGODB_PRIMARY_PIN_SECONDS,
+    long enough for its write to reach the secondaries.
+    Args:
+        response: The response to set the signed pin cookie on.
+    """
+    response.set_signed_cookie(
+        settings.MONGODB_PRIMARY_PIN_COOKIE, "1", salt=PRIMARY_PIN_SALT,
+        max_age=settings.MONGODB_PRIMARY_PIN_SECONDS, httponly=True, samesite="Lax"
+    )
+
+
+def primary_pinned(cookies):
+    """
+    Check whether a client carries a valid, unexpired primary pin.
+    Args:
+        cookies: The request cookies, request.COOKIES or scope["cookies"].
+    Returns:
+        bool: True if the client's reads must go to the primary.
+    """
+    value = cookies.get(settings.MONGODB_PRIMARY_PIN_COOKIE)
+    if not value:
+        return False
+    try:
+        signing.get_cookie_signer(salt=settings.MONGODB_PRIMARY_PIN_COOKIE + PRIMARY_PIN_SALT).unsign(
+            value, max_age=settings.MONGODB_PRIMARY_PIN_SECONDS
+        )
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def ping(alias=None):
+    """
+    Check that Mongo is reachable.
+    Args:
+        alias: The mongoengine connection alias, the default connection if None.
+    Returns:
+        float: The round trip time in seconds.
+    """
+    alias = alias or settings.MONGODB_SETTINGS.get("alias", "default")
+    start = time.perf_counter()
+    mongoengine.get_connection(alias).admin.command("ping")
+    return time.perf_counter() - start
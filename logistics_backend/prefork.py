@@ -0,0 +1,89 @@
+"""
+Support for preforking servers (see gunicorn.conf.py).
+
+The app is imported once in the master and the workers are forked from it,
+so the imports are paid once and the loaded modules are shared copy-on-write.
+Sockets must not be shared across the fork: every client created before it is
+dropped in the child (without closing it, the parent still owns the sockets)
+and recreated on first use.
+"""
+import gc
+import os
+import sys
+from django.conf import settings
+
+_installed = False
+
+
+def preload():
+    """
+    Import everything a worker needs in the master, then freeze the GC so the
+    preloaded objects are never touched by the children's collections and
+    their pages stay shared.
+    """
+    from django.urls import get_resolver
+    import deliveries.consumers  # noqa: F401
+
+    get_resolver().url_patterns  # imports every view
+    gc.freeze()
+
+
+def reset_after_fork():
+    """
+    Drop the clients inherited from the parent process.
+    Only modules that are already imported are reset, nothing is imported here.
+    """
+    connection = sys.modules.get("mongoengine.connection")
+    if connection is not None:
+        from mongoengine.base.common import _document_registry
+
+        for alias in list(connection._connections):
+            connection._connections.pop(alias, None)
+            connection._dbs.pop(alias, None)
+        for document in _document_registry.values():
+            if getattr(document, "_collection", None) is not None:
+                document._collection = None
+
+    redis_client = sys.modules.get("monitoring.redis_client")
+    if redis_client is not None:
+        redis_client.redis_circuit.reset()
+
+    redis_auth = sys.modules.get("users.utils.redis_auth")
+    if redis_auth is not None:
+        redis_auth.redis_token_manager.reset()
+
+    revocation = sys.modules.get("users.utils.revocation")
+    if revocation is not None:
+        revocation.revoked_tokens.reset()
+
+    ratelimit = sys.modules.get("logistics_backend.ratelimit")
+    if ratelimit is not None:
+        ratelimit.rate_limiter.reset()
+
+    events = sys.modules.get("deliveries.events")
+    if events is not None:
+        events.event_history.reset()
+
+    hot_state = sys.modules.get("deliveries.hot_state")
+    if hot_state is not None:
+        hot_state.hot_state.reset()
+
+    layers = sys.modules.get("channels.layers")
+    if layers is not None:
+        layers.channel_layers.backends.clear()
+
+    metrics = sys.modules.get("monitoring.metrics")
+    if metrics is not None:
+        metrics.REGISTRY.clear()
+        if settings.METRICS_MULTIPROCESS_DIR:
+            metrics.REGISTRY.start_snapshot_thread(settings.METRICS_MULTIPROCESS_DIR, settings.METRICS_SNAPSHOT_INTERVAL)
+
+
+def install():
+    """
+    Run reset_after_fork in every forked child. Safe to call more than once.
+    """
+    global _installed
+    if not _installed:
+        os.register_at_fork(after_in_child=reset_after_fork)
+        _installed = True
@@ -0,0 +1,286 @@
+"""
+Per-key token bucket rate limiting.
+
+The buckets live in Redis and are updated by a Lua script, so every worker
+shares the same limits. Workers don't ask Redis for every request: each one
+leases a small batch of tokens and spends it locally, and remembers a denial
+until the bucket refills, so most decisions are a dictionary lookup.
+"""
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+from django.conf import settings
+from monitoring.metrics import RATE_LIMIT_DECISIONS
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1]: bucket. ARGV: refill rate in tokens per second, burst, tokens wanted.
+# Grants up to the tokens wanted and returns {granted, tokens left, retry after ms}.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local wanted = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local granted = math.min(wanted, math.floor(tokens))
+tokens = tokens - granted
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+local retry_ms = 0
+if granted == 0 then
+    retry_ms = math.ceil((1 - tokens) / rate * 1000)
+end
+return {granted, tostring(tokens), retry_ms}
+"""
+
+PERIODS = {"s": 1, "sec": 1, "m": 60, "min": 60, "h": 3600, "hour": 3600}
+
+# Local leases kept per worker before expired ones are pruned
+MAX_LEASES = 10000
+
+
+def parse_rate(rate):
+    """
+    Parse a rate such as "60/m".
+    Args:
+        rate: "<requests>/<period>", the period one of s, m or h.
+    Returns:
+        tuple: (requests, period in seconds).
+    """
+    count, period = rate.split("/")
+    return int(count), PERIODS[period]
+
+
+class Policy:
+    """
+    A rate limit for one route.
+    Args:
+        name: Policy name, the URL name of the route it applies to.
+        rate: "<requests>/<period>", the sustained rate and the default burst.
+        burst: Requests allowed at once, the requests of the rate by default.
+        key: What the limit is per: "ip", "user" or "api_key".
+        lease: Tokens a worker takes from Redis at a time,
+            settings.RATE_LIMIT_LEASE of the burst by default.
+    """
+
+    def __init__(self, name, rate, burst=None, key="ip", lease=None):
+        count, period = parse_rate(rate)
+        self.name = name
+        self.refill_rate = count / period
+        self.burst = burst or count
+        self.key = key
+        self.lease = lease or max(1, int(self.burst * settings.RATE_LIMIT_LEASE))
+        self.header = f"{self.burst};w={period}"
+
+
+class Decision:
+    """
+    The outcome of a rate limit check, with the values for the RateLimit headers.
+    """
+
+    def __init__(self, policy, allowed, remaining, retry_after=0):
+        self.policy = policy
+        self.allowed = allowed
+        self.remaining = max(0, int(remaining))
+        self.retry_after = retry_after
+
+    def headers(self):
+        """
+        Returns:
+            dict: The RateLimit-* headers, and Retry-After when denied.
+        """
+        reset = math.ceil((self.policy.burst - self.remaining) / self.policy.refill_rate)
+        headers = {
+            "RateLimit-Limit": str(self.policy.burst),
+            "RateLimit-Remaining": str(self.remaining),
+            "RateLimit-Reset": str(max(reset, math.ceil(self.retry_after))),
+            "RateLimit-Policy": self.policy.header,
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class Lease:
+    __slots__ = ("tokens", "shared", "expires", "denied_until")
+
+    def __init__(self):
+        self.tokens = 0
+        self.shared = 0
+        self.expires = 0
+        self.denied_until = 0
+
+
+class RateLimiter:
+    """
+    Token buckets shared through Redis with a local pre-filter.
+    Leased tokens a worker doesn't spend within settings.RATE_LIMIT_LEASE_SECONDS
+    are dropped, so a worker never sits on tokens others could use for long.
+    If Redis is unreachable requests are let through.
+    """
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._redis_client = None
+        self._client_pid = None
+        self._script = None
+        self._redis_down_until = 0
+
+    @property
+    def redis_client(self):
+        """Redis client, created on first use and again in a forked worker"""
+        if self._redis_client is None or self._client_pid != os.getpid():
+            from monitoring.redis_client import create_client
+
+            self.redis_client = create_client()
+        return self._redis_client
+
+    @redis_client.setter
+    def redis_client(self, client):
+        self._redis_client = client
+        self._client_pid = os.getpid()
+        self._script = None
+
+    @property
+    def script(self):
+        """The token bucket script registered on the current client"""
+        client = self.redis_client
+        if self._script is None:
+            self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+        return self._script
+
+    def reset(self):
+        """Forget the local leases and drop the client without closing it"""
+        self._redis_client = None
+        self._script = None
+        self._leases = {}
+        self._redis_down_until = 0
+
+    def check(self, policy, key):
+        """
+        Take a token from the bucket of key under policy.
+        Args:
+            policy: The Policy to apply.
+            key: The client key, e.g. "ip:203.0.113.7".
+        Returns:
+            Decision: Whether the request is allowed, or None if Redis is unreachable.
+        """
+        bucket = f"ratelimit:{policy.name}:{key}"
+        now = time.monotonic()
+        with self._lock:
+            lease = self._leases.get(bucket)
+            if lease is not None:
+                if lease.denied_until > now:
+                    RATE_LIMIT_DECISIONS.inc(policy=policy.name, outcome="limited", source="local")
+                    return Decision(policy, False, 0, lease.denied_until - now)
+                if lease.tokens > 0 and lease.expires > now:
+                    lease.tokens -= 1
+                    RATE_LIMIT_DECISIONS.inc(policy=policy.name, outcome="allowed", source="local")
+                    return Decision(policy, True, lease.shared + lease.tokens)
+        if self._redis_down_until > now:
+            return None
+
+        try:
+            granted, tokens, retry_ms = self.script(
+                keys=[bucket], args=[policy.refill_rate, policy.burst, policy.lease]
+            )
+        except Exception as e:
+            logger.warning("Rate limiting disabled for 1s, Redis failed: %s", e)
+            self._redis_down_until = now + 1
+            return None
+
+        with self._lock:
+            if len(self._leases) >= MAX_LEASES:
+                self._prune(now)
+            lease = self._leases.setdefault(bucket, Lease())
+            lease.shared = int(float(tokens))
+            if granted:
+                lease.tokens = int(granted) - 1
+                lease.expires = now + settings.RATE_LIMIT_LEASE_SECONDS
+                lease.denied_until = 0
+                RATE_LIMIT_DECISIONS.inc(policy=policy.name, outcome="allowed", source="redis")
+                return Decision(policy, True, lease.shared + lease.tokens)
+            lease.tokens = 0
+            lease.denied_until = now + int(retry_ms) / 1000
+            RATE_LIMIT_DECISIONS.inc(policy=policy.name, outcome="limited", source="redis")
+            return Decision(policy, False, 0, int(retry_ms) / 1000)
+
+    def _prune(self, now):
+        for bucket in [bucket for bucket, lease in self._leases.items()
+                       if lease.expires <= now and lease.denied_until <= now]:
+            del self._leases[bucket]
+        if len(self._leases) >= MAX_LEASES:
+            self._leases.clear()
+
+
+rate_limiter = RateLimiter()
+
+
+def load_policies():
+    """
+    Build the policies in settings.RATE_LIMITS.
+    Returns:
+        dict: URL name to Policy.
+    """
+    return {name: Policy(name, **options) for name, options in settings.RATE_LIMITS.items()}
+
+
+def client_key(request, key):
+    """
+    Get the key a request is limited by.
+    Args:
+        request: The request.
+        key: "ip", "user" or "api_key". Anonymous requests and requests
+            without a key in settings.RATE_LIMIT_API_KEYS fall back to the
+            client IP, so made up keys don't get fresh buckets.
+    Returns:
+        str: The key, e.g. "user:<id>" or "ip:203.0.113.7".
+    """
+    if key == "api_key":
+        api_key = request.META.get("HTTP_X_API_KEY")
+        if api_key and api_key in settings.RATE_LIMIT_API_KEYS:
+            return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:32]
+    elif key == "user":
+        user_id = _user_id(request)
+        if user_id:
+            return f"user:{user_id}"
+    return "ip:" + client_ip(request)
+
+
+def client_ip(request):
+    """
+    Get the client IP, from settings.RATE_LIMIT_IP_HEADER behind a proxy.
+    The entries a client sends in the header come first, so the IP is the
+    one appended by the outermost of settings.RATE_LIMIT_TRUSTED_PROXIES.
+    Args:
+        request: The request.
+    Returns:
+        str: The IP, REMOTE_ADDR if the header has fewer entries than trusted proxies.
+    """
+    if settings.RATE_LIMIT_IP_HEADER:
+        forwarded = [hop.strip() for hop in request.META.get(settings.RATE_LIMIT_IP_HEADER, "").split(",")]
+        trusted = settings.RATE_LIMIT_TRUSTED_PROXIES
+        if trusted > 0 and len(forwarded) >= trusted and forwarded[-trusted]:
+            return forwarded[-trusted]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def _user_id(request):
+    # Only the signature is checked, whether the token was revoked is up to the view
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    if not header.startswith("Bearer "):
+        return None
+    import jwt
+
+    try:
+        return jwt.decode(header[7:], settings.JWT_SECRET_KEY, algorithms=["HS256"]).get("user_id")
+    except jwt.InvalidTokenError:
+        return None
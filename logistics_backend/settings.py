@@ -40,11 +40,17 @@ INSTALLED_APPS = [
     "django.contrib.staticfiles",
     'rest_framework',
     'channels',
+    'monitoring',
     'deliveries',
     'users',
 ]
 
 MIDDLEWARE = [
+    "monitoring.middleware.MetricsMiddleware",
+    "monitoring.middleware.RequestTimingMiddleware",
+    "monitoring.middleware.ProfilerMiddleware",
+    "logistics_backend.middleware.RateLimitMiddleware",
+    "logistics_backend.middleware.CompressionMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -52,10 +58,50 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "logistics_backend.middleware.ReadRoutingMiddleware",
 ]
 
 ROOT_URLCONF = "logistics_backend.urls"
 
+# Response compression
+COMPRESSION_MIN_SIZE = 1024  # bytes, smaller responses are sent as-is
+COMPRESSION_ENCODINGS = ['zstd', 'br', 'gzip']  # server preference, codecs that are not installed are skipped
+COMPRESSION_LEVELS = {
+    'gzip': 6,
+    'br': 4,
+    'zstd': 3,
+}
+
+# Fraction of requests timed by monitoring.middleware.RequestTimingMiddleware,
+# sampled responses carry a Server-Timing header
+REQUEST_TIMING_SAMPLE_RATE = 1.0 if DEBUG else 0.01
+
+# Map provider key passed to the delivery tracker page
+MAPS_API_KEY = os.environ.get('MAPS_API_KEY', '')
+
+# Metrics exposed on /metrics. With several workers, point METRICS_MULTIPROCESS_DIR
+# at a directory shared by them; every worker writes a snapshot there every
+# METRICS_SNAPSHOT_INTERVAL seconds and /metrics merges them.
+METRICS_MULTIPROCESS_DIR = os.environ.get('METRICS_MULTIPROCESS_DIR')
+METRICS_SNAPSHOT_INTERVAL = 5  # seconds
+# Snapshots not written for this long are deleted, their worker is gone. Their
+# counters and histograms are kept in retired.json in the same directory.
+METRICS_SNAPSHOT_MAX_AGE = 3600  # seconds
+# Addresses and networks that may scrape /metrics without a token, admins may always
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Mongo commands slower than this are recorded in the slow_queries collection,
+# new shapes are explained once when SLOW_QUERY_EXPLAIN is on
+SLOW_QUERY_THRESHOLD_MS = 100
+SLOW_QUERY_EXPLAIN = True
+
+# Sampling profiler, see monitoring.profiler. Profiles go to PROFILER_OUTPUT_DIR.
+# SIGURG is ignored by default, so signalling a process without the handler is harmless.
+PROFILER_OUTPUT_DIR = os.path.join(BASE_DIR, 'logs', 'profiles')
+PROFILER_INTERVAL = 0.005  # seconds between samples
+PROFILER_DEFAULT_DURATION = 30  # seconds
+PROFILER_SIGNAL = 'SIGURG'
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -81,10 +127,37 @@ ASGI_APPLICATION = "logistics_backend.asgi.application"
 REDIS_HOST = 'localhost'
 REDIS_PORT = 6379
 REDIS_DB = 0
+# Seconds a Redis command or connect may take before it fails. Tight, so an unreachable
+# Redis costs a request a fraction of a second rather than the OS TCP timeout.
+REDIS_SOCKET_TIMEOUT = 0.25
+REDIS_CONNECT_TIMEOUT = 0.25
+# Connection errors or timeouts in a row after which Redis commands fail at once, and the
+# seconds until one command is let through to check whether Redis is back
+REDIS_CIRCUIT_FAILURES = 5
+REDIS_CIRCUIT_RESET_SECONDS = 2
 
 # JWT settings
 JWT_SECRET_KEY = 'your-secret-key'  # Change this in production
 JWT_TTL_DAYS = 30
+# Token lifetime, lower it to hand out short-lived tokens that clients renew at /api/v1/users/refresh/
+JWT_TTL_SECONDS = JWT_TTL_DAYS * 86400
+# 'redis' checks every token in Redis. 'stateless' verifies tokens locally and checks
+# their jti against the revoked tokens each worker follows from AUTH_REVOCATION_STREAM.
+AUTH_TOKEN_MODE = 'redis'
+# Also look tokens up under their old token:<JWT> keys, moving them to the jti keys on
+# first use. Turn off once `python manage.py migrate_tokens` has run.
+AUTH_LEGACY_TOKEN_KEYS = True
+AUTH_REVOCATION_STREAM = 'auth:revoked'
+# Keep the revoked jtis in a Bloom filter instead of a dict, hits are confirmed in Redis,
+# e.g. {'capacity': 1000000, 'error_rate': 0.001}. The filter is rebuilt from the stream periodically.
+AUTH_REVOCATION_BLOOM = None
+AUTH_REVOCATION_REBUILD_SECONDS = 3600
+# What 'redis' mode does with a token it can't look up because Redis is unreachable.
+# 'reject' rejects it. 'trust_jwt' accepts it if its signature and expiry check out and this
+# worker doesn't know it as revoked, for the first AUTH_OUTAGE_TRUST_SECONDS of the outage.
+# Tokens logged out shortly before or during the outage may be accepted meanwhile.
+AUTH_OUTAGE_POLICY = 'trust_jwt'
+AUTH_OUTAGE_TRUST_SECONDS = 300
 
 # MongoDB settings
 MONGODB_HOST = 'localhost'
@@ -97,6 +170,57 @@ MONGODB_SETTINGS = {
     'alias': 'default'
 }
 
+# MongoClient options, see logistics_backend.mongo
+MONGODB_POOL = {
+    'maxPoolSize': 100,
+    'minPoolSize': 0,
+    'maxIdleTimeMS': 60000,
+    'waitQueueTimeoutMS': 2000,  # fail fast instead of queueing forever when the pool is exhausted
+    'serverSelectionTimeoutMS': 5000,
+    'connectTimeoutMS': 5000,
+    'socketTimeoutMS': 30000,
+    'readPreference': 'primary',
+    'retryWrites': True,
+    'retryReads': True,
+}
+# Wire compression in preference order, compressors that are not installed are skipped
+MONGODB_COMPRESSORS = ['zstd', 'snappy', 'zlib']
+# Read preference per kind of read, everything else reads from the primary
+MONGODB_READ_ROUTES = {
+    'tracking': 'secondaryPreferred',  # public tracking polls and WebSocket snapshots
+}
+# Skip secondaries lagging more than this behind the primary (90 is the smallest Mongo accepts, 0 disables)
+MONGODB_MAX_STALENESS_SECONDS = 90
+# After an admin write, that client reads from the primary for this long so it sees its own write
+MONGODB_PRIMARY_PIN_SECONDS = 5
+MONGODB_PRIMARY_PIN_COOKIE = 'mongo_primary'
+
+# Token bucket rate limits per URL name, see logistics_backend.ratelimit.
+# rate is "<requests>/<s|m|h>", burst defaults to the requests of the rate,
+# key is what the limit applies to: "ip", "user" or "api_key" (X-API-Key header,
+# only keys in RATE_LIMIT_API_KEYS, others are limited by IP).
+RATE_LIMIT_ENABLED = True
+RATE_LIMITS = {
+    'delivery_detail': {'rate': '120/m', 'key': 'ip'},
+    'delivery_tracker': {'rate': '60/m', 'key': 'ip'},
+    'login': {'rate': '10/m', 'key': 'ip'},
+    'refresh': {'rate': '30/m', 'key': 'user'},
+    'register': {'rate': '5/m', 'key': 'ip'},
+}
+# Share of the burst a worker takes from Redis at a time, and how long it may keep it
+RATE_LIMIT_LEASE = 0.1
+RATE_LIMIT_LEASE_SECONDS = 1.0
+# Header holding the client IP when behind a proxy, e.g. 'HTTP_X_FORWARDED_FOR'
+RATE_LIMIT_IP_HEADER = None
+# Trusted proxies appending to RATE_LIMIT_IP_HEADER, the client IP is the entry
+# this many from the right, entries left of it may be forged by the client
+RATE_LIMIT_TRUSTED_PROXIES = 1
+# X-API-Key values that get a bucket of their own
+RATE_LIMIT_API_KEYS = []
+
+# Read path for delivery queries: 'raw' (pymongo cursors) or 'document' (mongoengine)
+DELIVERY_READ_PATH = 'raw'
+
 # Channel layer settings
 CHANNEL_LAYERS = {
     'default': {
@@ -107,6 +231,50 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Delivery events are written to each delivery's outbox and published by
+# `python manage.py relay_outbox`: deliveries per batch, and seconds between polls while idle
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 0.2
+# Most events kept in a delivery's outbox, the oldest are dropped while no relay runs
+OUTBOX_MAX_EVENTS = 1000
+# `python manage.py relay_changes` turns changes made outside the API into the same events and
+# publishes the ids of changed deliveries on DELIVERY_INVALIDATION_CHANNEL (Redis pub/sub).
+# Changes per batch, seconds to wait for a batch to fill, and where resume tokens are saved.
+CHANGE_STREAM_BATCH_SIZE = 500
+CHANGE_STREAM_MAX_WAIT = 0.1
+CHANGE_STREAM_CHECKPOINTS = 'relay_checkpoints'
+# Deletions can only be routed with the deleted document: needs MongoDB 6.0 and
+# `db.runCommand({collMod: 'deliveries', changeStreamPreAndPostImages: {enabled: true}})`
+CHANGE_STREAM_PRE_IMAGES = True
+DELIVERY_INVALIDATION_CHANNEL = 'deliveries:invalidate'
+# The relays send at most one location update per delivery every
+# BROADCAST_LOCATION_INTERVAL seconds (0 sends all), the latest one, as a delta
+# of the last event sent, with a full snapshot at least every BROADCAST_DELTA_WINDOW seconds
+BROADCAST_LOCATION_INTERVAL = 1.0
+BROADCAST_DELTA_WINDOW = 60
+# Server-Sent Events: seconds between heartbeat comments, the reconnect delay
+# sent to clients in milliseconds, and the events kept per delivery and customer
+# for Last-Event-ID resume, dropped SSE_HISTORY_TTL seconds after the last one
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 3000
+SSE_HISTORY_LENGTH = 100
+SSE_HISTORY_TTL = 3600
+# Hot state of active deliveries in Redis (deliveries.hot_state). HOT_STATE_DURABILITY is
+# the most seconds a change to each field may live in Redis only before
+# `python manage.py flush_hot_state` writes it to Mongo, 0 writes it through in the
+# request. Hashes expire HOT_STATE_TTL seconds after the last change, and the flusher
+# polls every HOT_STATE_FLUSH_INTERVAL seconds and writes up to
+# HOT_STATE_FLUSH_BATCH_SIZE deliveries per bulk write
+HOT_STATE_ENABLED = True
+HOT_STATE_DURABILITY = {
+    'status': 0,
+    'current_location': 1.0,
+    'last_updated': 1.0,
+}
+HOT_STATE_TTL = 3600
+HOT_STATE_FLUSH_INTERVAL = 0.2
+HOT_STATE_FLUSH_BATCH_SIZE = 500
+
 WSGI_APPLICATION = "logistics_backend.wsgi.application"
 
 
@@ -127,6 +295,18 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [],
+    'DEFAULT_RENDERER_CLASSES': [
+        'deliveries.renderers.FastJSONRenderer',
+        'deliveries.renderers.MessagePackRenderer',
+        'deliveries.renderers.NDJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'deliveries.parsers.FastJSONParser',
+        'deliveries.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'EXCEPTION_HANDLER': 'rest_framework.views.exception_handler',
     'UNAUTHENTICATED_USER': None,
     'NON_FIELD_ERRORS_KEY': 'error',
@@ -222,5 +402,10 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'monitoring': {
+            'handlers': ['file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
@@ -0,0 +1,230 @@
+import os
+import json
+import sys
+import uuid
+import subprocess
+import jwt
+import pytest
+from django.conf import settings
+from django.test import Client, RequestFactory
+from pymongo import MongoClient, WriteConcern, monitoring
+from logistics_backend.mongo import read_preference, primary_reads
+from logistics_backend.ratelimit import Policy, RateLimiter, rate_limiter, client_key
+
+# Startup budget for `django.setup()`, override with IMPORT_TIME_BUDGET_MS on slow machines
+IMPORT_TIME_BUDGET_MS = int(os.environ.get("IMPORT_TIME_BUDGET_MS", 1000))
+
+# Modules that only requests need, importing them at setup slows every manage.py call
+LAZY_MODULES = ["redis", "jwt", "bcrypt", "msgpack", "channels_redis", "rest_framework.views", "users.utils.redis_auth"]
+
+SETUP_SCRIPT = """
+import sys, json, django
+django.setup()
+from mongoengine import connection
+print(json.dumps({
+    "imported": [name for name in %r if name in sys.modules],
+    "mongo_clients": list(connection._connections),
+}))
+""" % (LAZY_MODULES,)
+
+
+def run_setup():
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE="logistics_backend.settings")
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SETUP_SCRIPT],
+        cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def import_time_ms(stderr):
+    """Sum the cumulative import time of the top-level imports in -X importtime output"""
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            total += int(cumulative)
+    return total / 1000
+
+
+@pytest.fixture(scope="module")
+def setup_run():
+    return run_setup()
+
+
+def test_setup_does_not_connect(setup_run):
+    """Test that django.setup() neither imports the heavy clients nor connects to Mongo"""
+    result = json.loads(setup_run.stdout.strip().splitlines()[-1])
+    assert result["imported"] == []
+    assert result["mongo_clients"] == []
+
+
+def test_import_time_budget(setup_run):
+    """Test that django.setup() imports stay within the time budget"""
+    elapsed = import_time_ms(setup_run.stderr)
+    assert elapsed < IMPORT_TIME_BUDGET_MS, f"django.setup() imports took {elapsed:.0f}ms"
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_clients_reset_after_fork():
+    """Test that a forked worker creates its own Mongo and Redis clients"""
+    from mongoengine import connection
+    from deliveries.mongo.delivery import Delivery
+    from users.utils.redis_auth import redis_token_manager
+
+    Delivery.objects.count()
+    redis_token_manager.redis_client.ping()
+    assert connection._connections
+
+    pid = os.fork()
+    if pid == 0:
+        ok = not connection._connections and Delivery._collection is None \
+            and redis_token_manager._redis_client is None
+        os._exit(0 if ok else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    assert connection._connections
+
+
+# Replica set tests run against a local replica set, e.g.
+# mongod --replSet rs0 ... then MONGODB_REPLICA_SET_URI=mongodb://localhost:27017,localhost:27018/?replicaSet=rs0
+REPLICA_SET_URI = os.environ.get("MONGODB_REPLICA_SET_URI")
+replica_set = pytest.mark.skipif(not REPLICA_SET_URI, reason="MONGODB_REPLICA_SET_URI not set")
+
+
+class CommandAddresses(monitoring.CommandListener):
+    def __init__(self):
+        self.addresses = []
+
+    def started(self, event):
+        if event.command_name == "find":
+            self.addresses.append(event.connection_id)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@pytest.fixture
+def replica_collection():
+    listener = CommandAddresses()
+    client = MongoClient(REPLICA_SET_URI, event_listeners=[listener])
+    collection = client.get_database("logistics_replica_test").deliveries
+    collection.delete_many({})
+    yield client, collection, listener
+    client.drop_database("logistics_replica_test")
+    client.close()
+
+
+@replica_set
+def test_tracking_reads_go_to_secondaries(replica_collection, settings):
+    """Test that tracking reads are sent to a secondary of the replica set"""
+    settings.MONGODB_READ_ROUTES = {"tracking": "secondary"}
+    client, collection, listener = replica_collection
+    collection.with_options(write_concern=WriteConcern(w="majority")).insert_one({"delivery_id": "RS1"})
+
+    collection.with_options(read_preference=read_preference("tracking")).find_one({"delivery_id": "RS1"})
+    assert listener.addresses[-1] in client.secondaries
+
+
+@replica_set
+def test_primary_pin_reads_own_writes(replica_collection, settings):
+    """Test that reads inside primary_reads() see a write the secondaries may not have yet"""
+    settings.MONGODB_READ_ROUTES = {"tracking": "secondaryPreferred"}
+    client, collection, listener = replica_collection
+    # w=1 returns before the secondaries have the write
+    collection.insert_one({"delivery_id": "RS2", "status": "pending"})
+    collection.update_one({"delivery_id": "RS2"}, {"$set": {"status": "delivered"}})
+
+    with primary_reads():
+        delivery = collection.with_options(read_preference=read_preference("tracking")).find_one({"delivery_id": "RS2"})
+    assert listener.addresses[-1] == client.primary
+    assert delivery["status"] == "delivered"
+
+
+@pytest.fixture
+def rate_limits(settings):
+    settings.RATE_LIMIT_ENABLED = True
+    settings.RATE_LIMITS = {"login": {"rate": "3/m", "key": "ip", "lease": 1}}
+    rate_limiter.reset()
+    yield settings
+    rate_limiter.reset()
+
+
+def test_rate_limit_headers_and_429(rate_limits):
+    """Test the RateLimit headers and the 429 once the bucket is empty"""
+    # A fresh client IP per run, the buckets outlive the test in Redis
+    rate_limits.RATE_LIMIT_IP_HEADER = "HTTP_X_FORWARDED_FOR"
+    client = Client(HTTP_X_FORWARDED_FOR=str(uuid.uuid4()))
+    remaining = []
+    for _ in range(3):
+        response = client.post("/api/v1/users/login/", {}, content_type="application/json")
+        assert response.status_code == 400
+        remaining.append(response["RateLimit-Remaining"])
+    assert remaining == ["2", "1", "0"]
+    assert response["RateLimit-Limit"] == "3"
+    assert response["RateLimit-Policy"] == "3;w=60"
+
+    response = client.post("/api/v1/users/login/", {}, content_type="application/json")
+    assert response.status_code == 429
+    assert response.json() == {"error": "Rate limit exceeded"}
+    assert int(response["Retry-After"]) > 0
+
+
+def test_rate_limit_leases_tokens_locally(rate_limits):
+    """Test that tokens are leased from Redis in batches and spent locally"""
+    limiter = RateLimiter()
+    policy = Policy("lease-test", "10/m", lease=5)
+    script = limiter.script
+    calls = []
+    limiter._script = lambda **kwargs: calls.append(kwargs) or script(**kwargs)
+
+    key = f"ip:{uuid.uuid4()}"
+    assert all(limiter.check(policy, key).allowed for _ in range(10))
+    assert len(calls) == 2
+    assert not limiter.check(policy, key).allowed
+    assert not limiter.check(policy, key).allowed
+    assert len(calls) == 3
+
+
+def test_rate_limit_fails_open(rate_limits):
+    """Test that requests are let through while Redis is unreachable"""
+    limiter = RateLimiter()
+    limiter._client_pid = os.getpid()
+    limiter._redis_client = object()
+
+    def unreachable(**kwargs):
+        raise ConnectionError("unreachable")
+
+    limiter._script = unreachable
+    assert limiter.check(Policy("down", "1/m"), "ip:203.0.113.1") is None
+
+
+def test_rate_limit_client_key(rate_limits):
+    """Test the bucket keys for IPs, API keys and users"""
+    rate_limits.RATE_LIMIT_API_KEYS = ["secret"]
+    request = RequestFactory().get("/", REMOTE_ADDR="203.0.113.9", HTTP_X_API_KEY="secret")
+    assert client_key(request, "ip") == "ip:203.0.113.9"
+    assert client_key(request, "api_key").startswith("key:")
+    assert client_key(request, "user") == "ip:203.0.113.9"
+    # Unknown keys share the IP's bucket
+    request = RequestFactory().get("/", REMOTE_ADDR="203.0.113.9", HTTP_X_API_KEY=str(uuid.uuid4()))
+    assert client_key(request, "api_key") == "ip:203.0.113.9"
+
+    token = jwt.encode({"user_id": "u1"}, settings.JWT_SECRET_KEY, algorithm="HS256")
+    request = RequestFactory().get("/", HTTP_AUTHORIZATION=f"Bearer {token}")
+    assert client_key(request, "user") == "user:u1"
+
+
+def test_rate_limit_client_ip_from_trusted_proxies(rate_limits):
+    """Test the client IP is taken past the configured number of trusted proxies"""
+    rate_limits.RATE_LIMIT_IP_HEADER = "HTTP_X_FORWARDED_FOR"
+    request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.2", HTTP_X_FORWARDED_FOR="198.51.100.1, 203.0.113.9, 10.0.0.1")
+    assert client_key(request, "ip") == "ip:10.0.0.1"
+    rate_limits.RATE_LIMIT_TRUSTED_PROXIES = 2
+    assert client_key(request, "ip") == "ip:203.0.113.9"
+    rate_limits.RATE_LIMIT_TRUSTED_PROXIES = 4
+    assert client_key(request, "ip") == "ip:10.0.0.2"
@@ -17,9 +17,12 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
+from monitoring.views import metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/v1/users/', include('users.urls')),
     path('api/v1/deliveries/', include('deliveries.urls')),
+    path('api/v1/monitoring/', include('monitoring.urls')),
+    path('metrics', metrics, name='metrics'),
 ]
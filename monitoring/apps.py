@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class MonitoringConfig(AppConfig):
+    default_auto_field = "django.db.models.BigAutoField"
+    name = "monitoring"
+
+    def ready(self):
+        from monitoring.metrics import REGISTRY
+        from monitoring.profiler import install_signal_handler
+
+        if settings.METRICS_MULTIPROCESS_DIR:
+            REGISTRY.start_snapshot_thread(settings.METRICS_MULTIPROCESS_DIR, settings.METRICS_SNAPSHOT_INTERVAL)
+
+        install_signal_handler()
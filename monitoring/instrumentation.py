@@ -0,0 +1,25 @@
+from pymongo import monitoring
+from monitoring.timing import current_timing
+from monitoring.metrics import MONGO_COMMAND_LATENCY, MONGO_COMMAND_FAILURES
+
+
+class MongoTimingListener(monitoring.CommandListener):
+    """
+    Records the server round trip of every Mongo command, in the metrics and
+    in the current request. pymongo publishes the events on the thread that
+    ran the command, so the request context is still the active one.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        duration = event.duration_micros / 1e6
+        MONGO_COMMAND_LATENCY.observe(duration, command=event.command_name)
+        timing = current_timing()
+        if timing is not None:
+            timing.add("mongo", duration)
+
+    def failed(self, event):
+        MONGO_COMMAND_FAILURES.inc(command=event.command_name)
+        self.succeeded(event)
@@ -0,0 +1,31 @@
+import os
+import json
+import signal
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from monitoring.profiler import control_file
+
+
+class Command(BaseCommand):
+    help = "Profile running worker processes with the stack sampler for a number of seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument("pids", nargs="+", type=int, help="Worker process IDs")
+        parser.add_argument("--duration", type=float, default=settings.PROFILER_DEFAULT_DURATION,
+                            help="Seconds to profile for")
+        parser.add_argument("--interval", type=float, default=settings.PROFILER_INTERVAL,
+                            help="Seconds between samples")
+
+    def handle(self, *args, **options):
+        signum = getattr(signal, settings.PROFILER_SIGNAL)
+        os.makedirs(settings.PROFILER_OUTPUT_DIR, exist_ok=True)
+        for pid in options["pids"]:
+            with open(control_file(pid), "w") as f:
+                json.dump({"duration": options["duration"], "interval": options["interval"]}, f)
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                os.remove(control_file(pid))
+                raise CommandError(f"No process {pid}")
+            self.stdout.write(f"Profiling {pid} for {options['duration']}s")
+        self.stdout.write(f"Profiles will be written to {settings.PROFILER_OUTPUT_DIR}")
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from monitoring.mongo.slow_query import SlowQuery
+from monitoring.slow_queries import top_slow_queries
+
+
+class Command(BaseCommand):
+    help = "Show the slowest Mongo query shapes recorded by the slow query listener"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=20, help="Number of shapes to show")
+        parser.add_argument("--sort", default="total_ms", choices=["total_ms", "max_ms", "count"])
+        parser.add_argument("--reset", action="store_true", help="Delete all recorded shapes")
+
+    def handle(self, *args, **options):
+        if options["reset"]:
+            SlowQuery.objects.delete()
+            self.stdout.write("Slow query shapes deleted")
+            return
+
+        try:
+            queries = top_slow_queries(options["limit"], options["sort"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not queries:
+            self.stdout.write("No slow queries recorded")
+            return
+
+        self.stdout.write(f"{'count':>7} {'mean ms':>9} {'max ms':>9} {'total ms':>11}  shape")
+        for query in queries:
+            self.stdout.write(
+                f"{query['count']:>7} {query['mean_ms']:>9.1f} {query['max_ms']:>9.1f} "
+                f"{query['total_ms']:>11.1f}  {query['shape_key']}"
+            )
+            self.stdout.write(f"{'':>40}plan: {query['plan_summary'] or 'not explained'}")
+            self.stdout.write(f"{'':>40}views: {', '.join(query['views'])}")
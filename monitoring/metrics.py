@@ -0,0 +1,488 @@
+import os
+import json
+import time
+import bisect
+import fcntl
+import logging
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    Base class for metrics.
+    Every thread records into its own shard, so the recording path takes no
+    lock. The shards are only merged when the metrics are collected.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = {}
+            with self._shards_lock:
+                self._shards.append(values)
+            self._local.values = values
+            return values
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _merge(self, total, value):
+        return total + value
+
+    def collect(self):
+        """
+        Merge all thread shards.
+        Returns:
+            dict: Label values tuple to the metric value.
+        """
+        with self._shards_lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                merged[key] = self._merge(merged[key], value) if key in merged else self._copy(value)
+        return merged
+
+    def _copy(self, value):
+        return value
+
+    def clear(self):
+        with self._shards_lock:
+            for shard in self._shards:
+                shard.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge recorded as per-thread deltas, or computed on collection by function.
+    multiprocess_mode says how values of several workers are combined: "sum" or "max".
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None, multiprocess_mode="sum"):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+        self.multiprocess_mode = multiprocess_mode
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def collect(self):
+        if self.function is not None:
+            return self.function()
+        return super().collect()
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets.
+    Values are stored as per-bucket counts followed by the sum of observations.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def time(self, **labels):
+        return _HistogramTimer(self, labels)
+
+    def _merge(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def _copy(self, value):
+        return list(value)
+
+
+class _HistogramTimer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    """
+    Holds the metrics of this process and renders them for Prometheus.
+    With settings.METRICS_MULTIPROCESS_DIR set, every worker writes a snapshot
+    of its metrics there and the /metrics view merges the snapshots of all workers.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._snapshot_thread = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None, multiprocess_mode="sum"):
+        return self.register(Gauge(name, documentation, labelnames, function, multiprocess_mode))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def clear(self):
+        """
+        Reset every metric of this process, e.g. in a freshly forked worker.
+        """
+        for metric in self.metrics.values():
+            metric.clear()
+
+    def snapshot(self):
+        """
+        Collect every metric of this process.
+        Returns:
+            dict: Metric name to a list of [label values, value] pairs, JSON serializable.
+        """
+        return {
+            name: [[list(key), value] for key, value in metric.collect().items()]
+            for name, metric in self.metrics.items()
+        }
+
+    def write_snapshot(self, directory):
+        """
+        Atomically write this worker's snapshot to directory/<pid>.json.
+        """
+        os.makedirs(directory, exist_ok=True)
+        _write_json(os.path.join(directory, f"{os.getpid()}.json"), {"pid": os.getpid(), "metrics": self.snapshot()})
+
+    def start_snapshot_thread(self, directory, interval):
+        """
+        Write a snapshot every interval seconds from a daemon thread.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.write_snapshot(directory)
+                except OSError as e:
+                    logger.warning("Could not write metrics snapshot: %s", e)
+
+        self._snapshot_thread = threading.Thread(target=run, name="metrics-snapshot", daemon=True)
+        self._snapshot_thread.start()
+
+    def merged_snapshot(self, directory):
+        """
+        Merge the snapshots of all workers with the live metrics of this one.
+        Gauges of workers that are no longer running are dropped. Once a
+        snapshot is older than settings.METRICS_SNAPSHOT_MAX_AGE, its counters
+        and histograms are folded into directory/retired.json and it is
+        deleted, so the merged totals never go down.
+        Args:
+            directory: The multiprocess snapshot directory.
+        Returns:
+            dict: Same shape as snapshot().
+        """
+        snapshots = [(True, self.snapshot())]
+        if os.path.isdir(directory):
+            # Workers serving /metrics at once must not fold a snapshot twice
+            with open(os.path.join(directory, "retired.lock"), "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                snapshots.extend(self._read_snapshots(directory))
+
+        merged = {name: {} for name in self.metrics}
+        for alive, snapshot in snapshots:
+            self._merge_snapshot(merged, snapshot, alive)
+        return {name: list(samples.items()) for name, samples in merged.items()}
+
+    def _read_snapshots(self, directory):
+        retired_path = os.path.join(directory, "retired.json")
+        retired = {}
+        self._merge_snapshot(retired, _read_json(retired_path) or {}, alive=False)
+        snapshots = []
+        expired = []
+        oldest = time.time() - settings.METRICS_SNAPSHOT_MAX_AGE
+        for filename in os.listdir(directory):
+            if not filename.endswith(".json") or filename in ("retired.json", f"{os.getpid()}.json"):
+                continue
+            path = os.path.join(directory, filename)
+            data = _read_json(path)
+            try:
+                # Live workers rewrite theirs every METRICS_SNAPSHOT_INTERVAL
+                stale = os.path.getmtime(path) < oldest
+            except OSError:
+                continue
+            if stale:
+                expired.append(path)
+                if data is not None:
+                    self._merge_snapshot(retired, data["metrics"], alive=False)
+            elif data is not None:
+                snapshots.append((_pid_alive(data["pid"]), data["metrics"]))
+
+        retired = {name: [[list(key), value] for key, value in samples.items()] for name, samples in retired.items()}
+        if expired:
+            try:
+                _write_json(retired_path, retired)
+                for path in expired:
+                    os.remove(path)
+            except OSError as e:
+                # The expired snapshots are folded again on the next try
+                logger.warning("Could not retire metrics snapshots: %s", e)
+        return [(False, retired)] + snapshots
+
+    def _merge_snapshot(self, merged, snapshot, alive):
+        for name, samples in snapshot.items():
+            metric = self.metrics.get(name)
+            if metric is None or (metric.kind == "gauge" and not alive):
+                continue
+            totals = merged.setdefault(name, {})
+            for key, value in samples:
+                key = tuple(key)
+                if key not in totals:
+                    totals[key] = metric._copy(value)
+                elif metric.kind == "gauge" and metric.multiprocess_mode == "max":
+                    totals[key] = max(totals[key], value)
+                else:
+                    totals[key] = metric._merge(totals[key], value)
+
+    def exposition(self):
+        """
+        Render all metrics in the Prometheus text format.
+        Returns:
+            str: The exposition text.
+        """
+        directory = getattr(settings, "METRICS_MULTIPROCESS_DIR", None)
+        if directory:
+            snapshot = self.merged_snapshot(directory)
+        else:
+            snapshot = {name: list(metric.collect().items()) for name, metric in self.metrics.items()}
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(snapshot.get(name, []), key=lambda sample: tuple(sample[0])):
+                labels = list(zip(metric.labelnames, key))
+                if metric.kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets + (float("inf"),), value):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(float(bound))
+                        lines.append(f"{name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.histogram(
+    "http_request_duration_seconds", "HTTP request latency by URL name.", ("url_name", "method", "status")
+)
+MONGO_COMMAND_LATENCY = REGISTRY.histogram(
+    "mongo_command_duration_seconds", "MongoDB command round trip time.", ("command",)
+)
+MONGO_COMMAND_FAILURES = REGISTRY.counter(
+    "mongo_command_failures_total", "MongoDB commands that failed.", ("command",)
+)
+MONGO_POOL_CONNECTIONS = REGISTRY.gauge(
+    "mongo_pool_connections", "Open connections in the MongoDB pool.", ("address",)
+)
+MONGO_POOL_CHECKED_OUT = REGISTRY.gauge(
+    "mongo_pool_checked_out", "MongoDB connections currently checked out.", ("address",)
+)
+MONGO_POOL_CHECKOUT_WAIT = REGISTRY.histogram(
+    "mongo_pool_checkout_wait_seconds", "Time spent waiting for a MongoDB connection.", ("address",)
+)
+MONGO_POOL_CHECKOUT_FAILURES = REGISTRY.counter(
+    "mongo_pool_checkout_failures_total", "MongoDB connection checkouts that failed.", ("address", "reason")
+)
+MONGO_POOL_CLEARED = REGISTRY.counter(
+    "mongo_pool_cleared_total", "Times the MongoDB pool was cleared after an error.", ("address",)
+)
+REDIS_COMMAND_LATENCY = REGISTRY.histogram(
+    "redis_command_duration_seconds", "Redis command round trip time.", ("command",)
+)
+REDIS_COMMAND_FAILURES = REGISTRY.counter(
+    "redis_command_failures_total", "Redis commands that raised.", ("command",)
+)
+REDIS_CIRCUIT_OPENED = REGISTRY.counter(
+    "redis_circuit_opened_total", "Times a Redis circuit breaker opened.", ("circuit",)
+)
+REDIS_CIRCUIT_REJECTIONS = REGISTRY.counter(
+    "redis_circuit_rejections_total", "Redis commands failed at once by an open circuit.", ("circuit",)
+)
+TOKEN_VALIDATIONS = REGISTRY.counter(
+    "token_validations_total", "Token validations by outcome.", ("outcome",)
+)
+BCRYPT_IN_FLIGHT = REGISTRY.gauge(
+    "bcrypt_in_flight", "bcrypt hashes and checks currently running.", ("operation",)
+)
+BCRYPT_LATENCY = REGISTRY.histogram(
+    "bcrypt_duration_seconds", "Time spent in bcrypt.", ("operation",),
+    buckets=(0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5, 5.0)
+)
+WEBSOCKET_CONNECTIONS = REGISTRY.gauge(
+    "websocket_connections", "Open WebSocket connections by consumer.", ("consumer",)
+)
+BROADCAST_EVENTS = REGISTRY.counter(
+    "broadcast_events_total",
+    "Delivery events by how the relay broadcast them: full snapshot, delta, or conflated into a later one.",
+    ("outcome",)
+)
+SSE_STREAMS = REGISTRY.gauge(
+    "sse_streams", "Open Server-Sent Events streams by kind.", ("stream",)
+)
+SSE_RESUMES = REGISTRY.counter(
+    "sse_resumes_total", "SSE reconnects with a Last-Event-ID, by whether the history still had it.", ("outcome",)
+)
+RATE_LIMIT_DECISIONS = REGISTRY.counter(
+    "rate_limit_decisions_total", "Rate limit decisions by policy, outcome and where they were made.",
+    ("policy", "outcome", "source")
+)
+CHANNEL_SEND_LATENCY = REGISTRY.histogram(
+    "channel_layer_send_duration_seconds", "Channel layer group_send latency.", ("message_type",)
+)
+OUTBOX_EVENTS_PUBLISHED = REGISTRY.counter(
+    "outbox_events_published_total", "Delivery outbox events published to the channel layer.", ("update_type",)
+)
+OUTBOX_PUBLISH_FAILURES = REGISTRY.counter(
+    "outbox_publish_failures_total", "Delivery outbox events that failed to publish and were kept for a retry."
+)
+OUTBOX_LAG = REGISTRY.histogram(
+    "outbox_publish_lag_seconds", "Time from a delivery change to the publish of its event."
+)
+CHANGE_STREAM_CHANGES = REGISTRY.counter(
+    "change_stream_changes_total", "Delivery changes read from the change stream.", ("operation",)
+)
+CHANGE_STREAM_EVENTS_PUBLISHED = REGISTRY.counter(
+    "change_stream_events_published_total", "Delivery events published from the change stream.", ("update_type",)
+)
+CHANGE_STREAM_LAG = REGISTRY.histogram(
+    "change_stream_lag_seconds", "Time from a delivery change to the publish of its change stream event."
+)
+HOT_STATE_READS = REGISTRY.counter(
+    "hot_state_reads_total", "Delivery reads from the Redis hot state: hit, miss, or error.", ("outcome",)
+)
+HOT_STATE_WRITES = REGISTRY.counter(
+    "hot_state_writes_total", "Delivery status and location changes, written through to Mongo or behind.", ("mode",)
+)
+HOT_STATE_FLUSHED = REGISTRY.counter(
+    "hot_state_flushed_changes_total", "Delivery changes written behind and flushed to Mongo."
+)
+
+# Channel layer group membership of this worker, group name to local member count
+_group_members = {}
+_group_members_lock = threading.Lock()
+
+
+def group_joined(group):
+    with _group_members_lock:
+        _group_members[group] = _group_members.get(group, 0) + 1
+
+
+def group_left(group):
+    with _group_members_lock:
+        count = _group_members.get(group, 0) - 1
+        if count > 0:
+            _group_members[group] = count
+        else:
+            _group_members.pop(group, None)
+
+
+WEBSOCKET_GROUPS = REGISTRY.gauge(
+    "websocket_groups", "Channel layer groups with at least one local member.",
+    function=lambda: {(): len(_group_members)}
+)
+WEBSOCKET_GROUP_MEMBERS_MAX = REGISTRY.gauge(
+    "websocket_group_members_max", "Members of the largest local channel layer group.",
+    function=lambda: {(): max(_group_members.values(), default=0)}, multiprocess_mode="max"
+)
+
+# State of each circuit breaker of this worker: 0 closed, 1 half open, 2 open
+_circuit_states = {}
+
+
+def circuit_state(circuit, value):
+    _circuit_states[circuit] = value
+
+
+REDIS_CIRCUIT_STATE = REGISTRY.gauge(
+    "redis_circuit_state", "Redis circuit breaker state: 0 closed, 1 half open, 2 open.", ("circuit",),
+    function=lambda: {(circuit,): value for circuit, value in list(_circuit_states.items())}, multiprocess_mode="max"
+)
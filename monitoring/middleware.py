@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import threading
+import random
+import logging
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+from monitoring.timing import start_timing, stop_timing, set_current_view
+from monitoring.metrics import REQUEST_LATENCY
+from monitoring.profiler import StackSampler
+
+logger = logging.getLogger("monitoring.timing")
+
+# Server-Timing descriptions of the spans recorded by the instrumentation hooks
+SPAN_DESCRIPTIONS = {
+    "mongo": "MongoDB",
+    "redis": "Redis",
+    "jwt": "JWT decode",
+    "render": "Rendering",
+}
+
+
+def server_timing_header(timing, total):
+    """
+    Build the Server-Timing header value for a request.
+    Args:
+        timing: The RequestTiming of the request.
+        total: The total time spent in the request, in seconds.
+    Returns:
+        str: The header value, durations in milliseconds.
+    """
+    entries = []
+    for name, duration in timing.durations.items():
+        description = SPAN_DESCRIPTIONS.get(name, name)
+        entries.append(f'{name};dur={duration * 1000:.2f};desc="{description} x{timing.counts[name]}"')
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+class RequestTimingMiddleware(MiddlewareMixin):
+    """
+    Break down where a request spends its time: Mongo, Redis, JWT and rendering.
+    Only a settings.REQUEST_TIMING_SAMPLE_RATE fraction of requests is timed.
+    Sampled responses get a Server-Timing header and one structured log line.
+    """
+
+    def process_request(self, request):
+        if random.random() < settings.REQUEST_TIMING_SAMPLE_RATE:
+            request.timing = start_timing()
+
+    def process_response(self, request, response):
+        timing = getattr(request, "timing", None)
+        if timing is None:
+            return response
+        stop_timing()
+
+        total = timing.elapsed()
+        response.headers["Server-Timing"] = server_timing_header(timing, total)
+        logger.info(json.dumps({
+            "event": "request_timing",
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total * 1000, 3),
+            "spans_ms": {name: round(duration * 1000, 3) for name, duration in timing.durations.items()},
+            "counts": dict(timing.counts),
+        }))
+        return response
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Record the latency of every request, labelled with its URL name,
+    and keep track of the view serving it.
+    """
+
+    def process_request(self, request):
+        request.metrics_start = time.perf_counter()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Lets the slow query listener attribute Mongo commands to a view
+        view = getattr(view_func, "view_class", None) or getattr(view_func, "cls", None) or view_func
+        set_current_view(f"{view.__module__}.{view.__qualname__}")
+
+    def process_response(self, request, response):
+        set_current_view(None)
+        start = getattr(request, "metrics_start", None)
+        if start is None:
+            return response
+        match = getattr(request, "resolver_match", None)
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - start,
+            url_name=match.url_name if match and match.url_name else "unmatched",
+            method=request.method,
+            status=response.status_code
+        )
+        return response
+
+
+class ProfilerMiddleware(MiddlewareMixin):
+    """
+    Profile a single request with the stack sampler when an admin asks for it
+    with the X-Profile: 1 header or the ?profile=1 query flag. The profile is
+    written to settings.PROFILER_OUTPUT_DIR and its name returned in X-Profile.
+    """
+
+    def process_request(self, request):
+        if request.headers.get("X-Profile") != "1" and request.GET.get("profile") != "1":
+            return
+        # Imported here, users imports from monitoring at module level
+        from rest_framework.exceptions import AuthenticationFailed
+        from users.utils.auth_utils import extract_user_from_request
+
+        try:
+            user = extract_user_from_request(request)
+        except AuthenticationFailed:
+            return
+        if user.is_admin:
+            name = f"request-{request.method.lower()}-{request.path.strip('/').replace('/', '-')}"
+            request.profiler = StackSampler(thread_ids=[threading.get_ident()], name=name).start()
+
+    def process_response(self, request, response):
+        sampler = getattr(request, "profiler", None)
+        if sampler is None:
+            return response
+        path = sampler.stop().write()
+        response.headers["X-Profile"] = os.path.basename(path)
+        return response
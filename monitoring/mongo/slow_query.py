@@ -0,0 +1,49 @@
+from mongoengine import Document, StringField, IntField, FloatField, DictField, ListField, DateTimeField
+from datetime import datetime, timezone
+
+
+class SlowQuery(Document):
+    """
+    Aggregate of the slow Mongo commands sharing one filter shape.
+    """
+    shape_key = StringField(required=True, unique=True)
+    database = StringField(required=True)
+    collection = StringField()
+    command = StringField(required=True)
+    shape = DictField()
+    count = IntField(default=0)
+    total_ms = FloatField(default=0)
+    max_ms = FloatField(default=0)
+    views = ListField(StringField())
+    last_view = StringField()
+    plan_summary = StringField()
+    explain = DictField()
+    first_seen = DateTimeField(default=lambda: datetime.now(timezone.utc))
+    last_seen = DateTimeField(default=lambda: datetime.now(timezone.utc))
+
+    meta = {
+        "collection": "slow_queries",
+        "indexes": [
+            {"fields": ["shape_key"], "unique": True},
+            "-total_ms",
+        ]
+    }
+
+    def to_dict(self):
+        return {
+            "shape_key": self.shape_key,
+            "database": self.database,
+            "collection": self.collection,
+            "command": self.command,
+            "shape": self.shape,
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0,
+            "max_ms": round(self.max_ms, 3),
+            "views": self.views,
+            "last_view": self.last_view,
+            "plan_summary": self.plan_summary,
+            "explain": self.explain,
+            "first_seen": self.first_seen.isoformat(),
+            "last_seen": self.last_seen.isoformat()
+        }
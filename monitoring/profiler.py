@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_worker_sampler = None
+_worker_lock = threading.Lock()
+
+
+class StackSampler:
+    """
+    Statistical profiler: a background thread reads the stacks of the other
+    threads through sys._current_frames() every interval seconds and counts
+    them. Coroutines show up on the event loop thread while they run, so
+    consumer handlers are covered as well as views.
+    """
+
+    def __init__(self, interval=None, thread_ids=None, name="profile"):
+        self.interval = interval or settings.PROFILER_INTERVAL
+        self.thread_ids = set(thread_ids) if thread_ids else None
+        self.name = name
+        self.samples = Counter()
+        self.started = None
+        self.elapsed = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (self.thread_ids and thread_id not in self.thread_ids):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append((thread_names.get(thread_id, str(thread_id)), "", 0))
+                self.samples[tuple(reversed(stack))] += 1
+
+    def collapsed(self):
+        """
+        Render the samples as collapsed stacks, one "frame;frame;frame count" line per stack.
+        Returns:
+            str: The collapsed stacks, for flamegraph.pl, speedscope and friends.
+        """
+        lines = []
+        for stack, count in self.samples.most_common():
+            frames = [stack[0][0]] + [f"{name} ({os.path.basename(file)}:{line})" for name, file, line in stack[1:]]
+            lines.append(f"{';'.join(frames)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self):
+        """
+        Render the samples in the speedscope file format.
+        Returns:
+            dict: The speedscope document.
+        """
+        frames = []
+        frame_index = {}
+        samples = []
+        weights = []
+        for stack, count in self.samples.most_common():
+            sample = []
+            for frame in stack:
+                if frame not in frame_index:
+                    frame_index[frame] = len(frames)
+                    name, file, line = frame
+                    frames.append({"name": name, "file": file, "line": line} if file else {"name": name})
+                sample.append(frame_index[frame])
+            samples.append(sample)
+            weights.append(count * self.interval)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "monitoring.profiler",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": self.name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+    def write(self, directory=None):
+        """
+        Write the profile to <directory>/<timestamp>-<name>.collapsed and .speedscope.json.
+        Args:
+            directory: Output directory, settings.PROFILER_OUTPUT_DIR by default.
+        Returns:
+            str: Path of the written files without extension.
+        """
+        directory = directory or settings.PROFILER_OUTPUT_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{self.name}")
+        with open(f"{path}.collapsed", "w") as f:
+            f.write(self.collapsed())
+        with open(f"{path}.speedscope.json", "w") as f:
+            json.dump(self.speedscope(), f)
+        logger.info("Wrote profile %s (%d samples over %.2fs)", path, sum(self.samples.values()), self.elapsed)
+        return path
+
+
+def profile_worker(duration, interval=None):
+    """
+    Sample every thread of this worker for duration seconds, then write the profile.
+    Does nothing if this worker is already being profiled.
+    Args:
+        duration: Seconds to sample for.
+        interval: Seconds between samples, settings.PROFILER_INTERVAL by default.
+    Returns:
+        StackSampler: The running sampler, or None if one was already running.
+    """
+    global _worker_sampler
+    with _worker_lock:
+        if _worker_sampler is not None:
+            return None
+        sampler = _worker_sampler = StackSampler(interval, name=f"worker-{os.getpid()}").start()
+
+    def finish():
+        global _worker_sampler
+        try:
+            sampler.stop().write()
+        finally:
+            with _worker_lock:
+                _worker_sampler = None
+
+    timer = threading.Timer(duration, finish)
+    timer.daemon = True
+    timer.start()
+    return sampler
+
+
+def control_file(pid):
+    """
+    Path of the file the profile_worker command leaves for worker pid.
+    """
+    return os.path.join(settings.PROFILER_OUTPUT_DIR, f"request-{pid}.json")
+
+
+def handle_profile_signal(signum=None, frame=None):
+    """
+    Signal handler: start profiling this worker with the options from its control file.
+    """
+    options = {}
+    path = control_file(os.getpid())
+    try:
+        with open(path) as f:
+            options = json.load(f)
+        os.remove(path)
+    except (OSError, ValueError):
+        pass
+    profile_worker(options.get("duration", settings.PROFILER_DEFAULT_DURATION), options.get("interval"))
+
+
+def install_signal_handler():
+    """
+    Install handle_profile_signal for settings.PROFILER_SIGNAL.
+    Signal handlers can only be installed from the main thread, elsewhere this is a no-op.
+    """
+    signum = getattr(signal, settings.PROFILER_SIGNAL, None)
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signum, handle_profile_signal)
+    return True
@@ -0,0 +1,184 @@
+import time
+import threading
+import redis
+from redis.retry import Retry
+from redis.backoff import NoBackoff
+from django.conf import settings
+from monitoring.timing import span
+from monitoring.metrics import (
+    REDIS_COMMAND_LATENCY, REDIS_COMMAND_FAILURES, REDIS_CIRCUIT_OPENED, REDIS_CIRCUIT_REJECTIONS, circuit_state
+)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(redis.ConnectionError):
+    """Raised instead of sending a command while the circuit is open"""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a Redis server.
+    After settings.REDIS_CIRCUIT_FAILURES connection errors or timeouts in a row
+    the circuit opens and commands fail at once, without waiting for a timeout.
+    After settings.REDIS_CIRCUIT_RESET_SECONDS one command is let through as a
+    probe, its success closes the circuit and its failure opens it again.
+    Args:
+        name: Name for the metrics.
+        failures: Failures in a row that open the circuit, from settings by default.
+        reset_seconds: Seconds the circuit stays open, from settings by default.
+    """
+
+    def __init__(self, name, failures=None, reset_seconds=None):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.state = CLOSED
+        self._failures = 0
+        self._failing_since = None
+        self._opened_at = 0
+        self._probing = False
+        circuit_state(self.name, STATE_VALUES[CLOSED])
+
+    @property
+    def is_open(self):
+        """True while commands fail at once, a probe is not due yet"""
+        return self.state == OPEN and time.monotonic() - self._opened_at < self._reset_seconds()
+
+    def outage_seconds(self):
+        """Seconds since the current run of failures started, 0 if the last command succeeded"""
+        failing_since = self._failing_since
+        return 0 if failing_since is None else time.monotonic() - failing_since
+
+    def allow(self):
+        """
+        Check whether a command may be sent.
+        Returns:
+            bool: False while the circuit is open.
+        """
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN and not self.is_open:
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            if self.state == CLOSED:
+                return True
+        REDIS_CIRCUIT_REJECTIONS.inc(circuit=self.name)
+        return False
+
+    def record_success(self):
+        if self._failing_since is None and self.state == CLOSED:
+            return
+        with self._lock:
+            self._failures = 0
+            self._failing_since = None
+            self._probing = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            self._failures += 1
+            if self._failing_since is None:
+                self._failing_since = now
+            self._probing = False
+            threshold = self.failures or settings.REDIS_CIRCUIT_FAILURES
+            if self.state == HALF_OPEN or self._failures >= threshold:
+                self._opened_at = now
+                if self.state != OPEN:
+                    self._transition(OPEN)
+
+    def _reset_seconds(self):
+        return self.reset_seconds or settings.REDIS_CIRCUIT_RESET_SECONDS
+
+    def _transition(self, state):
+        self.state = state
+        circuit_state(self.name, STATE_VALUES[state])
+        if state == OPEN:
+            REDIS_CIRCUIT_OPENED.inc(circuit=self.name)
+
+
+# Every client of settings' Redis shares one circuit, an outage is an outage for all of them
+redis_circuit = CircuitBreaker("redis")
+
+
+class InstrumentedRedis(redis.Redis):
+    """
+    Redis client that records every command in the metrics and the current request.
+    With circuit set, commands go through that CircuitBreaker. Pipelines don't.
+    """
+    circuit = None
+
+    def execute_command(self, *args, **options):
+        command = str(args[0]).lower() if args else ""
+        circuit = self.circuit
+        if circuit is not None and not circuit.allow():
+            REDIS_COMMAND_FAILURES.inc(command=command)
+            raise CircuitOpenError(f"Circuit {circuit.name} is open")
+        start = time.perf_counter()
+        try:
+            with span("redis"):
+                response = super().execute_command(*args, **options)
+        except (redis.ConnectionError, redis.TimeoutError):
+            REDIS_COMMAND_FAILURES.inc(command=command)
+            if circuit is not None:
+                circuit.record_failure()
+            raise
+        except redis.RedisError:
+            # The server answered, an error reply is not an outage
+            REDIS_COMMAND_FAILURES.inc(command=command)
+            if circuit is not None:
+                circuit.record_success()
+            raise
+        finally:
+            REDIS_COMMAND_LATENCY.observe(time.perf_counter() - start, command=command)
+        if circuit is not None:
+            circuit.record_success()
+        return response
+
+
+def connection_options():
+    """
+    Timeouts and retries for connections to settings' Redis.
+    A failed command is retried once at once, on a new connection, which covers
+    a connection the server closed. redis-py's default of three retries with
+    backoff would hold a request for seconds while Redis is down.
+    Returns:
+        dict: Options for redis.Redis or a ConnectionPool.
+    """
+    return {
+        "socket_timeout": settings.REDIS_SOCKET_TIMEOUT,
+        "socket_connect_timeout": settings.REDIS_CONNECT_TIMEOUT,
+        "retry": Retry(NoBackoff(), 1),
+    }
+
+
+def create_client(**options):
+    """
+    Create a client for settings' Redis, with connection_options() and the
+    shared circuit breaker.
+    Args:
+        **options: Options for redis.Redis, override the defaults.
+    Returns:
+        InstrumentedRedis: The client.
+    """
+    client = InstrumentedRedis(**{
+        "host": settings.REDIS_HOST,
+        "port": settings.REDIS_PORT,
+        "db": settings.REDIS_DB,
+        **connection_options(),
+        **options,
+    })
+    client.circuit = redis_circuit
+    return client
@@ -0,0 +1,269 @@
+import os
+import json
+import queue
+import logging
+import threading
+from datetime import datetime, timezone
+from django.conf import settings
+from mongoengine.connection import get_connection
+from pymongo import monitoring
+from monitoring.timing import current_view
+from monitoring.mongo.slow_query import SlowQuery
+
+logger = logging.getLogger(__name__)
+
+# Where each command keeps the part that decides the query plan
+SHAPE_FIELDS = {
+    "find": ("filter", "sort"),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "findAndModify": ("query", "sort"),
+    "aggregate": ("pipeline",),
+    "update": ("updates",),
+    "delete": ("deletes",),
+    "insert": (),
+}
+
+# Commands and collections that are never recorded, so explain and the
+# recorder's own writes can't feed back into the listener.
+IGNORED_COMMANDS = {
+    "explain", "getMore", "killCursors", "endSessions", "hello", "isMaster", "ismaster",
+    "ping", "buildInfo", "saslStart", "saslContinue",
+}
+IGNORED_COLLECTIONS = {SlowQuery._meta["collection"]}
+
+QUEUE_SIZE = 1000
+
+
+def query_shape(value):
+    """
+    Strip the values out of a query, keeping field names and operators.
+    Args:
+        value: A filter, sort, pipeline or any part of one.
+    Returns:
+        The same structure with every leaf value replaced by "?".
+        Lists are reduced to their distinct element shapes.
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = query_shape(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return "?"
+
+
+def command_shape(command_name, command):
+    """
+    Get the shape of a Mongo command.
+    Args:
+        command_name: The command name, e.g. "find".
+        command: The command document.
+    Returns:
+        dict: The shape of the fields that decide the query plan.
+    """
+    fields = SHAPE_FIELDS.get(command_name)
+    if fields is None:
+        return {}
+    shape = {}
+    for field in fields:
+        if field in command:
+            shape[field] = command[field] if field == "key" else query_shape(command[field])
+    return shape
+
+
+def plan_summary(explain):
+    """
+    Summarize the winning plan of an explain result, e.g. "FETCH, IXSCAN {delivery_id: 1}".
+    Args:
+        explain: The explain command result.
+    Returns:
+        str: The stages from the outermost in, or None if there is no plan.
+    """
+    planner = explain.get("queryPlanner")
+    if planner is None:
+        # Aggregations nest the planner inside their first stage
+        stages = explain.get("stages") or [{}]
+        planner = stages[0].get("$cursor", {}).get("queryPlanner")
+    if not planner:
+        return None
+    stage = planner.get("winningPlan", {})
+    stage = stage.get("queryPlan", stage)
+    summary = []
+    while stage:
+        name = stage.get("stage", "?")
+        if "keyPattern" in stage:
+            keys = ", ".join(f"{key}: {value}" for key, value in stage["keyPattern"].items())
+            name = f"{name} {{{keys}}}"
+        summary.append(name)
+        stage = stage.get("inputStage") or (stage.get("inputStages") or [None])[0]
+    return ", ".join(summary)
+
+
+class SlowCommand:
+    """
+    A command that took longer than the threshold.
+    """
+
+    def __init__(self, database, command_name, command, duration_ms, view):
+        self.database = database
+        self.command_name = command_name
+        self.command = command
+        self.duration_ms = duration_ms
+        self.view = view
+        self.collection = command.get(command_name) if isinstance(command.get(command_name), str) else None
+        self.shape = command_shape(command_name, command)
+        self.shape_key = (
+            f"{database}.{self.collection or '-'} {command_name} "
+            f"{json.dumps(self.shape, sort_keys=True, default=str)}"
+        )
+
+
+class SlowQueryRecorder:
+    """
+    Persists slow commands to the slow_queries collection from a background
+    thread, so the request that ran the slow command never waits on it. The
+    first time a shape is seen its command is explained.
+    """
+
+    def __init__(self, alias="default"):
+        self.alias = alias
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._seen_shapes = set()
+
+    def submit(self, slow_command):
+        """
+        Queue a slow command for recording, dropped if the queue is full.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(slow_command)
+        except queue.Full:
+            logger.warning("Slow query queue full, dropping %s", slow_command.shape_key)
+
+    def _start(self):
+        with self._lock:
+            # A forked worker inherits the queue but not the thread
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(QUEUE_SIZE)
+            self._thread = threading.Thread(target=self._run, name="slow-query-recorder", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            slow_command = self._queue.get()
+            try:
+                self.record(slow_command)
+            except Exception:
+                logger.exception("Could not record slow query %s", slow_command.shape_key)
+
+    def record(self, slow_command):
+        """
+        Add a slow command to the aggregate of its shape, explaining new shapes.
+        Args:
+            slow_command: The SlowCommand to record.
+        """
+        now = datetime.now(timezone.utc)
+        SlowQuery.objects(shape_key=slow_command.shape_key).update_one(
+            upsert=True,
+            set_on_insert__database=slow_command.database,
+            set_on_insert__collection=slow_command.collection,
+            set_on_insert__command=slow_command.command_name,
+            set_on_insert__shape=slow_command.shape,
+            set_on_insert__first_seen=now,
+            inc__count=1,
+            inc__total_ms=slow_command.duration_ms,
+            max__max_ms=slow_command.duration_ms,
+            add_to_set__views=slow_command.view or "-",
+            set__last_view=slow_command.view,
+            set__last_seen=now
+        )
+        logger.info("Slow %s on %s.%s took %.1fms (%s)", slow_command.command_name, slow_command.database,
+                    slow_command.collection, slow_command.duration_ms, slow_command.view)
+
+        if slow_command.shape_key in self._seen_shapes:
+            return
+        self._seen_shapes.add(slow_command.shape_key)
+        if settings.SLOW_QUERY_EXPLAIN and slow_command.command_name in SHAPE_FIELDS \
+                and slow_command.command_name != "insert" \
+                and SlowQuery.objects(shape_key=slow_command.shape_key, plan_summary=None).count():
+            self.explain(slow_command)
+
+    def explain(self, slow_command):
+        """
+        Explain a slow command and store the plan on its shape.
+        """
+        command = {
+            key: value for key, value in slow_command.command.items()
+            if not key.startswith("$") and key not in ("lsid", "txnNumber", "autocommit", "startTransaction")
+        }
+        try:
+            result = get_connection(self.alias)[slow_command.database].command(
+                {"explain": command, "verbosity": "queryPlanner"}
+            )
+        except Exception as e:
+            logger.warning("Could not explain %s: %s", slow_command.shape_key, e)
+            return
+        result = json.loads(json.dumps(result, default=str))
+        SlowQuery.objects(shape_key=slow_command.shape_key).update_one(
+            set__explain=result,
+            set__plan_summary=plan_summary(result) or "?"
+        )
+
+
+slow_query_recorder = SlowQueryRecorder()
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """
+    Records Mongo commands slower than settings.SLOW_QUERY_THRESHOLD_MS.
+    The command document and calling view are kept from the started event
+    until the command completes; only slow commands go further.
+    """
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder or slow_query_recorder
+        self._pending = {}
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        if event.command.get(event.command_name) in IGNORED_COLLECTIONS:
+            return
+        self._pending[(event.connection_id, event.request_id)] = (event.command, current_view())
+
+    def succeeded(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < settings.SLOW_QUERY_THRESHOLD_MS:
+            return
+        command, view = pending
+        self.recorder.submit(SlowCommand(event.database_name, event.command_name, command, duration_ms, view))
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+def top_slow_queries(limit=20, sort="total_ms"):
+    """
+    Get the slowest query shapes.
+    Args:
+        limit: Number of shapes to return.
+        sort: Field to sort by, one of "total_ms", "max_ms" or "count".
+    Returns:
+        list: The shapes, slowest first.
+    """
+    if sort not in ("total_ms", "max_ms", "count"):
+        raise ValueError("Sort must be one of: total_ms, max_ms, count")
+    return [query.to_dict() for query in SlowQuery.objects.order_by(f"-{sort}").limit(limit)]
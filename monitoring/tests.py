@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import asyncio
+import pytest
+import bcrypt
+import threading
+from django.test import Client
+from types import SimpleNamespace
+from rest_framework.test import APIClient
+from users.mongo.user import User
+from users.utils.jwt_utils import generate_token
+from deliveries.mongo.delivery import Delivery
+from .timing import start_timing, stop_timing, current_timing, span
+from .instrumentation import MongoTimingListener
+from .metrics import Registry, Counter
+from .timing import set_current_view
+from .slow_queries import query_shape, plan_summary, SlowCommand, SlowQueryListener, SlowQueryRecorder
+from .mongo.slow_query import SlowQuery
+from .profiler import StackSampler, handle_profile_signal
+
+# Create your tests here.
+
+@pytest.fixture(autouse=True)
+def cleanup_data():
+    User.objects.delete()
+    Delivery.objects.delete()
+    SlowQuery.objects.delete()
+    yield
+    stop_timing()
+    set_current_view(None)
+
+@pytest.fixture
+def admin_token():
+    admin = User(
+        username="timingadmin",
+        email="timingadmin@example.com",
+        password_hash=bcrypt.hashpw("admin123".encode(), bcrypt.gensalt()).decode(),
+        is_admin=True
+    )
+    admin.save()
+    return generate_token(str(admin.id))
+
+@pytest.fixture
+def user_token():
+    user = User(
+        username="timinguser",
+        email="timing@example.com",
+        password_hash=bcrypt.hashpw("password123".encode(), bcrypt.gensalt()).decode()
+    )
+    user.save()
+    return generate_token(str(user.id))
+
+def test_span_outside_request_is_noop():
+    """Test that a span outside a timed request records nothing"""
+    with span("mongo"):
+        pass
+    assert current_timing() is None
+
+def test_spans_accumulate_by_name():
+    """Test that spans of the same name add up"""
+    timing = start_timing()
+    with span("redis"):
+        pass
+    with span("redis"):
+        pass
+    assert timing.counts["redis"] == 2
+    assert timing.durations["redis"] >= 0
+
+def test_mongo_listener_records_duration():
+    """Test that the Mongo command listener records command durations"""
+    timing = start_timing()
+    MongoTimingListener().succeeded(SimpleNamespace(duration_micros=1500, command_name="find"))
+    assert timing.durations["mongo"] == pytest.approx(0.0015)
+    assert timing.counts["mongo"] == 1
+
+def test_server_timing_header(settings, user_token):
+    """Test the Server-Timing header of a sampled request"""
+    settings.REQUEST_TIMING_SAMPLE_RATE = 1.0
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {user_token}")
+    response = client.get("/api/v1/deliveries/my/")
+    assert response.status_code == 200
+    header = response["Server-Timing"]
+    for name in ("redis", "jwt", "render", "total"):
+        assert f"{name};dur=" in header
+    assert current_timing() is None
+
+def test_unsampled_request_has_no_header(settings, user_token):
+    """Test that a request left out of the sample has no Server-Timing header"""
+    settings.REQUEST_TIMING_SAMPLE_RATE = 0.0
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {user_token}")
+    response = client.get("/api/v1/deliveries/my/")
+    assert response.status_code == 200
+    assert not response.has_header("Server-Timing")
+
+def test_histogram_exposition():
+    """Test the cumulative buckets of a histogram in the exposition text"""
+    registry = Registry()
+    histogram = registry.histogram("test_duration_seconds", "Test.", ("name",), buckets=(0.1, 1.0))
+    histogram.observe(0.05, name="a")
+    histogram.observe(0.5, name="a")
+    histogram.observe(5, name="a")
+    text = registry.exposition()
+    assert 'test_duration_seconds_bucket{name="a",le="0.1"} 1' in text
+    assert 'test_duration_seconds_bucket{name="a",le="1.0"} 2' in text
+    assert 'test_duration_seconds_bucket{name="a",le="+Inf"} 3' in text
+    assert 'test_duration_seconds_count{name="a"} 3' in text
+
+def test_metrics_merge_thread_shards():
+    """Test that counts recorded by several threads are merged"""
+    counter = Counter("test_total", "Test.", ("outcome",))
+    threads = [threading.Thread(target=lambda: [counter.inc(outcome="ok") for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.collect() == {("ok",): 4000}
+
+def test_multiprocess_snapshots_merge(tmp_path, settings):
+    """Test merging the snapshots of exited workers and retiring old ones"""
+    registry = Registry()
+    counter = registry.counter("test_total", "Test.")
+    gauge = registry.gauge("test_connections", "Test.")
+    counter.inc(2)
+    gauge.inc(3)
+    (tmp_path / "1.json").write_text(json.dumps({"pid": os.getpid() + 10 ** 6, "metrics": {
+        "test_total": [[[], 5]],
+        "test_connections": [[[], 7]],
+    }}))
+    settings.METRICS_MULTIPROCESS_DIR = str(tmp_path)
+    text = registry.exposition()
+    # Counters of exited workers are kept, their gauges are not
+    assert "test_total 7" in text
+    assert "test_connections 3" in text
+
+    # A snapshot too old is deleted, its counters are kept in retired.json
+    stale = time.time() - settings.METRICS_SNAPSHOT_MAX_AGE - 1
+    os.utime(tmp_path / "1.json", (stale, stale))
+    text = registry.exposition()
+    assert "test_total 7" in text
+    assert "test_connections 3" in text
+    assert not (tmp_path / "1.json").exists()
+    assert json.loads((tmp_path / "retired.json").read_text()) == {"test_total": [[[], 5]]}
+
+def test_expired_snapshots_fold_into_retired(tmp_path, settings):
+    """Test counters and histograms of expired snapshots add up in retired.json"""
+    registry = Registry()
+    registry.counter("test_total", "Test.")
+    histogram = registry.histogram("test_seconds", "Test.", buckets=(1.0,))
+    histogram.observe(0.5)
+    settings.METRICS_MULTIPROCESS_DIR = str(tmp_path)
+    stale = time.time() - settings.METRICS_SNAPSHOT_MAX_AGE - 1
+    for pid in (1, 2):
+        path = tmp_path / f"{pid}.json"
+        path.write_text(json.dumps({"pid": os.getpid() + 10 ** 6, "metrics": {
+            "test_total": [[[], pid]],
+            "test_seconds": [[[], [1, 1, 3.0]]],
+        }}))
+        os.utime(path, (stale, stale))
+        text = registry.exposition()
+    assert "test_total 3" in text
+    assert 'test_seconds_bucket{le="1.0"} 3' in text
+    assert 'test_seconds_bucket{le="+Inf"} 5' in text
+    assert "test_seconds_sum 6.5" in text
+    assert sorted(os.listdir(tmp_path)) == ["retired.json", "retired.lock"]
+
+def test_metrics_endpoint(user_token):
+    """Test that /metrics exposes request, token and bcrypt metrics"""
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {user_token}")
+    client.get("/api/v1/deliveries/my/")
+    response = Client().get("/metrics")
+    assert response.status_code == 200
+    body = response.content.decode()
+    assert 'http_request_duration_seconds_count{url_name="my_deliveries",method="GET",status="200"}' in body
+    assert 'token_validations_total{outcome="valid"}' in body
+    assert "# TYPE bcrypt_in_flight gauge" in body
+
+def test_metrics_endpoint_restricted(settings, user_token, admin_token):
+    """Test that /metrics only answers allowed addresses and admins"""
+    settings.METRICS_ALLOWED_IPS = ["10.0.0.0/8"]
+    assert Client(REMOTE_ADDR="10.1.2.3").get("/metrics").status_code == 200
+    client = Client(REMOTE_ADDR="203.0.113.9")
+    response = client.get("/metrics")
+    assert (response.status_code, response.json()) == (403, {"error": "Admin access required"})
+    assert client.get("/metrics", HTTP_AUTHORIZATION=f"Bearer {user_token}").status_code == 403
+    assert client.get("/metrics", HTTP_AUTHORIZATION=f"Bearer {admin_token}").status_code == 200
+
+def command_events(command, duration_micros):
+    event = dict(
+        connection_id=("localhost", 27017), request_id=1, database_name="logistics_db",
+        command_name=next(iter(command)), command=command, duration_micros=duration_micros
+    )
+    return SimpleNamespace(**event), SimpleNamespace(**event)
+
+def test_query_shape_strips_values():
+    """Test that query shapes keep the fields and drop the values"""
+    shape = query_shape({"delivery_id": "DEL001", "status": {"$in": ["pending", "delivered"]}})
+    assert shape == {"delivery_id": "?", "status": {"$in": ["?"]}}
+
+def test_plan_summary():
+    """Test the one-line summary of an explain plan"""
+    explain = {"queryPlanner": {"winningPlan": {
+        "stage": "FETCH", "inputStage": {"stage": "IXSCAN", "keyPattern": {"delivery_id": 1}}
+    }}}
+    assert plan_summary(explain) == "FETCH, IXSCAN {delivery_id: 1}"
+
+def test_slow_query_listener(settings):
+    """Test that only commands over the threshold are submitted, with their view and shape"""
+    settings.SLOW_QUERY_THRESHOLD_MS = 100
+    submitted = []
+    listener = SlowQueryListener(recorder=SimpleNamespace(submit=submitted.append))
+    set_current_view("deliveries.views.DeliveryDetailView")
+
+    command = {"find": "deliveries", "filter": {"delivery_id": "DEL001"}, "lsid": {}}
+    started, succeeded = command_events(command, 5000)
+    listener.started(started)
+    listener.succeeded(succeeded)
+    assert submitted == []
+
+    started, succeeded = command_events(command, 250000)
+    listener.started(started)
+    listener.succeeded(succeeded)
+    assert len(submitted) == 1
+    assert submitted[0].duration_ms == 250
+    assert submitted[0].view == "deliveries.views.DeliveryDetailView"
+    assert submitted[0].shape == {"filter": {"delivery_id": "?"}}
+
+def test_slow_query_recorder_aggregates_shapes(settings):
+    """Test that slow queries of the same shape are aggregated"""
+    settings.SLOW_QUERY_EXPLAIN = False
+    recorder = SlowQueryRecorder()
+    for delivery_id, duration_ms in (("DEL001", 150), ("DEL002", 450)):
+        command = {"find": "deliveries", "filter": {"delivery_id": delivery_id}}
+        recorder.record(SlowCommand("logistics_db", "find", command, duration_ms, "view"))
+    query = SlowQuery.objects.get()
+    assert query.count == 2
+    assert query.total_ms == 600
+    assert query.max_ms == 450
+    assert query.collection == "deliveries"
+
+def test_slow_queries_endpoint_admin_only(settings, user_token, admin_token):
+    """Test that only admins can list slow queries"""
+    settings.SLOW_QUERY_EXPLAIN = False
+    command = {"find": "deliveries", "filter": {"delivery_id": "DEL001"}}
+    SlowQueryRecorder().record(SlowCommand("logistics_db", "find", command, 150, "view"))
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {user_token}")
+    assert client.get("/api/v1/monitoring/slow-queries/").status_code == 403
+
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {admin_token}")
+    response = client.get("/api/v1/monitoring/slow-queries/?limit=5")
+    assert response.status_code == 200
+    assert response.json()[0]["count"] == 1
+    assert response.json()[0]["command"] == "find"
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+async def busy_handler(seconds):
+    busy(seconds)
+
+def test_stack_sampler_covers_event_loop(settings, tmp_path):
+    """Test that the stack sampler records frames of an event loop thread"""
+    settings.PROFILER_OUTPUT_DIR = str(tmp_path)
+    thread = threading.Thread(target=lambda: asyncio.run(busy_handler(0.3)), name="event-loop")
+    sampler = StackSampler(interval=0.001, name="test").start()
+    thread.start()
+    thread.join()
+    path = sampler.stop().write()
+
+    collapsed = open(f"{path}.collapsed").read()
+    assert any(line.startswith("event-loop;") and "busy_handler" in line for line in collapsed.splitlines())
+    speedscope = json.load(open(f"{path}.speedscope.json"))
+    names = {frame["name"] for frame in speedscope["shared"]["frames"]}
+    assert {"busy_handler", "busy"} <= names
+    assert len(speedscope["profiles"][0]["samples"]) == len(speedscope["profiles"][0]["weights"])
+
+def test_profile_worker_from_signal(settings, tmp_path):
+    """Test profiling a worker from the profile signal and its request file"""
+    settings.PROFILER_OUTPUT_DIR = str(tmp_path)
+    (tmp_path / f"request-{os.getpid()}.json").write_text(json.dumps({"duration": 0.05, "interval": 0.001}))
+    handle_profile_signal()
+    busy(0.2)
+    assert not (tmp_path / f"request-{os.getpid()}.json").exists()
+    assert any(path.name.endswith(f"worker-{os.getpid()}.collapsed") for path in tmp_path.iterdir())
+
+def test_profile_request_admin_only(settings, tmp_path, user_token, admin_token):
+    """Test that only admins can profile a request"""
+    settings.PROFILER_OUTPUT_DIR = str(tmp_path)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {user_token}")
+    response = client.get("/api/v1/deliveries/my/?profile=1")
+    assert response.status_code == 200
+    assert not response.has_header("X-Profile")
+
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {admin_token}")
+    response = client.get("/api/v1/deliveries/my/", HTTP_X_PROFILE="1")
+    assert response.status_code == 200
+    assert (tmp_path / f"{response['X-Profile']}.speedscope.json").exists()
+
+def test_health():
+    """Test the health endpoint reports Mongo as ok"""
+    response = Client().get("/api/v1/monitoring/health/")
+    assert response.status_code == 200
+    assert response.json()["mongo"]["status"] == "ok"
@@ -0,0 +1,94 @@
+import time
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import defaultdict
+
+_current_timing = ContextVar("request_timing", default=None)
+_current_view = ContextVar("current_view", default=None)
+
+
+class RequestTiming:
+    """
+    Time spent per component while serving one request.
+    Spans are accumulated by name, so three Mongo queries add up to one "mongo" total.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    def add(self, name, duration):
+        self.durations[name] += duration
+        self.counts[name] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+def start_timing():
+    """
+    Start timing the current request.
+    Returns:
+        RequestTiming: The timing that spans will be recorded on.
+    """
+    timing = RequestTiming()
+    _current_timing.set(timing)
+    return timing
+
+
+def stop_timing():
+    _current_timing.set(None)
+
+
+def current_timing():
+    """
+    Get the timing of the request being served.
+    Returns:
+        RequestTiming: The timing, or None when the request is not sampled.
+    """
+    return _current_timing.get()
+
+
+@contextmanager
+def span(name):
+    """
+    Time a block and add it to the current request under name.
+    A no-op outside of a sampled request.
+    """
+    timing = _current_timing.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """
+    Decorator version of span().
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_current_view(name):
+    _current_view.set(name)
+
+
+def current_view():
+    """
+    Get the name of the view serving the current request.
+    Returns:
+        str: The dotted path of the view, or None outside of a request.
+    """
+    return _current_view.get()
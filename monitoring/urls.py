@@ -0,0 +1,9 @@
+from django.urls import path
+from monitoring.views import SlowQueryList, health
+
+urlpatterns = [
+    path('health/', health, name='health'),
+
+    # Admin routes
+    path('slow-queries/', SlowQueryList.as_view(), name='slow_queries'),
+]
@@ -0,0 +1,78 @@
+import ipaddress
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from pymongo.errors import PyMongoError
+from logistics_backend.mongo import ping
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.exceptions import AuthenticationFailed
+from users.permissions import IsAuthenticated, IsAdminUser
+from users.utils.auth_utils import extract_user_from_request
+from monitoring.metrics import REGISTRY
+from monitoring.slow_queries import top_slow_queries
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics(request):
+    """
+    Expose the metrics in the Prometheus text format, to scrapers from
+    settings.METRICS_ALLOWED_IPS and to admins.
+    """
+    if not metrics_allowed(request):
+        return JsonResponse({"error": "Admin access required"}, status=403)
+    return HttpResponse(REGISTRY.exposition(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+def metrics_allowed(request):
+    """
+    Check whether a request may read the metrics.
+    Args:
+        request: The request.
+    Returns:
+        bool: True if it comes from an address in settings.METRICS_ALLOWED_IPS
+            (REMOTE_ADDR, forwarded headers are not trusted) or carries an admin token.
+    """
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        address = None
+    if address is not None and any(address in ipaddress.ip_network(network, strict=False)
+                                   for network in settings.METRICS_ALLOWED_IPS):
+        return True
+    try:
+        return bool(extract_user_from_request(request).is_admin)
+    except Exception:
+        return False
+
+
+def health(request):
+    """
+    Report whether Mongo is reachable, 503 if it is not.
+    """
+    try:
+        latency = ping()
+    except PyMongoError as e:
+        return JsonResponse({"mongo": {"status": "down", "error": str(e)}}, status=503)
+    return JsonResponse({"mongo": {"status": "ok", "latency_ms": round(latency * 1000, 3)}}, status=200)
+
+
+class SlowQueryList(APIView):
+    """
+    Top slow Mongo query shapes, with their plan.
+    Query parameters: limit (default 20) and sort (total_ms, max_ms or count).
+    """
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+    def handle_exception(self, exc):
+        if isinstance(exc, AuthenticationFailed):
+            return Response({"error": str(exc)}, status=401)
+        return super().handle_exception(exc)
+
+    def get(self, request):
+        try:
+            limit = int(request.query_params.get("limit", 20))
+            sort = request.query_params.get("sort", "total_ms")
+            return Response(top_slow_queries(limit, sort), status=200)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=400)
@@ -1,9 +1,15 @@
 import os
 import sys
+import time
+import math
+import bisect
 import django
 import random
 import logging
-from datetime import datetime, timedelta
+import argparse
+import itertools
+import multiprocessing
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.utils import timezone
 
 # Setup Django environment
@@ -11,11 +17,20 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'logistics_backend.settings')
 django.setup()
 
+import bcrypt
+from pymongo import MongoClient
+from django.conf import settings
 from users.mongo.user import User
 from deliveries.mongo.delivery import Delivery, StatusHistory
 
 logger = logging.getLogger('seed')
 
+# Demo fixtures get sequential IDs so repeated runs never collide
+_demo_ids = itertools.count(1)
+
+def next_delivery_id():
+    return f"DEL{next(_demo_ids):06d}"
+
 def clean_database():
     """Remove all data from the database"""
     logger.info("Cleaning database...")
@@ -26,7 +41,7 @@ def clean_database():
 def create_test_users():
     """Create various types of users for testing"""
     users = []
-    
+
     # Regular user
     regular_user = User(
         username="regular_user",
@@ -70,7 +85,7 @@ def create_test_deliveries(users):
     """Create various types of deliveries for testing"""
     deliveries = []
     statuses = ['pending', 'in transit', 'out for delivery', 'delivered']
-    
+
     def create_status_history(status, location, timestamp):
         return StatusHistory(
             status=status,
@@ -81,7 +96,7 @@ def create_test_deliveries(users):
     # Basic delivery for each status
     for status in statuses:
         delivery = Delivery(
-            delivery_id=f"DEL{random.randint(100000, 999999)}",
+            delivery_id=next_delivery_id(),
             title=f"Test Delivery - {status}",
             status=status,
             customer_id=users[0].username,
@@ -104,7 +119,7 @@ def create_test_deliveries(users):
 
     # Delivery with multiple status updates
     multi_status = Delivery(
-        delivery_id=f"DEL{random.randint(100000, 999999)}",
+        delivery_id=next_delivery_id(),
         title="Multi-Status Delivery",
         status="in transit",
         customer_id=users[0].username,
@@ -138,7 +153,7 @@ def create_test_deliveries(users):
     # Bulk deliveries for one user
     for i in range(20):
         delivery = Delivery(
-            delivery_id=f"DEL{random.randint(100000, 999999)}",
+            delivery_id=next_delivery_id(),
             title=f"Bulk Delivery {i+1}",
             status=random.choice(statuses),
             customer_id=users[2].username,  # bulk_user
@@ -165,7 +180,7 @@ def create_test_deliveries(users):
     # Edge cases
     # 1. Delivery with special characters
     special_delivery = Delivery(
-        delivery_id=f"DEL{random.randint(100000, 999999)}",
+        delivery_id=next_delivery_id(),
         title="Special Characters !@#$%^&*()",
         status="pending",
         customer_id=users[3].username,
@@ -181,7 +196,7 @@ def create_test_deliveries(users):
 
     # 2. Delivery with long title
     long_title_delivery = Delivery(
-        delivery_id=f"DEL{random.randint(100000, 999999)}",
+        delivery_id=next_delivery_id(),
         title="x" * 100,  # Maximum length title
         status="pending",
         customer_id=users[0].username,
@@ -201,7 +216,7 @@ def create_test_deliveries(users):
         "coordinates": [-73.935242, 40.730610]
     }
     same_location_delivery = Delivery(
-        delivery_id=f"DEL{random.randint(100000, 999999)}",
+        delivery_id=next_delivery_id(),
         title="Same Location Delivery",
         status="pending",
         customer_id=users[0].username,
@@ -223,5 +238,245 @@ def run_seed():
     deliveries = create_test_deliveries(users)
     logger.info("Seed completed successfully")
 
+
+# Large-scale synthetic data
+
+# Metro areas deliveries are spread over: (name, lon, lat, weight)
+HUBS = [
+    ("New York, NY", -73.97, 40.75, 20),
+    ("Los Angeles, CA", -118.25, 34.05, 14),
+    ("Chicago, IL", -87.63, 41.88, 10),
+    ("Houston, TX", -95.37, 29.76, 8),
+    ("Phoenix, AZ", -112.07, 33.45, 5),
+    ("Philadelphia, PA", -75.17, 39.95, 5),
+    ("San Francisco, CA", -122.42, 37.77, 7),
+    ("Seattle, WA", -122.33, 47.61, 6),
+    ("Miami, FL", -80.19, 25.76, 6),
+    ("Atlanta, GA", -84.39, 33.75, 6),
+    ("Boston, MA", -71.06, 42.36, 5),
+    ("Denver, CO", -104.99, 39.74, 4),
+    ("Dallas, TX", -96.80, 32.78, 4),
+]
+HUB_CUM_WEIGHTS = list(itertools.accumulate(hub[3] for hub in HUBS))
+
+# Share of deliveries by their current (final) status
+FINAL_STATUSES = ['pending', 'in transit', 'out for delivery', 'delivered']
+FINAL_STATUS_CUM_WEIGHTS = list(itertools.accumulate([10, 20, 10, 60]))
+
+STREETS = ["Main St", "Broadway", "Oak Ave", "Maple Dr", "Pine St", "Cedar Ln", "Elm St", "Park Ave",
+           "Washington Blvd", "Lake Rd", "Hill St", "Sunset Blvd", "2nd Ave", "Market St", "River Rd"]
+FIRST_NAMES = ["James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David",
+               "Elizabeth", "Maria", "Wei", "Aisha", "Carlos", "Priya", "Olga", "Kenji", "Fatima"]
+LAST_NAMES = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Lopez",
+              "Nguyen", "Kim", "Patel", "Khan", "Silva", "Novak", "Sato", "Okafor", "Cohen"]
+ITEMS = ["Parcel", "Documents", "Electronics", "Groceries", "Furniture", "Clothing", "Books",
+         "Medical Supplies", "Auto Parts", "Flowers", "Appliance", "Toys"]
+
+
+def zipf_cum_weights(n, exponent):
+    """
+    Cumulative weights of a Zipf distribution over ranks 1..n.
+    Args:
+        n: Number of ranks.
+        exponent: The Zipf exponent, higher values skew harder.
+    Returns:
+        list: Cumulative weights, usable with bisect or random.choices.
+    """
+    return list(itertools.accumulate(1.0 / math.pow(rank, exponent) for rank in range(1, n + 1)))
+
+
+def username_for(index):
+    return f"user_{index:07d}"
+
+
+def _point(lon, lat):
+    return {"type": "Point", "coordinates": [round(lon, 6), round(lat, 6)]}
+
+
+def build_delivery(index, rng, customer_cum_weights, customer_order, now, options):
+    """
+    Build one synthetic delivery document as stored in Mongo.
+    Args:
+        index: Global sequence number, used for the delivery ID.
+        rng: The random.Random instance of the batch.
+        customer_cum_weights: Zipf cumulative weights over customer ranks.
+        customer_order: Maps customer rank to user index.
+        now: Upper bound for all timestamps.
+        options: The parsed command line options.
+    Returns:
+        dict: The raw delivery document.
+    """
+    rank = bisect.bisect_left(customer_cum_weights, rng.random() * customer_cum_weights[-1])
+    customer = username_for(customer_order[min(rank, len(customer_order) - 1)])
+    hub_name, hub_lon, hub_lat, _ = HUBS[bisect.bisect_left(HUB_CUM_WEIGHTS, rng.random() * HUB_CUM_WEIGHTS[-1])]
+    final = bisect.bisect_left(FINAL_STATUS_CUM_WEIGHTS, rng.random() * FINAL_STATUS_CUM_WEIGHTS[-1])
+
+    origin_lon, origin_lat = rng.gauss(hub_lon, 0.15), rng.gauss(hub_lat, 0.15)
+    dest_lon, dest_lat = rng.gauss(hub_lon, 0.15), rng.gauss(hub_lat, 0.15)
+
+    # pending, then a trail of in-transit pings, then out for delivery and delivered
+    pings = 0
+    if final >= 1:
+        pings = min(int(rng.lognormvariate(options.history_mu, options.history_sigma)) + 1, options.max_history)
+    steps = ["pending"] + ["in transit"] * pings
+    if final >= 2:
+        steps.append("out for delivery")
+    if final >= 3:
+        steps.append("delivered")
+
+    created_at = now - timedelta(seconds=rng.random() * options.days * 86400)
+    timestamp = created_at
+    history = []
+    total = len(steps)
+    for position, status in enumerate(steps):
+        progress = position / (total - 1) if total > 1 else 0.0
+        history.append({
+            "status": status,
+            "location": _point(
+                origin_lon + (dest_lon - origin_lon) * progress + rng.gauss(0, 0.005),
+                origin_lat + (dest_lat - origin_lat) * progress + rng.gauss(0, 0.005)
+            ),
+            "timestamp": timestamp
+        })
+        timestamp = min(timestamp + timedelta(minutes=rng.expovariate(1 / 45)), now)
+
+    return {
+        "delivery_id": f"DEL{index:09d}",
+        "title": f"{rng.choice(ITEMS)} #{index}",
+        "status": steps[-1],
+        "customer_id": customer,
+        "recipient_name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+        "current_location": history[-1]["location"],
+        "destination": f"{rng.randint(1, 9999)} {rng.choice(STREETS)}, {hub_name}",
+        "created_at": created_at,
+        "last_updated": history[-1]["timestamp"],
+        "status_history": history
+    }
+
+
+def _customer_order(options):
+    # Popular customers are spread over the user ID space, not the first N users
+    order = list(range(options.users))
+    random.Random(f"{options.seed}:customers").shuffle(order)
+    return order
+
+
+def _write_batches(task):
+    """Worker entry point, generates and inserts a range of delivery batches"""
+    options, batch_indexes = task
+    client = MongoClient(settings.MONGODB_SETTINGS["host"])
+    collection = client[settings.MONGODB_SETTINGS["db"]][Delivery._meta["collection"]]
+    customer_cum_weights = zipf_cum_weights(options.users, options.zipf)
+    customer_order = _customer_order(options)
+    now = datetime.fromisoformat(options.now)
+    written = 0
+    try:
+        for batch_index in batch_indexes:
+            # Seeding per batch keeps the output identical whatever the number of workers
+            rng = random.Random(f"{options.seed}:{batch_index}")
+            start = batch_index * options.batch_size
+            end = min(start + options.batch_size, options.deliveries)
+            docs = [
+                build_delivery(index, rng, customer_cum_weights, customer_order, now, options)
+                for index in range(start, end)
+            ]
+            collection.insert_many(docs, ordered=False)
+            written += len(docs)
+    finally:
+        client.close()
+    return written
+
+
+def generate_users(options):
+    """Insert options.users synthetic users, the first options.admins of them are admins"""
+    # One hash for everybody, bcrypt per user would dominate the load time
+    password_hash = bcrypt.hashpw(options.password.encode(), bcrypt.gensalt(rounds=4)).decode()
+    created_at = datetime.fromisoformat(options.now)
+    collection = User._get_collection()
+    for start in range(0, options.users, options.batch_size):
+        end = min(start + options.batch_size, options.users)
+        collection.insert_many([
+            {
+                "username": username_for(index),
+                "email": f"{username_for(index)}@example.com",
+                "password_hash": password_hash,
+                "is_admin": index < options.admins,
+                "created_at": created_at
+            }
+            for index in range(start, end)
+        ], ordered=False)
+    logger.info(f"Created {options.users} users")
+
+
+def generate_deliveries(options):
+    """Insert options.deliveries synthetic deliveries using options.workers processes"""
+    batches = list(range(math.ceil(options.deliveries / options.batch_size)))
+    workers = max(1, min(options.workers, len(batches)))
+    tasks = [(options, batches[worker::workers]) for worker in range(workers)]
+    started = time.perf_counter()
+    if workers == 1:
+        written = sum(map(_write_batches, tasks))
+    else:
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            written = sum(pool.imap_unordered(_write_batches, tasks))
+    elapsed = time.perf_counter() - started
+    logger.info(f"Created {written} deliveries in {elapsed:.1f}s ({written / max(elapsed, 1e-9):,.0f}/s)")
+
+
+def run_generate(options):
+    """Generate a large synthetic data set"""
+    logger.info(
+        f"Generating {options.users} users and {options.deliveries} deliveries "
+        f"(seed={options.seed}, workers={options.workers}, batch_size={options.batch_size})"
+    )
+    # Dropping rather than emptying the collections lets indexes be built once after the load
+    User.drop_collection()
+    Delivery.drop_collection()
+    generate_users(options)
+    generate_deliveries(options)
+    # Build indexes once after the load instead of maintaining them per insert
+    User.ensure_indexes()
+    Delivery.ensure_indexes()
+    logger.info("Seed completed successfully")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Seed the database with demo or synthetic data")
+    parser.add_argument("--clean", action="store_true", help="only remove all data")
+    parser.add_argument("--users", type=int, default=0,
+                        help="number of synthetic users, enables the generator when set")
+    parser.add_argument("--deliveries", type=int, default=0, help="number of synthetic deliveries")
+    parser.add_argument("--admins", type=int, default=1, help="number of synthetic users that are admins")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, the same seed gives the same data")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="writer processes")
+    parser.add_argument("--batch-size", type=int, default=5000, help="documents per insert_many")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of deliveries per customer")
+    parser.add_argument("--history-mu", type=float, default=1.2,
+                        help="log-mean of the number of in-transit pings")
+    parser.add_argument("--history-sigma", type=float, default=0.8,
+                        help="log-stddev of the number of in-transit pings")
+    parser.add_argument("--max-history", type=int, default=200, help="cap on in-transit pings per delivery")
+    parser.add_argument("--days", type=int, default=90, help="deliveries are created over the last N days")
+    parser.add_argument("--password", default="password123", help="password of every synthetic user")
+    parser.add_argument("--now", default=None,
+                        help="ISO timestamp used as 'now', defaults to midnight UTC today. "
+                             "Pass the same value with the same --seed to reproduce a data set")
+    options = parser.parse_args(argv)
+    if options.deliveries and not options.users:
+        parser.error("--deliveries requires --users")
+    if options.now is None:
+        options.now = datetime.now(dt_timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0,
+                                                           microsecond=0).isoformat()
+    return options
+
+
 if __name__ == "__main__":
-    run_seed() 
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    options = parse_args()
+    random.seed(options.seed)
+    if options.clean:
+        clean_database()
+    elif options.users:
+        run_generate(options)
+    else:
+        run_seed()
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from users.utils.redis_auth import redis_token_manager, LEGACY_PREFIX
+
+
+class Command(BaseCommand):
+    help = "Move tokens stored under token:<JWT> keys to the compact jti keys and session index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Keys per SCAN call")
+        parser.add_argument("--dry-run", action="store_true", help="Count the legacy keys without moving them")
+
+    def handle(self, *args, **options):
+        client = redis_token_manager.redis_client
+        migrated = skipped = 0
+        for key in client.scan_iter(match=f"{LEGACY_PREFIX}*", count=options["batch_size"]):
+            token = (key.decode() if isinstance(key, bytes) else key)[len(LEGACY_PREFIX):]
+            if options["dry_run"]:
+                migrated += 1
+                continue
+            try:
+                user_id = redis_token_manager.migrate_token(token)
+            except Exception as e:
+                self.stderr.write(f"Could not migrate {key!r}: {e}")
+                user_id = None
+            if user_id:
+                migrated += 1
+            else:
+                # Expired or not a valid token
+                client.delete(key)
+                skipped += 1
+
+        if options["dry_run"]:
+            self.stdout.write(f"{migrated} legacy token keys to migrate")
+        else:
+            self.stdout.write(f"Migrated {migrated} tokens, removed {skipped} expired or invalid keys")
@@ -13,6 +13,7 @@ class IsAuthenticated(BasePermission):
             user = extract_user_from_request(request)
             if not user:
                 raise AuthenticationFailed(self.message)
+            # Also sets it on the Django request, ReadRoutingMiddleware reads it after a write
             request.user = user
             return True
         except Exception:
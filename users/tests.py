@@ -3,9 +3,12 @@ import pytest
 from .mongo.user import User
 from django.test import Client
 from rest_framework.test import APIClient
-from .utils.jwt_utils import generate_token, decode_token, invalidate_token
+from .utils.jwt_utils import generate_token, issue_token, decode_token, invalidate_token
 from .utils.auth_utils import extract_user_from_request
-from .utils.redis_auth import redis_token_manager
+from .utils.redis_auth import redis_token_manager, STORE_TOKEN_SCRIPT
+from .utils.revocation import RevocationSet, BloomFilter, revoked_tokens
+from monitoring.redis_client import create_client, connection_options, redis_circuit
+from monitoring.metrics import TOKEN_VALIDATIONS, REDIS_CIRCUIT_STATE
 from rest_framework.exceptions import AuthenticationFailed
 import jwt
 from django.conf import settings
@@ -14,8 +17,14 @@ import bcrypt
 from bson import ObjectId
 from datetime import datetime
 from deliveries.mongo.delivery import Delivery
+from deliveries.utils.serializers import msgpack_dumps, msgpack_loads
 import random
 import time
+import redis
+import socket
+import threading
+from io import StringIO
+from django.core.management import call_command
 
 # Create your tests here.
 
@@ -158,6 +167,22 @@ def test_login_success(api_client, sample_user):
     assert response.status_code == 200
     assert "token" in response.data
 
+def test_login_msgpack(api_client, sample_user):
+    """Test login with a MessagePack request and response"""
+    data = {
+        "username": sample_user.username,
+        "password": "password123"
+    }
+    response = api_client.post(
+        "/api/v1/users/login/",
+        msgpack_dumps(data),
+        content_type="application/msgpack",
+        HTTP_ACCEPT="application/msgpack"
+    )
+    assert response.status_code == 200
+    assert response["Content-Type"] == "application/msgpack"
+    assert "token" in msgpack_loads(response.content)
+
 def test_login_invalid_credentials(api_client, sample_user):
     """Test login with invalid credentials"""
     data = {
@@ -258,7 +283,7 @@ def test_redis_token_refresh(sample_user):
     # Verify old token is invalidated
     assert not redis_token_manager.validate_token(old_token)
     # Verify new token exists in Redis
-    assert redis_token_manager.redis_client.exists(f"token:{new_token}")
+    assert redis_token_manager.redis_client.exists(redis_token_manager.token_key(new_token))
     # Verify new token is valid
     assert redis_token_manager.validate_token(new_token)
 
@@ -269,3 +294,311 @@ def test_redis_token_invalidation(sample_user):
     assert redis_token_manager.validate_token(token)
     redis_token_manager.invalidate_token(token)
     assert not redis_token_manager.validate_token(token)
+
+@pytest.fixture
+def stateless(settings):
+    settings.AUTH_TOKEN_MODE = "stateless"
+    revoked_tokens.reset()
+    yield settings
+    revoked_tokens.reset()
+
+class Unreachable:
+    def __getattr__(self, name):
+        raise AssertionError(f"Redis used: {name}")
+
+def test_stateless_verification_skips_redis(sample_user, stateless, monkeypatch):
+    """Test that stateless tokens are verified without Redis"""
+    token = generate_token(str(sample_user.id))
+    assert jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])["jti"]
+    assert decode_token(token)["user_id"] == str(sample_user.id)
+
+    monkeypatch.setattr(redis_token_manager, "_redis_client", Unreachable())
+    monkeypatch.setattr(revoked_tokens, "_redis_client", Unreachable())
+    request = type("Request", (), {"META": {"HTTP_AUTHORIZATION": f"Bearer {token}"}})()
+    assert extract_user_from_request(request).id == sample_user.id
+
+def test_stateless_logout_revokes_everywhere(api_client, sample_user, stateless):
+    """Test that a stateless logout reaches the revocation set of other workers"""
+    token = generate_token(str(sample_user.id))
+    other_worker = RevocationSet()
+    other_worker.redis_client = revoked_tokens.redis_client
+    other_worker._load()
+
+    response = api_client.post("/api/v1/users/logout/", HTTP_AUTHORIZATION=f"Bearer {token}")
+    assert response.status_code == 200
+    assert decode_token(token) is None
+    jti = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])["jti"]
+    assert not other_worker._revoked.get(jti)
+    assert other_worker.sync() == 1
+    assert other_worker._revoked.get(jti)
+
+def test_stateless_token_without_jti_checked_in_redis(sample_user, stateless):
+    """Test that a token without a jti is still looked up in Redis"""
+    payload = {"user_id": str(sample_user.id), "exp": int(datetime.now().timestamp()) + 3600}
+    token = jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm="HS256")
+    assert decode_token(token) is None
+    redis_token_manager.store_token(token, str(sample_user.id))
+    assert decode_token(token)["user_id"] == str(sample_user.id)
+
+def test_revocation_bloom_filter(sample_user, stateless):
+    """Test the bloom filter's error rate and revocations through it"""
+    bloom = BloomFilter(1000, 0.01)
+    items = [f"jti-{i}" for i in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items)
+    assert sum(f"other-{i}" in bloom for i in range(10000)) < 300
+
+    stateless.AUTH_REVOCATION_BLOOM = {"capacity": 1000, "error_rate": 0.01}
+    token = generate_token(str(sample_user.id))
+    assert decode_token(token)
+    assert revoked_tokens._bloom is not None
+    invalidate_token(token)
+    assert decode_token(token) is None
+
+def test_revocation_checks_keep_the_normal_socket_timeout():
+    """Test only the blocking stream reads get the long socket timeout"""
+    revocations = RevocationSet()
+    assert revocations.redis_client.connection_pool.connection_kwargs["socket_timeout"] == settings.REDIS_SOCKET_TIMEOUT
+    assert revocations.stream_client.connection_pool.connection_kwargs["socket_timeout"] > settings.REDIS_SOCKET_TIMEOUT
+    assert revocations.stream_client is not revocations.redis_client
+
+def test_tokens_stored_under_compact_keys(sample_user):
+    """Test that tokens are stored under short jti keys"""
+    token = generate_token(str(sample_user.id))
+    jti = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])["jti"]
+    assert redis_token_manager.token_key(token) == f"t:{jti}"
+    assert len(redis_token_manager.token_key(token)) < 24
+    assert redis_token_manager.redis_client.get(f"t:{jti}").decode() == str(sample_user.id)
+    assert [session_id for session_id, _ in redis_token_manager.sessions(str(sample_user.id))] == [jti]
+
+def test_sessions_and_logout_all(api_client, sample_user):
+    """Test listing sessions and logging out of all of them"""
+    tokens = [generate_token(str(sample_user.id)) for _ in range(3)]
+    response = api_client.get("/api/v1/users/sessions/", HTTP_AUTHORIZATION=f"Bearer {tokens[0]}")
+    assert response.status_code == 200
+    sessions = response.json()["sessions"]
+    assert len(sessions) == 3
+    assert [session["current"] for session in sessions].count(True) == 1
+
+    response = api_client.post("/api/v1/users/logout-all/", HTTP_AUTHORIZATION=f"Bearer {tokens[1]}")
+    assert response.status_code == 200
+    assert response.json()["sessions"] == 3
+    assert not any(redis_token_manager.validate_token(token) for token in tokens)
+    assert redis_token_manager.sessions(str(sample_user.id)) == []
+
+def test_sessions_key_ttl_only_grows(sample_user):
+    """Test that storing a token never shortens the sessions index TTL"""
+    user_id = str(sample_user.id)
+    generate_token(user_id)
+    sessions_key = f"sessions:{user_id}"
+    ttl = redis_token_manager.redis_client.ttl(sessions_key)
+    assert ttl > 3600
+    # A migrated legacy token lives an hour, the index keeps the longer session
+    token = store_legacy_token(sample_user)
+    assert redis_token_manager.validate_token(token)
+    assert redis_token_manager.redis_client.ttl(sessions_key) >= ttl - 1
+    assert len(redis_token_manager.sessions(user_id)) == 2
+
+def store_legacy_token(user, offset=0):
+    payload = {"user_id": str(user.id), "exp": int(datetime.now().timestamp()) + 3600 + offset}
+    token = jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm="HS256")
+    redis_token_manager.redis_client.setex(f"token:{token}", 3600, str(user.id))
+    return token
+
+def test_legacy_token_migrated_on_use(sample_user):
+    """Test that a token under a legacy key is migrated when used"""
+    token = store_legacy_token(sample_user)
+    assert redis_token_manager.validate_token(token)
+    assert not redis_token_manager.redis_client.exists(f"token:{token}")
+    assert redis_token_manager.redis_client.exists(redis_token_manager.token_key(token))
+    assert len(redis_token_manager.sessions(str(sample_user.id))) == 1
+
+def test_migrate_tokens_command(sample_user):
+    """Test that migrate_tokens moves legacy tokens and removes invalid ones"""
+    tokens = [store_legacy_token(sample_user, offset) for offset in range(3)]
+    redis_token_manager.redis_client.setex("token:not-a-jwt", 3600, "x")
+    out = StringIO()
+    call_command("migrate_tokens", stdout=out)
+    assert "Migrated 3 tokens, removed 1" in out.getvalue()
+    assert not list(redis_token_manager.redis_client.scan_iter(match="token:*"))
+    assert all(redis_token_manager.redis_client.exists(redis_token_manager.token_key(token)) for token in tokens)
+
+def test_issue_token_stores_with_one_command(sample_user, monkeypatch):
+    """Test that issuing a token takes a single Redis command"""
+    issue_token(sample_user)  # loads the script
+    client = redis_token_manager.redis_client
+    commands = []
+    execute_command = client.execute_command
+    monkeypatch.setattr(client, "execute_command", lambda *args, **kwargs: commands.append(args[0]) or execute_command(*args, **kwargs))
+
+    token = issue_token(sample_user)
+    assert commands == ["EVALSHA"]
+    assert redis_token_manager.validate_token(token)
+    assert len(redis_token_manager.sessions(str(sample_user.id))) == 2
+
+def test_refresh_endpoint(api_client, sample_user):
+    """Test that a refresh swaps the token and the old one stops working"""
+    response = api_client.post("/api/v1/users/login/", {"username": sample_user.username, "password": "password123"}, format="json")
+    old_token = response.json()["token"]
+
+    response = api_client.post("/api/v1/users/refresh/", HTTP_AUTHORIZATION=f"Bearer {old_token}")
+    assert response.status_code == 200
+    new_token = response.json()["token"]
+    assert decode_token(new_token)["user_id"] == str(sample_user.id)
+    assert decode_token(old_token) is None
+    assert [session_id for session_id, _ in redis_token_manager.sessions(str(sample_user.id))] == \
+        [redis_token_manager.session_id(new_token)]
+
+    response = api_client.post("/api/v1/users/refresh/", HTTP_AUTHORIZATION=f"Bearer {old_token}")
+    assert response.status_code == 401
+    assert api_client.post("/api/v1/users/refresh/").status_code == 401
+
+def test_refresh_endpoint_reports_unreachable_token_store(api_client, sample_user, monkeypatch):
+    """Test a refresh that can't reach Redis gets a 503, not an invalid token"""
+    token = issue_token(sample_user)
+
+    def unreachable(*args, **kwargs):
+        raise redis.ConnectionError("Redis is down")
+
+    monkeypatch.setattr(redis_token_manager, "_store", unreachable)
+    response = api_client.post("/api/v1/users/refresh/", HTTP_AUTHORIZATION=f"Bearer {token}")
+    assert response.status_code == 503
+    assert response.json() == {"error": "Authentication temporarily unavailable"}
+    assert decode_token(token)
+
+class RedisStandIn:
+    """fakeredis served over TCP, behind a proxy that can be killed or slowed"""
+
+    def __init__(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        self.server = fakeredis.TcpFakeServer(("127.0.0.1", 0))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.delay = 0
+        self.connections = []
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+        self._serve()
+
+    def _serve(self):
+        threading.Thread(target=self._accept, args=(self.listener,), daemon=True).start()
+
+    def _accept(self, listener):
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(self.server.server_address)
+            self.connections += [client, upstream]
+            threading.Thread(target=self._pipe, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=self._pipe, args=(upstream, client), daemon=True).start()
+
+    def _pipe(self, source, target):
+        try:
+            while data := source.recv(65536):
+                if self.delay:
+                    time.sleep(self.delay)
+                target.sendall(data)
+        except OSError:
+            pass
+        finally:
+            source.close()
+            target.close()
+
+    def kill(self):
+        """Refuse connections and drop the open ones, like a Redis that went away"""
+        self.listener.shutdown(socket.SHUT_RDWR)
+        self.listener.close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.connections = []
+
+    def revive(self):
+        self.listener = socket.create_server(("127.0.0.1", self.port))
+        self._serve()
+
+    def client(self):
+        return create_client(connection_pool=redis.ConnectionPool(host="127.0.0.1", port=self.port, **connection_options()))
+
+    def close(self):
+        self.kill()
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def redis_stand_in(settings):
+    settings.REDIS_CIRCUIT_FAILURES = 2
+    settings.REDIS_CIRCUIT_RESET_SECONDS = 0.5
+    stand_in = RedisStandIn()
+    redis_circuit.reset()
+    redis_token_manager.redis_client = stand_in.client()
+    # fakeredis' TCP server drops the connection after an error reply such as NOSCRIPT
+    redis_token_manager.redis_client.script_load(STORE_TOKEN_SCRIPT)
+    yield stand_in
+    redis_token_manager.reset()
+    redis_circuit.reset()
+    stand_in.close()
+
+def outcomes():
+    return {outcome: count for (outcome,), count in TOKEN_VALIDATIONS.collect().items()}
+
+def test_auth_degrades_while_redis_is_down(api_client, sample_user, redis_stand_in, settings):
+    """Test token checks, the circuit breaker and login while Redis is down"""
+    token = issue_token(sample_user)
+    logged_out = issue_token(sample_user)
+    invalidate_token(logged_out)
+    assert decode_token(token)["user_id"] == str(sample_user.id)
+
+    redis_stand_in.kill()
+    before = outcomes()
+    assert decode_token(token)["user_id"] == str(sample_user.id)
+    assert decode_token(token)
+    assert redis_circuit.is_open
+    assert REDIS_CIRCUIT_STATE.collect()[("redis",)] == 2
+    # The circuit is open, no more time spent on the socket
+    start = time.perf_counter()
+    assert decode_token(token)
+    assert time.perf_counter() - start < 0.1
+    assert outcomes()["outage_trusted"] - before.get("outage_trusted", 0) == 3
+    # Known to this worker as logged out
+    assert decode_token(logged_out) is None
+
+    settings.AUTH_OUTAGE_POLICY = "reject"
+    assert decode_token(token) is None
+    settings.AUTH_OUTAGE_POLICY = "trust_jwt"
+    settings.AUTH_OUTAGE_TRUST_SECONDS = 0
+    assert decode_token(token) is None
+    settings.AUTH_OUTAGE_TRUST_SECONDS = 300
+
+    response = api_client.post("/api/v1/users/login/", {"username": sample_user.username, "password": "password123"}, format="json")
+    assert response.status_code == 503
+    assert response["Retry-After"] == "1"
+
+    redis_stand_in.revive()
+    time.sleep(0.5)
+    assert decode_token(token)
+    assert redis_circuit.state == "closed"
+    assert redis_circuit.outage_seconds() == 0
+    response = api_client.post("/api/v1/users/login/", {"username": sample_user.username, "password": "password123"}, format="json")
+    assert response.status_code == 200
+
+def test_slow_redis_times_out_and_opens_the_circuit(sample_user, redis_stand_in):
+    """Test that slow Redis commands time out and open the circuit"""
+    token = issue_token(sample_user)
+    redis_stand_in.delay = 1
+    start = time.perf_counter()
+    for _ in range(3):
+        assert decode_token(token)
+    # Two timed out commands, each tried twice, open the circuit and the third check doesn't wait
+    assert time.perf_counter() - start < 4 * settings.REDIS_SOCKET_TIMEOUT + 0.3
+    assert redis_circuit.is_open
+
+    redis_stand_in.delay = 0
+    time.sleep(0.5)
+    assert decode_token(token)
+    assert redis_circuit.state == "closed"
+
@@ -4,6 +4,9 @@ from users import views
 urlpatterns = [
     path('register/', views.register, name='register'),
     path('login/', views.login, name='login'),
+    path('refresh/', views.refresh, name='refresh'),
     path('logout/', views.logout, name='logout'),
+    path('logout-all/', views.logout_all, name='logout_all'),
+    path('sessions/', views.sessions, name='sessions'),
     path('create-admin/', views.create_admin, name='create_admin'),
 ] 
\ No newline at end of file
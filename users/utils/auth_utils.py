@@ -1,7 +1,7 @@
+from urllib.parse import parse_qs
 from rest_framework.exceptions import AuthenticationFailed
 from django.conf import settings
 from users.mongo.user import User
-from users.utils.redis_auth import redis_token_manager
 from users.utils.jwt_utils import decode_token
 
 def extract_user_from_request(request):
@@ -25,15 +25,50 @@ def extract_user_from_request(request):
     except ValueError:
         raise AuthenticationFailed("Invalid authorization header format")
 
-    if not redis_token_manager.validate_token(token):
-        raise AuthenticationFailed("Invalid or expired token")
-
+    # decode_token checks the token in Redis, or locally in stateless mode
     decoded = decode_token(token)
     if not decoded:
-        raise AuthenticationFailed("Invalid token")
+        raise AuthenticationFailed("Invalid or expired token")
 
     user = User.objects(id=decoded["user_id"]).first()
     if not user:
         raise AuthenticationFailed("User not found")
 
     return user
+
+
+def extract_user_from_scope(scope):
+    """
+    Extract the user of a WebSocket connection from its JWT token.
+    Browsers can't set headers on a WebSocket, so the token is taken from the
+    token query parameter unless an Authorization header is sent.
+    Args:
+        scope: The ASGI connection scope.
+    Returns:
+        User: The user, or None if the token is missing, invalid or expired.
+    """
+    token = None
+    for name, value in scope.get("headers") or []:
+        if name == b"authorization":
+            parts = value.decode("latin-1").split()
+            if len(parts) == 2 and parts[0].lower() == "bearer":
+                token = parts[1]
+            break
+    if token is None:
+        token = (parse_qs(scope.get("query_string", b"").decode("latin-1")).get("token") or [None])[0]
+    if not token:
+        return None
+    return user_from_token(token)
+
+
+def user_from_token(token):
+    """
+    Args:
+        token: The JWT.
+    Returns:
+        User: The user the token was issued to, or None if it is invalid or expired.
+    """
+    decoded = decode_token(token)
+    if not decoded:
+        return None
+    return User.objects(id=decoded["user_id"]).first()
@@ -1,46 +1,129 @@
 import jwt
-from datetime import datetime, timedelta, timezone
+import redis
+import secrets
+from datetime import datetime, timezone
 from django.conf import settings
 from users.mongo.user import User
 from users.utils.redis_auth import redis_token_manager
+from users.utils.revocation import revoked_tokens
+from monitoring.timing import span
+from monitoring.metrics import TOKEN_VALIDATIONS
+
+def build_payload(user_id):
+    """Build the claims of a new token for a user"""
+    now = datetime.now(timezone.utc)
+    return {
+        "user_id": str(user_id),  # Convert ObjectId to string
+        "jti": secrets.token_urlsafe(12),  # lets a single token be revoked
+        "iat": int(now.timestamp()),
+        "exp": int(now.timestamp()) + settings.JWT_TTL_SECONDS
+    }
+
+def issue_token(user):
+    """
+    Issue a token for a user that is already loaded, e.g. by login.
+    The token is stored in Redis with one command and never decoded again.
+    Args:
+        user: The User document, or its ID.
+    Returns:
+        str: The token.
+    """
+    payload = build_payload(getattr(user, "id", user))
+    token = jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm="HS256")
+    redis_token_manager.store_payload(token, payload)
+    return token
 
 def generate_token(user_id):
     """Generate a JWT token for a user"""
     user = User.objects(id=user_id).first()
     if not user:
         return None
-        
-    payload = {
-        "user_id": str(user.id),  # Convert ObjectId to string
-        "iat": datetime.now(timezone.utc),
-        "exp": datetime.now(timezone.utc) + timedelta(days=settings.JWT_TTL_DAYS)
-    }
-    token = jwt.encode(payload, settings.JWT_SECRET_KEY, algorithm="HS256")
-    
-    # Store token in Redis
-    redis_token_manager.store_token(token, str(user.id))
-    
-    return token
+    return issue_token(user)
 
 def decode_token(token):
     """Decode and validate a JWT token"""
+    if settings.AUTH_TOKEN_MODE == "stateless":
+        return verify_token(token)
     try:
         # First check if token is in Redis
         if not redis_token_manager.validate_token(token):
             return None
 
         # Then decode and verify JWT
-        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])
+        with span("jwt"):
+            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])
         return payload
     except jwt.InvalidTokenError:
         return None
 
+def verify_token(token):
+    """
+    Verify a token without Redis: the signature and expiry are checked locally
+    and the jti against the revoked tokens. Tokens issued without a jti can't
+    be revoked that way and are still checked in Redis.
+    Args:
+        token: The JWT.
+    Returns:
+        dict: The payload, or None if the token is invalid, expired or revoked.
+    """
+    try:
+        with span("jwt"):
+            payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        TOKEN_VALIDATIONS.inc(outcome="expired")
+        return None
+    except jwt.InvalidTokenError:
+        TOKEN_VALIDATIONS.inc(outcome="invalid")
+        return None
+
+    jti = payload.get("jti")
+    if jti is None:
+        return payload if redis_token_manager.validate_token(token) else None
+    try:
+        revoked = revoked_tokens.is_revoked(jti)
+    except (redis.ConnectionError, redis.TimeoutError):
+        return payload if redis_token_manager.outage_fallback(payload) else None
+    if revoked:
+        TOKEN_VALIDATIONS.inc(outcome="revoked")
+        return None
+    TOKEN_VALIDATIONS.inc(outcome="valid")
+    return payload
+
 def invalidate_token(token):
     """Invalidate a JWT token"""
+    # Revoke the jti too, so the token is rejected in either auth mode
+    try:
+        payload = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])
+        if payload.get("jti"):
+            revoked_tokens.revoke(payload["jti"], payload["exp"])
+    except jwt.InvalidTokenError:
+        pass
     return redis_token_manager.invalidate_token(token)
 
+def invalidate_user_tokens(user_id, session_ids=None):
+    """
+    Log a user out everywhere, or out of the given sessions.
+    Args:
+        user_id: The user ID.
+        session_ids: Session ids from redis_token_manager.sessions, every session if None.
+    Returns:
+        int: Number of sessions ended.
+    """
+    sessions = redis_token_manager.invalidate_sessions(user_id, session_ids)
+    # Sessions of tokens without a jti are keyed by a hash and can't be revoked statelessly
+    revoked_tokens.revoke_many([(session_id, exp) for session_id, exp in sessions if not session_id.startswith("h:")])
+    return len(sessions)
+
 def refresh_token(old_token):
-    """Generate a new token and invalidate the old one"""
+    """
+    Generate a new token and invalidate the old one.
+    Args:
+        old_token: The token to swap.
+    Returns:
+        str: The new token, or None if the old one is not valid.
+    Raises:
+        redis.ConnectionError, redis.TimeoutError: The token store is unreachable.
+    """
     try:
         # First validate the old token
         payload = decode_token(old_token)
@@ -51,14 +134,17 @@ def refresh_token(old_token):
         if not user_id:
             return None
             
-        # Generate new token
-        new_token = generate_token(user_id)
-        if not new_token:
-            return None
+        # The old token already names the user, no need to load it
+        new_payload = build_payload(user_id)
+        new_token = jwt.encode(new_payload, settings.JWT_SECRET_KEY, algorithm="HS256")
 
-        # Refresh in Redis
-        if redis_token_manager.refresh_token(old_token, new_token):
+        # Swap the tokens in Redis
+        if redis_token_manager.refresh_token(old_token, new_token, new_payload):
+            if payload.get("jti"):
+                revoked_tokens.revoke(payload["jti"], payload["exp"])
             return new_token
         return None
+    except (redis.ConnectionError, redis.TimeoutError):
+        raise
     except Exception:
         return None
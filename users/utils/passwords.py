@@ -0,0 +1,38 @@
+import time
+import bcrypt
+from monitoring.metrics import BCRYPT_IN_FLIGHT, BCRYPT_LATENCY
+
+
+def hash_password(password):
+    """
+    Hash a password with bcrypt.
+    Args:
+        password: The plain text password.
+    Returns:
+        str: The bcrypt hash.
+    """
+    BCRYPT_IN_FLIGHT.inc(operation="hash")
+    start = time.perf_counter()
+    try:
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    finally:
+        BCRYPT_LATENCY.observe(time.perf_counter() - start, operation="hash")
+        BCRYPT_IN_FLIGHT.dec(operation="hash")
+
+
+def check_password(password, password_hash):
+    """
+    Check a password against a bcrypt hash.
+    Args:
+        password: The plain text password.
+        password_hash: The stored bcrypt hash.
+    Returns:
+        bool: True if the password matches.
+    """
+    BCRYPT_IN_FLIGHT.inc(operation="check")
+    start = time.perf_counter()
+    try:
+        return bcrypt.checkpw(password.encode(), password_hash.encode())
+    finally:
+        BCRYPT_LATENCY.observe(time.perf_counter() - start, operation="check")
+        BCRYPT_IN_FLIGHT.dec(operation="check")
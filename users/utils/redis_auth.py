@@ -1,125 +1,311 @@
-import redis
+import os
+import hashlib
+import logging
 from django.conf import settings
 import jwt
+import redis
 from datetime import datetime, timedelta
+from monitoring.redis_client import create_client, redis_circuit
+from monitoring.timing import span
+from monitoring.metrics import TOKEN_VALIDATIONS
+
+logger = logging.getLogger(__name__)
+
+# Active sessions of a user, a sorted set of session ids scored by expiry
+SESSIONS_KEY = "sessions:{user_id}"
+# Tokens used to be stored under their whole JWT
+LEGACY_PREFIX = "token:"
+
+# Stores a token and adds it to its user's sessions in one command.
+# KEYS: token key, sessions key, and for a refresh the old token key.
+# ARGV: user_id, session id, exp, ttl, now, and for a refresh the old session id.
+# A refresh only goes through if the old token is still stored. The sessions
+# key lives until its last session expires, a shorter lived token never cuts it.
+STORE_TOKEN_SCRIPT = """
+if KEYS[3] then
+    if redis.call('DEL', KEYS[3]) == 0 then
+        return 0
+    end
+    redis.call('ZREM', KEYS[2], ARGV[6])
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[4])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[5])
+local ttl = tonumber(ARGV[4])
+local last = redis.call('ZRANGE', KEYS[2], -1, -1, 'WITHSCORES')
+if last[2] then
+    ttl = math.max(ttl, math.ceil(tonumber(last[2]) - tonumber(ARGV[5])))
+end
+if redis.call('TTL', KEYS[2]) < ttl then
+    redis.call('EXPIRE', KEYS[2], ttl)
+end
+return 1
+"""
 
 class RedisTokenManager:
     def __init__(self):
-        self.redis_client = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB
-        )
+        self._redis_client = None
+        self._client_pid = None
+        self._store_script = None
+
+    @property
+    def redis_client(self):
+        """Redis client, created on first use and again in a forked worker"""
+        if self._redis_client is None or self._client_pid != os.getpid():
+            self.redis_client = create_client()
+        return self._redis_client
+
+    @redis_client.setter
+    def redis_client(self, client):
+        self._redis_client = client
+        self._client_pid = os.getpid()
+        self._store_script = None
+
+    @property
+    def store_script(self):
+        """STORE_TOKEN_SCRIPT registered on the current client"""
+        client = self.redis_client
+        if self._store_script is None:
+            self._store_script = client.register_script(STORE_TOKEN_SCRIPT)
+        return self._store_script
+
+    def reset(self):
+        """Drop the client without closing it, the next command creates a new one"""
+        self._redis_client = None
+        self._store_script = None
+
+    def token_key(self, token, payload=None):
+        """
+        Redis key of a token: t:<jti>, or t:h:<hash of the token> if it has no jti.
+        Args:
+            token: The token.
+            payload: The decoded token, if already decoded.
+        Returns:
+            str: The key, about 20 bytes instead of the whole JWT.
+        """
+        if payload is None:
+            payload = jwt.decode(token, options={"verify_signature": False})
+        jti = payload.get("jti")
+        if jti:
+            return f"t:{jti}"
+        return "t:h:" + hashlib.blake2b(token.encode(), digest_size=12).hexdigest()
+
+    def session_id(self, token, payload=None):
+        """The member of a token in its user's session index, its key without the prefix"""
+        return self.token_key(token, payload)[2:]
+
+    def _decode(self, token, verify_exp=True):
+        with span("jwt"):
+            return jwt.decode(
+                token, settings.JWT_SECRET_KEY, algorithms=["HS256"], options={"verify_exp": verify_exp}
+            )
+
+    def _store(self, token, payload, user_id, ttl, old_token=None, old_payload=None, client=None):
+        keys = [self.token_key(token, payload), SESSIONS_KEY.format(user_id=user_id)]
+        args = [user_id, self.session_id(token, payload), payload["exp"], ttl, int(datetime.now().timestamp())]
+        if old_token is not None:
+            keys.append(self.token_key(old_token, old_payload))
+            args.append(self.session_id(old_token, old_payload))
+        return self.store_script(keys=keys, args=args, client=client)
+
+    def store_payload(self, token, payload):
+        """
+        Store a token that was just issued, without decoding it again.
+        Args:
+            token: The encoded token.
+            payload: Its claims, with user_id and exp.
+        Returns:
+            bool: True if the token was stored.
+        """
+        exp = payload["exp"]
+        if isinstance(exp, datetime):
+            exp = int(exp.timestamp())
+        ttl = exp - int(datetime.now().timestamp())
+        if ttl <= 0:
+            return False
+        self._store(token, dict(payload, exp=exp), str(payload["user_id"]), ttl)
+        return True
 
     def store_token(self, token, user_id):
         """Store a token in Redis with user_id"""
         try:
-            decoded = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])
+            decoded = self._decode(token)
             exp = decoded.get("exp")
             if exp:
                 ttl = exp - int(datetime.now().timestamp())
                 if ttl > 0:
-                    # Store token with user_id
-                    token_key = f"token:{token}"
                     # Ensure user_id is a string
                     if not isinstance(user_id, str):
                         user_id = str(user_id)
-                    self.redis_client.setex(token_key, ttl, user_id)
-                    print(f"Stored token {token_key} with TTL {ttl}")
+                    self._store(token, decoded, user_id, ttl)
                     return True
             return False
         except jwt.InvalidTokenError:
-            print(f"Invalid token: {token}")
+            logger.warning("Not storing an invalid token")
             return False
-        except Exception as e:
-            print(f"Error storing token: {str(e)}")
+        except Exception:
+            logger.exception("Error storing token")
             return False
 
     def validate_token(self, token):
         """Validate if a token exists in Redis"""
         try:
-            # First check if token exists in Redis
-            token_key = f"token:{token}"
-            exists = self.redis_client.exists(token_key)
-            if not exists:
-                print(f"Token {token_key} not found in Redis")
+            try:
+                decoded = self._decode(token)
+            except jwt.ExpiredSignatureError:
+                TOKEN_VALIDATIONS.inc(outcome="expired")
+                # If JWT is expired, remove from Redis
+                self.invalidate_token(token)
                 return False
-
-            # Get the user_id associated with the token
-            user_id = self.redis_client.get(token_key)
-            if not user_id:
-                print(f"No user_id found for token {token_key}")
+            except jwt.InvalidTokenError as e:
+                logger.warning("JWT validation error: %s", e)
+                TOKEN_VALIDATIONS.inc(outcome="invalid")
                 return False
 
-            # Then verify JWT is still valid
             try:
-                decoded = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=["HS256"])
-                exp = decoded.get("exp")
-                if exp and exp > datetime.now().timestamp():
-                    print(f"Token {token_key} is valid")
-                    return True
-                print(f"Token {token_key} is expired")
-            except jwt.InvalidTokenError as e:
-                print(f"JWT validation error: {str(e)}")
+                user_id = self.redis_client.get(self.token_key(token, decoded))
+                if not user_id and settings.AUTH_LEGACY_TOKEN_KEYS:
+                    user_id = self.migrate_token(token)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                logger.warning("Redis unreachable validating a token: %s", e)
+                return self.outage_fallback(decoded)
+            if not user_id:
+                TOKEN_VALIDATIONS.inc(outcome="missing")
                 return False
-            
-            # If JWT is expired, remove from Redis
-            self.invalidate_token(token)
-            return False
-        except Exception as e:
-            print(f"Error validating token: {str(e)}")
+            TOKEN_VALIDATIONS.inc(outcome="valid")
+            return True
+        except Exception:
+            logger.exception("Error validating token")
+            TOKEN_VALIDATIONS.inc(outcome="error")
             return False
 
-    def refresh_token(self, old_token, new_token):
-        """Replace old token with new token in Redis"""
-        try:
-            # Get user_id from old token
-            old_token_key = f"token:{old_token}"
-            user_id = self.redis_client.get(old_token_key)
-            if not user_id:
-                print(f"Old token not found: {old_token}")
-                return False
+    def outage_fallback(self, payload):
+        """
+        Decide on a token that can't be looked up because Redis is unreachable,
+        by settings.AUTH_OUTAGE_POLICY.
+        Args:
+            payload: The token's claims, its signature and expiry already verified.
+        Returns:
+            bool: True if the token is accepted.
+        """
+        from users.utils.revocation import revoked_tokens
 
-            # Decode user_id from bytes to string if needed
-            if isinstance(user_id, bytes):
-                user_id = user_id.decode('utf-8')
-            if not isinstance(user_id, str):
-                user_id = str(user_id)
+        if (settings.AUTH_OUTAGE_POLICY == "trust_jwt"
+                and redis_circuit.outage_seconds() <= settings.AUTH_OUTAGE_TRUST_SECONDS
+                and not revoked_tokens.known_revoked(payload.get("jti"))):
+            TOKEN_VALIDATIONS.inc(outcome="outage_trusted")
+            return True
+        TOKEN_VALIDATIONS.inc(outcome="outage_rejected")
+        return False
 
-            # Store new token with the same TTL as the old token
-            decoded = jwt.decode(new_token, settings.JWT_SECRET_KEY, algorithms=["HS256"])
+    def refresh_token(self, old_token, new_token, new_payload=None):
+        """
+        Replace old token with new token in Redis.
+        Raises:
+            redis.ConnectionError, redis.TimeoutError: Redis is unreachable.
+        """
+        try:
+            old_decoded = self._decode(old_token)
+            decoded = new_payload or self._decode(new_token)
             exp = decoded.get("exp")
-            now = int(datetime.now().timestamp())
-            if exp:
-                ttl = exp - now
-                print(f"Calculated TTL for new token: {ttl}")
-                if ttl <= 0:
-                    print("TTL is not positive, using fallback TTL of 86400 seconds (1 day)")
-                    ttl = 86400
-                # Store new token first
-                new_token_key = f"token:{new_token}"
-                result = self.redis_client.setex(new_token_key, ttl, user_id)
-                print(f"Stored new token {new_token_key} with TTL {ttl}, result: {result}")
-                # Only invalidate old token after new one is stored
-                self.invalidate_token(old_token)
-                # Verify the new token was stored
-                if self.redis_client.exists(new_token_key):
-                    print(f"Verified new token {new_token_key} exists in Redis")
-                    return True
-                print(f"Failed to verify new token {new_token_key} in Redis")
-            else:
-                print("No exp in new token JWT payload")
-            return False
-        except Exception as e:
-            print(f"Error refreshing token: {str(e)}")
+            if not exp:
+                logger.warning("No exp in new token JWT payload")
+                return False
+            if isinstance(exp, datetime):
+                exp = int(exp.timestamp())
+            ttl = exp - int(datetime.now().timestamp())
+            if ttl <= 0:
+                logger.warning("TTL is not positive, using fallback TTL of 86400 seconds (1 day)")
+                ttl = 86400
+
+            # Swap the tokens in one command, only if the old one is still stored
+            user_id = str(old_decoded.get("user_id") or decoded.get("user_id"))
+            if not self._store(new_token, dict(decoded, exp=exp), user_id, ttl, old_token, old_decoded):
+                logger.warning("Refresh of user %s refused, the old token is no longer stored", user_id)
+                return False
+            return True
+        except (redis.ConnectionError, redis.TimeoutError):
+            raise
+        except Exception:
+            logger.exception("Error refreshing token")
             return False
 
     def invalidate_token(self, token):
         """Remove a token from Redis"""
         try:
-            self.redis_client.delete(f"token:{token}")
+            decoded = self._decode(token, verify_exp=False)
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.delete(self.token_key(token, decoded))
+            if decoded.get("user_id"):
+                pipeline.zrem(SESSIONS_KEY.format(user_id=decoded["user_id"]), self.session_id(token, decoded))
+            if settings.AUTH_LEGACY_TOKEN_KEYS:
+                pipeline.delete(f"{LEGACY_PREFIX}{token}")
+            pipeline.execute()
             return True
         except Exception:
             return False
 
+    def sessions(self, user_id):
+        """
+        List the active sessions of a user.
+        Args:
+            user_id: The user ID.
+        Returns:
+            list: (session id, expiry timestamp) pairs, oldest first.
+        """
+        now = int(datetime.now().timestamp())
+        return [
+            (member.decode() if isinstance(member, bytes) else member, int(score))
+            for member, score in self.redis_client.zrangebyscore(
+                SESSIONS_KEY.format(user_id=user_id), now, "+inf", withscores=True
+            )
+        ]
+
+    def invalidate_sessions(self, user_id, session_ids=None):
+        """
+        Remove sessions of a user, all of them by default ("logout everywhere").
+        Args:
+            user_id: The user ID.
+            session_ids: The sessions to remove, every session if None.
+        Returns:
+            list: (session id, expiry timestamp) pairs of the removed sessions.
+        """
+        sessions = self.sessions(user_id)
+        if session_ids is not None:
+            sessions = [session for session in sessions if session[0] in session_ids]
+        sessions_key = SESSIONS_KEY.format(user_id=user_id)
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for session_id, _ in sessions:
+            pipeline.delete(f"t:{session_id}")
+        if session_ids is None:
+            pipeline.delete(sessions_key)
+        elif sessions:
+            pipeline.zrem(sessions_key, *[session_id for session_id, _ in sessions])
+        pipeline.execute()
+        return sessions
+
+    def migrate_token(self, token):
+        """
+        Move a token stored under its legacy token:<JWT> key to the compact key.
+        Args:
+            token: The token.
+        Returns:
+            The user ID, or None if the token has no legacy key.
+        """
+        legacy_key = f"{LEGACY_PREFIX}{token}"
+        pipeline = self.redis_client.pipeline(transaction=False)
+        pipeline.get(legacy_key)
+        pipeline.ttl(legacy_key)
+        user_id, ttl = pipeline.execute()
+        if not user_id or ttl <= 0:
+            return None
+        decoded = self._decode(token, verify_exp=False)
+        decoded.setdefault("exp", int(datetime.now().timestamp()) + ttl)
+        user_id = user_id.decode() if isinstance(user_id, bytes) else user_id
+        pipeline = self.redis_client.pipeline(transaction=True)
+        self._store(token, decoded, user_id, ttl, client=pipeline)
+        pipeline.delete(legacy_key)
+        pipeline.execute()
+        return user_id
+
 redis_token_manager = RedisTokenManager() 
\ No newline at end of file
@@ -0,0 +1,263 @@
+"""
+Revoked token ids for stateless token verification.
+
+A revocation is written to a Redis Stream once, and every worker follows the
+stream from a background thread into its own in-memory copy, so checking a
+token needs no round-trip. With settings.AUTH_REVOCATION_BLOOM the copy is a
+Bloom filter instead of a dict: it stays small however many tokens are revoked,
+and the rare hit is confirmed with Redis.
+"""
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds a stream read waits for new revocations
+READ_BLOCK_MS = 5000
+READ_COUNT = 1000
+PRUNE_INTERVAL = 60
+
+
+class BloomFilter:
+    """
+    Bloom filter over a bytearray. The bit positions come from the two halves
+    of one blake2b digest (double hashing).
+    Args:
+        capacity: Number of items the filter is sized for.
+        error_rate: False positive rate at capacity.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+def revoked_key(jti):
+    return f"revoked:{jti}"
+
+
+class RevocationSet:
+    """
+    The revoked token ids, followed from settings.AUTH_REVOCATION_STREAM.
+    Each worker loads the stream on first use, then reads new entries from a
+    background thread. The stream is trimmed to the longest token lifetime.
+    """
+
+    def __init__(self):
+        self._revoked = {}
+        self._bloom = None
+        self._last_id = None
+        self._loaded_at = 0
+        self._pruned_at = 0
+        self._pid = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._redis_client = None
+        self._stream_client = None
+        self._client_pid = None
+
+    @property
+    def redis_client(self):
+        """Redis client for the request path, created on first use and again in a forked worker"""
+        self._check_pid()
+        if self._redis_client is None:
+            from monitoring.redis_client import create_client
+
+            self._redis_client = create_client()
+        return self._redis_client
+
+    @redis_client.setter
+    def redis_client(self, client):
+        self._redis_client = self._stream_client = client
+        self._client_pid = os.getpid()
+
+    @property
+    def stream_client(self):
+        """Redis client of the blocking stream reads, kept off the request path"""
+        self._check_pid()
+        if self._stream_client is None:
+            from monitoring.redis_client import create_client
+
+            # Reads block for up to READ_BLOCK_MS, the socket has to wait longer than that
+            self._stream_client = create_client(socket_timeout=READ_BLOCK_MS / 1000 + settings.REDIS_SOCKET_TIMEOUT)
+        return self._stream_client
+
+    def _check_pid(self):
+        if self._client_pid != os.getpid():
+            self._redis_client = self._stream_client = None
+            self._client_pid = os.getpid()
+
+    def reset(self):
+        """Drop the clients and the loaded set, the next check loads them again"""
+        self._redis_client = None
+        self._stream_client = None
+        self._pid = None
+        self._generation += 1
+
+    def revoke(self, jti, exp):
+        """
+        Revoke a token id until its token expires.
+        Args:
+            jti: The token id.
+            exp: The token expiry, as a Unix timestamp.
+        """
+        self.revoke_many([(jti, exp)])
+
+    def revoke_many(self, tokens):
+        """
+        Revoke token ids in one round-trip, e.g. every session of a user.
+        Args:
+            tokens: (jti, expiry timestamp) pairs.
+        """
+        now = time.time()
+        tokens = [(jti, exp) for jti, exp in tokens if exp > now]
+        if not tokens:
+            return
+        lifetime_ms = settings.JWT_TTL_SECONDS * 1000
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for jti, exp in tokens:
+            pipeline.set(revoked_key(jti), 1, ex=int(exp - now) or 1)
+            pipeline.xadd(
+                settings.AUTH_REVOCATION_STREAM, {"jti": jti, "exp": int(exp)},
+                minid=int(now * 1000) - lifetime_ms, approximate=True
+            )
+        pipeline.execute()
+        with self._lock:
+            for jti, exp in tokens:
+                self._add(jti, exp)
+
+    def is_revoked(self, jti):
+        """
+        Check whether a token id was revoked.
+        Args:
+            jti: The token id.
+        Returns:
+            bool: True if the token was revoked.
+        """
+        if self._pid != os.getpid():
+            self._start()
+        bloom = self._bloom
+        if bloom is not None:
+            if jti not in bloom:
+                return False
+            return bool(self.redis_client.exists(revoked_key(jti)))
+        exp = self._revoked.get(jti)
+        return exp is not None and exp > time.time()
+
+    def known_revoked(self, jti):
+        """
+        Check a token id against the revocations this worker already has, without
+        Redis, e.g. while Redis is unreachable. A Bloom filter hit counts as revoked.
+        Args:
+            jti: The token id.
+        Returns:
+            bool: True if the token is known to be revoked.
+        """
+        bloom = self._bloom
+        if bloom is not None:
+            return jti in bloom
+        exp = self._revoked.get(jti)
+        return exp is not None and exp > time.time()
+
+    def sync(self, block=None):
+        """
+        Apply the revocations added to the stream since the last sync.
+        Args:
+            block: Milliseconds to wait for new revocations, None to return at once.
+        Returns:
+            int: Number of revocations applied.
+        """
+        client = self.stream_client if block else self.redis_client
+        response = client.xread(
+            {settings.AUTH_REVOCATION_STREAM: self._last_id}, count=READ_COUNT, block=block
+        )
+        applied = 0
+        with self._lock:
+            for _, entries in response or []:
+                for entry_id, fields in entries:
+                    self._add(_text(fields[b"jti"]), int(fields[b"exp"]))
+                    self._last_id = entry_id
+                    applied += 1
+        return applied
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._load()
+            self._pid = os.getpid()
+            self._generation += 1
+        threading.Thread(target=self._run, args=(self._generation,), name="revocation-sync", daemon=True).start()
+
+    def _load(self):
+        """Build the set from the whole stream, as a dict or a Bloom filter"""
+        options = settings.AUTH_REVOCATION_BLOOM
+        revoked = {}
+        bloom = BloomFilter(options["capacity"], options["error_rate"]) if options else None
+        last_id = b"0-0"
+        now = time.time()
+        for entry_id, fields in self.redis_client.xrange(settings.AUTH_REVOCATION_STREAM):
+            exp = int(fields[b"exp"])
+            if exp > now:
+                if bloom is not None:
+                    bloom.add(_text(fields[b"jti"]))
+                else:
+                    revoked[_text(fields[b"jti"])] = exp
+            last_id = entry_id
+        # Swapped in at once so checks never see a half-built set
+        self._revoked, self._bloom, self._last_id = revoked, bloom, last_id
+        self._loaded_at = self._pruned_at = now
+
+    def _add(self, jti, exp):
+        if self._bloom is not None:
+            self._bloom.add(jti)
+        else:
+            self._revoked[jti] = exp
+
+    def _run(self, generation):
+        # A reset or a fork starts a new generation, and this thread stops
+        while self._generation == generation and self._pid == os.getpid():
+            try:
+                self.sync(block=READ_BLOCK_MS)
+                self._maintain()
+            except Exception as e:
+                logger.warning("Could not sync revoked tokens: %s", e)
+                time.sleep(1)
+
+    def _maintain(self):
+        """Drop expired revocations, a Bloom filter can't forget so it is rebuilt"""
+        now = time.time()
+        if self._bloom is not None:
+            if now - self._loaded_at > settings.AUTH_REVOCATION_REBUILD_SECONDS:
+                with self._lock:
+                    self._load()
+        elif now - self._pruned_at > PRUNE_INTERVAL:
+            with self._lock:
+                self._revoked = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+                self._pruned_at = now
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+revoked_tokens = RevocationSet()
@@ -1,14 +1,28 @@
-import bcrypt
+import math
+import redis
+from django.conf import settings
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from users.mongo.user import User
 from users.permissions import IsAuthenticated, IsAdminUser
-from users.utils.jwt_utils import generate_token, invalidate_token
+from users.utils.jwt_utils import issue_token, refresh_token, invalidate_token, invalidate_user_tokens
+from users.utils.redis_auth import redis_token_manager
 from users.utils.auth_utils import extract_user_from_request
+from users.utils.passwords import hash_password, check_password
+from monitoring.redis_client import redis_circuit
 from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import AllowAny
+from logistics_backend.middleware import compression_exempt
+from datetime import datetime, timezone
+
+def token_store_unavailable():
+    """503 for requests that need to write tokens while Redis is unreachable"""
+    return Response(
+        {"error": "Authentication temporarily unavailable"}, status=503,
+        headers={"Retry-After": str(math.ceil(settings.REDIS_CIRCUIT_RESET_SECONDS))}
+    )
 
 @api_view(['POST'])
 @permission_classes([AllowAny])
@@ -23,7 +37,7 @@ def register(request):
         return Response({"error": "Missing required fields"}, status=400)
 
     try:
-        password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+        password_hash = hash_password(password)
         user = User(
             username=username,
             email=email,
@@ -34,6 +48,8 @@ def register(request):
     except Exception as e:
         return Response({"error": str(e)}, status=400)
 
+# Responses carry a fresh token, never compress them
+@compression_exempt
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def login(request):
@@ -45,14 +61,41 @@ def login(request):
     if not all([username, password]):
         return Response({"error": "Missing username or password"}, status=400)
 
+    # The token couldn't be stored, don't spend a password check on it
+    if redis_circuit.is_open:
+        return token_store_unavailable()
+
     user = User.objects(username=username).first()
     if not user:
         return Response({"error": "Invalid credentials"}, status=401)
 
-    if not bcrypt.checkpw(password.encode(), user.password_hash.encode()):
+    if not check_password(password, user.password_hash):
         return Response({"error": "Invalid credentials"}, status=401)
 
-    token = generate_token(str(user.id))
+    try:
+        token = issue_token(user)
+    except (redis.ConnectionError, redis.TimeoutError):
+        return token_store_unavailable()
+    return Response({"token": token}, status=200)
+
+# Responses carry a fresh token, never compress them
+@compression_exempt
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def refresh(request):
+    """Swap a valid token for a new one, the old token stops working"""
+    auth_header = request.META.get("HTTP_AUTHORIZATION", "")
+    if not auth_header.startswith("Bearer "):
+        return Response({"error": "Missing token"}, status=401)
+    if redis_circuit.is_open:
+        return token_store_unavailable()
+
+    try:
+        token = refresh_token(auth_header.split(" ")[1])
+    except (redis.ConnectionError, redis.TimeoutError):
+        return token_store_unavailable()
+    if not token:
+        return Response({"error": "Invalid token"}, status=401)
     return Response({"token": token}, status=200)
 
 @api_view(['POST'])
@@ -66,6 +109,30 @@ def logout(request):
     except Exception:
         return Response({"error": "Invalid token"}, status=401)
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def logout_all(request):
+    """Log the user out of every session"""
+    count = invalidate_user_tokens(str(request.user.id))
+    return Response({"message": "Logged out of all sessions", "sessions": count}, status=200)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def sessions(request):
+    """List the active sessions of the user"""
+    token = request.META.get("HTTP_AUTHORIZATION").split(" ")[1]
+    current = redis_token_manager.session_id(token)
+    return Response({
+        "sessions": [
+            {
+                "id": session_id,
+                "expires_at": datetime.fromtimestamp(exp, timezone.utc).isoformat(),
+                "current": session_id == current
+            }
+            for session_id, exp in redis_token_manager.sessions(str(request.user.id))
+        ]
+    }, status=200)
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated, IsAdminUser])
 def create_admin(request):
@@ -83,7 +150,7 @@ def create_admin(request):
         if not all([username, email, password]):
             return Response({"error": "Missing required fields"}, status=400)
 
-        password_hash = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+        password_hash = hash_password(password)
         user = User(
             username=username,
             email=email,